@@ -0,0 +1,292 @@
+"""
+    Resumable backfill of an archive of swift netcdf files:
+
+        python backfill_stf_flow.py /data/stf_archive \
+            --start 2018-01-01 --end 2020-12-31 --catchments kiewa ovens \
+            --workers 4 --checkpoint kiewa_ovens.json
+
+    Files (<data_dir>/<catchment>/SWIFT-*.nc) are partitioned by catchment and
+    forecast date. Each partition (its observed then forecast file) is
+    ingested with `ingest_stf_flow.ingest_file`, and recorded in the
+    checkpoint json once all of its files have gone in without error. A
+    rerun with the same checkpoint skips the recorded partitions, so an
+    interrupted backfill resumes where it stopped. Failed partitions, and
+    partitions with files that were being ingested by another process (which
+    may still fail there), are not recorded and are retried on the next run.
+
+    Within a partition, files that are complete in the ingest manifest are
+    skipped as usual (unless --force), so a partition that was interrupted
+    half way only redoes the files that didn't finish.
+
+    Observed files are ingested in full (not OBS_INCREMENTAL), since
+    partitions can go in out of order, e.g. a retried partition or workers
+    finishing in a different order. That leaves gaps in the stored ranges, so
+    incremental ingest would mostly send every row anyway, after counting the
+    rows stored for each station.
+
+    Unlike `ingest_stf_flow.py` the tables are never deleted.
+"""
+import os
+import json
+import time
+import logging
+import argparse
+import datetime
+import functools
+import collections
+import multiprocessing
+
+import stf_conf
+import stf_sinks
+import ingest_stf_flow
+
+LOGGER = logging.getLogger(__name__)
+
+# the checkpoint is rewritten after every partition, progress is only logged
+# this often to keep the output readable for long backfills
+PROGRESS_INTERVAL = 30  # seconds
+
+
+def find_partitions(data_dir, start_date=None, end_date=None, catchments=None):
+    """
+        Returns {(catchment, date): [(stf_type, filename), ...]} for the swift
+        files in data_dir within [start_date, end_date] (inclusive). Observed
+        files are listed before forecast files, the same as
+        `ingest_stf_nc_to_db`.
+    """
+    ingest_stf_flow.DATA_DIR = data_dir
+    fn_map = ingest_stf_flow.find_stf_nc()
+
+    partitions = collections.defaultdict(list)
+    for stf_type in ['obs_flow', 'fc_flow']:
+        for fn in sorted(fn_map[stf_type]):
+            fc_dt, catchment = ingest_stf_flow.get_filename_info(fn)
+            d = fc_dt.date()
+            if catchments and catchment not in catchments:
+                continue
+            if (start_date and d < start_date) or (end_date and d > end_date):
+                continue
+            partitions[(catchment, d)].append((stf_type, fn))
+    return dict(sorted(partitions.items()))
+
+
+def partition_key(partition):
+    catchment, d = partition
+    return '{}/{:%Y-%m-%d}'.format(catchment, d)
+
+
+def load_checkpoint(path):
+    if not os.path.exists(path):
+        return {'completed': {}}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_checkpoint(path, checkpoint):
+    # write then rename so that an interrupted write can't corrupt it
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(checkpoint, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def ingest_partition(item, force=False):
+    """
+        item: (key, tasks)
+
+        Returns (key, results) with a result per file from
+        `ingest_stf_flow.ingest_file`.
+    """
+    key, tasks = item
+    return key, [ingest_stf_flow.ingest_file(t, force=force) for t in tasks]
+
+
+class Progress():
+    """
+        Tracks rows/s and estimates the time remaining from the bytes of the
+        partitions still to go, as partitions vary a lot in size.
+    """
+    def __init__(self, n_partitions, total_bytes):
+        self.n_partitions = n_partitions
+        self.total_bytes = total_bytes
+        self.n_done = 0
+        self.n_failed = 0
+        self.done_bytes = 0
+        self.n_rows = 0
+        self.start_time = time.time()
+        self._last_log = 0
+
+    def update(self, n_bytes, n_rows, failed=False):
+        self.n_done += 1
+        self.n_failed += failed
+        self.done_bytes += n_bytes
+        self.n_rows += n_rows
+
+    def eta(self):
+        elapsed = time.time() - self.start_time
+        if self.done_bytes == 0:
+            return None
+        return elapsed * (self.total_bytes - self.done_bytes) / self.done_bytes
+
+    def log(self, force=False):
+        now = time.time()
+        if not force and now - self._last_log < PROGRESS_INTERVAL:
+            return
+        self._last_log = now
+        elapsed = now - self.start_time
+        eta = self.eta()
+        LOGGER.info(
+            "{}/{} partitions ({} failed), {} rows, {:.0f} rows/s, "
+            "elapsed {}, eta {}".format(
+                self.n_done, self.n_partitions, self.n_failed, self.n_rows,
+                self.n_rows / max(elapsed, 1e-6), format_seconds(elapsed),
+                format_seconds(eta) if eta is not None else '?'))
+
+
+def format_seconds(seconds):
+    return str(datetime.timedelta(seconds=int(seconds)))
+
+
+def backfill(data_dir, checkpoint_path, start_date=None, end_date=None,
+        catchments=None, n_workers=1,
+        max_concurrent_copy=ingest_stf_flow.MAX_CONCURRENT_COPY, force=False,
+        full_obs=True):
+    """
+        Ingests every partition not yet in the checkpoint. Returns the keys
+        of partitions that failed or weren't checkpointed.
+
+        full_obs: ingest the whole observed history of every file, see the
+                  module docstring. Turning it off only pays off if
+                  partitions are ingested in date order.
+    """
+    ingest_stf_flow.OBS_INCREMENTAL = not full_obs
+    checkpoint = load_checkpoint(checkpoint_path)
+    completed = checkpoint['completed']
+
+    partitions = find_partitions(data_dir, start_date, end_date, catchments)
+    todo = [(partition_key(p), tasks) for p, tasks in partitions.items()
+        if partition_key(p) not in completed]
+    LOGGER.info("{} partitions in range, {} already completed, {} to go".format(
+        len(partitions), len(partitions) - len(todo), len(todo)))
+    if not todo:
+        return []
+
+    todo_bytes = {key: sum(os.path.getsize(fn) for _, fn in tasks)
+        for key, tasks in todo}
+    progress = Progress(len(todo), sum(todo_bytes.values()))
+    failed = []
+
+    def record(key, results):
+        errors = [r for r in results if r['error'] is not None]
+        in_flight = [r for r in results if r['in_flight']]
+        n_rows = sum(r['n_rows'] for r in results)
+        progress.update(
+            todo_bytes[key], n_rows, failed=bool(errors or in_flight))
+        if errors or in_flight:
+            failed.append(key)
+            for r in errors:
+                LOGGER.error("FAILED: {} - {}".format(r['fn'], r['error']))
+            for r in in_flight:
+                LOGGER.warning("NOT CHECKPOINTED: {} is being ingested "
+                    "elsewhere".format(r['fn']))
+        else:
+            completed[key] = {
+                'rows': n_rows,
+                'seconds': round(sum(r['seconds'] for r in results), 3),
+                'finished': datetime.datetime.utcnow().isoformat() + 'Z'
+            }
+            save_checkpoint(checkpoint_path, checkpoint)
+        progress.log()
+
+    try:
+        if n_workers <= 1:
+            for item in todo:
+                record(*ingest_partition(item, force=force))
+        else:
+            # forked, so that workers inherit the connection, sinks and
+            # OBS_INCREMENTAL set above (see `ingest_stf_nc_to_db`)
+            ctx = multiprocessing.get_context('fork')
+            copy_semaphore = ctx.BoundedSemaphore(max_concurrent_copy)
+            with ctx.Pool(
+                    n_workers,
+                    initializer=ingest_stf_flow.init_worker,
+                    initargs=(copy_semaphore,)) as pool:
+                for key, results in pool.imap_unordered(
+                        functools.partial(ingest_partition, force=force), todo):
+                    record(key, results)
+    except KeyboardInterrupt:
+        LOGGER.warning(
+            "interrupted, {} partitions completed this run. rerun with "
+            "--checkpoint {} to resume".format(
+                progress.n_done - progress.n_failed, checkpoint_path))
+        raise
+    finally:
+        progress.log(force=True)
+
+    return failed
+
+
+def parse_date(s):
+    return datetime.datetime.strptime(s, '%Y-%m-%d').date()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(
+        level=logging.INFO,
+        format="[%(asctime)s|%(levelname)s|%(module)s.%(funcName)s]: %(message)s"
+    )
+
+    parser = argparse.ArgumentParser(
+        description='resumable backfill of swift netcdf files into timescaledb')
+    parser.add_argument('data_dir', nargs='?', default=ingest_stf_flow.DATA_DIR,
+        help='directory with <catchment>/SWIFT-*.nc files '
+            '(default: ingest_stf_flow.DATA_DIR)')
+    parser.add_argument('--start', type=parse_date,
+        help='first forecast date YYYY-mm-dd (default: earliest file)')
+    parser.add_argument('--end', type=parse_date,
+        help='last forecast date YYYY-mm-dd, inclusive (default: latest file)')
+    parser.add_argument('--catchments', nargs='+',
+        help='catchments to backfill (default: all in data_dir)')
+    parser.add_argument('--checkpoint', default='backfill_checkpoint.json',
+        help='json file recording completed partitions '
+            '(default: backfill_checkpoint.json)')
+    parser.add_argument('--reset', action='store_true',
+        help='ignore and overwrite an existing checkpoint')
+    parser.add_argument('--connection', default=stf_conf.CONNECTION,
+        help='database connection string (default: from stf_tsdb.cfg)')
+    parser.add_argument('--workers', type=int, default=1,
+        help='number of worker processes (default: 1, serial)')
+    parser.add_argument('--max-concurrent-copy', type=int,
+        default=ingest_stf_flow.MAX_CONCURRENT_COPY,
+        help='max COPY transactions in flight across workers (default: {})'
+            .format(ingest_stf_flow.MAX_CONCURRENT_COPY))
+    parser.add_argument('--force', action='store_true',
+        help='re-ingest files even if the manifest has them as complete')
+    parser.add_argument('--incremental-obs', action='store_true',
+        help='only send observed timestamps outside the range already '
+            'stored, for stations without gaps (faster when partitions go in '
+            'date order, e.g. --workers 1)')
+    parser.add_argument('--parquet-dir',
+        help='also write the ingested rows as parquet, partitioned by '
+            'catchment/date, under this directory (requires pyarrow)')
+    args = parser.parse_args()
+    if args.start and args.end and args.start > args.end:
+        parser.error('--start is after --end')
+
+    stf_conf.CONNECTION = args.connection
+    if args.parquet_dir:
+        ingest_stf_flow.SINKS.append(stf_sinks.ParquetSink(args.parquet_dir))
+    if args.reset and os.path.exists(args.checkpoint):
+        os.remove(args.checkpoint)
+    # per file logging is too noisy for a long backfill
+    ingest_stf_flow.LOGGER.setLevel(logging.WARNING)
+
+    failed = backfill(
+        args.data_dir, args.checkpoint, start_date=args.start,
+        end_date=args.end, catchments=args.catchments, n_workers=args.workers,
+        max_concurrent_copy=args.max_concurrent_copy, force=args.force,
+        full_obs=not args.incremental_obs)
+    if failed:
+        LOGGER.error("{} partitions failed (not checkpointed): {}".format(
+            len(failed), ', '.join(failed)))
+        raise SystemExit(1)
@@ -0,0 +1,235 @@
+"""
+    Benchmarks the swift netcdf ingest against a local timescaledb, e.g. with
+    files from `generate_stf_nc.py`:
+
+        python generate_stf_nc.py /tmp/stf_bench --catchments bencha benchb
+        python benchmark_ingest.py /tmp/stf_bench --seed-metadata --json out.json
+
+    Each file is ingested with `ingest_fc`/`ingest_obs` (the lambda shares
+    this code) and the time spent in each stage is taken from the ingest's
+    `stf_metrics` spans:
+
+        decode   - open the netcdf file (and with --preload, decode the
+                   variables, otherwise that happens in the later stages)
+        metadata - resolve node ids to meta_ids (`station_meta_ids`)
+        quantile - ensemble percentiles (`quantiles`, forecasts only)
+        frame    - build the rows (`fc_frame`/`obs_frame`), including the
+                   metadata and quantile stages
+        encode   - binary COPY encoding (`encode_frame`)
+        copy     - COPY + INSERT into the table (`copy_to_db`)
+        ensemble - raw ensembles (`ingest_fc_ens_to_db`, --store-ensemble)
+
+    along with the peak RSS of the process. With --baseline, stages that are
+    slower than the baseline json by more than --tolerance are reported and
+    the script exits with status 1.
+
+    CAUTION: rows for the catchments being benchmarked are deleted before
+    every repeat (unless --keep-rows), only run this on a test database.
+"""
+import os
+import sys
+import glob
+import json
+import time
+import resource
+import logging
+import argparse
+
+import stf_conf
+import stf_metrics
+import ingest_stf_flow
+
+LOGGER = logging.getLogger(__name__)
+
+
+def benchmark_file(fn, preload=False):
+    """
+        Ingests a single file with `ingest_fc`/`ingest_obs`. Returns the
+        number of new rows.
+
+        Those open the file lazily, so the variables are decoded as the
+        frames are built. With `preload` the file goes through the pipelined
+        ingest's steps (`ingest_stages`) instead, as they are the ones that
+        decode the whole file up front. They also check and update the
+        ingest manifest, forced so that the file isn't skipped.
+    """
+    is_fc = 'Forecast-Flow' in os.path.basename(fn)
+    if not preload:
+        if is_fc:
+            return ingest_stf_flow.ingest_fc(fn)
+        return ingest_stf_flow.ingest_obs(fn)
+
+    result = ingest_stf_flow.new_result(
+        ('fc_flow' if is_fc else 'obs_flow', fn))
+    for stage in ingest_stf_flow.ingest_stages(force=True, preload=True):
+        result = stage(result)
+    # the ingest steps record errors rather than raising them
+    if result['error'] is not None:
+        raise RuntimeError('failed to ingest {}: {}'.format(
+            fn, result['error']))
+    return result['n_rows']
+
+
+def run(fns, repeat=1, preload=False, cold_metadata=False,
+        keep_rows=False):
+    catchments = sorted({ingest_stf_flow.get_filename_info(fn)[1]
+        for fn in fns})
+    all_spans = []
+    n_rows = 0
+    start_time = time.perf_counter()
+    for i in range(repeat):
+        if not keep_rows:
+            delete_catchment_rows(catchments)
+        # only the spans of the ingest itself, not of deleting rows
+        with stf_metrics.context() as spans:
+            for fn in fns:
+                if cold_metadata:
+                    ingest_stf_flow.invalidate_meta_cache()
+                n_rows += benchmark_file(fn, preload=preload)
+                LOGGER.debug('{}: peak rss {:.1f} MiB'.format(
+                    os.path.basename(fn), peak_rss() / 2**20))
+        all_spans.extend(spans)
+    delta_t = time.perf_counter() - start_time
+
+    n_files = len(fns) * repeat
+    totals = stf_metrics.summarize(all_spans)
+    return {
+        'files': n_files,
+        'rows': n_rows,
+        'seconds': delta_t,
+        'rows_per_s': n_rows / max(delta_t, 1e-6),
+        'peak_rss_bytes': peak_rss(),
+        # `stf_metrics.summarize` totals, plus the time per file
+        'stages': {
+            s: dict(t, ms_per_file=1000 * t['seconds'] / max(n_files, 1))
+            for s, t in totals.items()
+        }
+    }
+
+
+def peak_rss():
+    # ru_maxrss is in kilobytes on linux and bytes on macos
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def delete_catchment_rows(catchments):
+    with ingest_stf_flow.db_connection() as con:
+        with con.cursor() as cur:
+            for table_name in [ingest_stf_flow.FC_DAILY_TABLE_NAME,
+                    ingest_stf_flow.OBS_DAILY_TABLE_NAME,
+                    ingest_stf_flow.CATALOG_TABLE_NAME,
+                    ingest_stf_flow.ENS_TABLE_NAME,
+                    ingest_stf_flow.FC_TABLE_NAME,
+                    ingest_stf_flow.OBS_TABLE_NAME]:
+                cur.execute(
+                    """
+                        DELETE FROM {} WHERE meta_id IN (
+                            SELECT pk_meta FROM stf_metadata
+                            WHERE catchment = ANY(%s)
+                        );
+                    """.format(table_name), (catchments,))
+            # the same as `delete_from_tables`, so the api doesn't keep
+            # serving cached responses for the deleted rows
+            for table_name in [ingest_stf_flow.FC_TABLE_NAME,
+                    ingest_stf_flow.OBS_TABLE_NAME,
+                    ingest_stf_flow.ENS_TABLE_NAME]:
+                cur.execute(ingest_stf_flow.BUMP_VERSION_SQL, (table_name,))
+    ingest_stf_flow.invalidate_obs_range_cache()
+
+
+def seed_metadata(metadata_csv):
+    # reuse the metadata ingest, existing awrc_ids keep their pk_meta
+    import ingest_meta
+    ingest_meta.METADATA_CSV = metadata_csv
+    ingest_meta.ingest()
+    ingest_stf_flow.invalidate_meta_cache()
+
+
+def report(results):
+    print('{files} files, {rows} rows in {seconds:.2f}s ({rows_per_s:.0f} '
+        'rows/s), peak rss {rss:.1f} MiB'.format(
+            rss=results['peak_rss_bytes'] / 2**20, **results))
+    # times are inclusive, e.g. frame includes metadata and quantile
+    print(stf_metrics.format_summary(results['stages']))
+
+
+def compare(results, baseline, tolerance):
+    """ Returns the stages that regressed compared to the baseline results """
+    regressions = []
+    for s, v in results['stages'].items():
+        base = baseline['stages'].get(s, {}).get('ms_per_file')
+        # ignore stages that are too quick to time reliably
+        if base is None or max(base, v['ms_per_file']) < 1.0:
+            continue
+        if v['ms_per_file'] > base * (1 + tolerance):
+            regressions.append(
+                '{}: {:.2f} ms/file (baseline {:.2f})'.format(
+                    s, v['ms_per_file'], base))
+    return regressions
+
+
+if __name__ == '__main__':
+    logging.basicConfig(
+        level=logging.INFO,
+        format="[%(asctime)s|%(levelname)s|%(module)s.%(funcName)s]: %(message)s"
+    )
+
+    parser = argparse.ArgumentParser(
+        description='benchmark the swift netcdf ingest stages')
+    parser.add_argument('data_dir',
+        help='directory with <catchment>/SWIFT-*.nc files')
+    parser.add_argument('--connection', default=stf_conf.CONNECTION,
+        help='database connection string (default: from stf_tsdb.cfg)')
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--seed-metadata', action='store_true',
+        help='ingest <data_dir>/metadata/station_metadata.csv first')
+    parser.add_argument('--preload', action='store_true',
+        help='decode every variable in the decode stage, as the pipelined '
+            'ingest does (otherwise decoding shows up in the quantile/frame '
+            'stages)')
+    parser.add_argument('--cold-metadata', action='store_true',
+        help='clear the metadata cache before every file')
+    parser.add_argument('--keep-rows', action='store_true',
+        help="don't delete existing rows for the catchments between repeats")
+    parser.add_argument('--stream', action='store_true',
+        help='stream forecast rows into COPY in chunks of stations x lead '
+            'times (see ingest_stf_flow.FC_STREAM), the frame and encode '
+            'time then shows up in the copy stage')
+    parser.add_argument('--store-ensemble', action='store_true',
+        help='also store the raw forecast ensembles '
+            '(see ingest_stf_flow.STORE_ENSEMBLE)')
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--baseline', help='results json to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+        help='allowed slowdown per stage vs the baseline (default: 0.2)')
+    args = parser.parse_args()
+
+    stf_conf.CONNECTION = args.connection
+    ingest_stf_flow.FC_STREAM = args.stream
+    ingest_stf_flow.STORE_ENSEMBLE = args.store_ensemble
+    ingest_stf_flow.LOGGER.setLevel(logging.WARNING)
+
+    if args.seed_metadata:
+        seed_metadata(os.path.join(
+            args.data_dir, 'metadata', 'station_metadata.csv'))
+
+    fns = sorted(glob.glob(os.path.join(args.data_dir, '*', 'SWIFT-*.nc')))
+    if not fns:
+        parser.error('no SWIFT-*.nc files found in {}'.format(args.data_dir))
+
+    results = run(fns, repeat=args.repeat, preload=args.preload,
+        cold_metadata=args.cold_metadata, keep_rows=args.keep_rows)
+    report(results)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for r in regressions:
+            LOGGER.error('regression - {}'.format(r))
+        if regressions:
+            sys.exit(1)
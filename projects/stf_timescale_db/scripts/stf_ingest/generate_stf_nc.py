@@ -0,0 +1,191 @@
+"""
+    Generates synthetic SWIFT netcdf files with the same layout as the sample
+    data (see `get_sample_data_from_s3.sh`), for benchmarking and testing the
+    ingest without access to the sample data bucket:
+
+        <out_dir>/<catchment>/SWIFT-Ensemble-Forecast-Flow_<catchment>_<date>_2300.nc
+        <out_dir>/<catchment>/SWIFT-Ensemble-Observed-Flow_<catchment>_<date>_2300.nc
+
+    Forecast files:
+        q_fcast_ens (time, ens_member, station, lead_time) - float32
+        station_id  (station)                               - node id
+    Observed files:
+        q_der      (time, station) - hourly, float32
+        station_id (station)
+
+    A matching station metadata csv (in the format read by `ingest_meta.py`)
+    is written to <out_dir>/metadata/station_metadata.csv so that the node ids
+    resolve to stations once it has been ingested.
+"""
+import os
+import argparse
+import datetime
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+FC_HOUR = 23
+FC_FN_FMT = 'SWIFT-Ensemble-Forecast-Flow_{catchment}_{dt:%Y%m%d_%H%M}.nc'
+OBS_FN_FMT = 'SWIFT-Ensemble-Observed-Flow_{catchment}_{dt:%Y%m%d_%H%M}.nc'
+FILL_VALUE = np.float32(-9999.0)
+
+
+def generate(out_dir, catchments, start_date, n_days=1, n_station=20,
+        n_lead=240, n_ens=100, n_obs_days=10, missing_frac=0.0, seed=0):
+    """
+        Writes forecast and observed files for every catchment and forecast
+        date, plus the station metadata csv. Returns the list of files written.
+    """
+    # the ingest takes the catchment from the '_' separated filename
+    assert not any('_' in c for c in catchments), \
+        "catchment names can't contain '_'"
+
+    rng = np.random.default_rng(seed)
+    fns = []
+    meta = []
+    for ci, catchment in enumerate(catchments):
+        catchment_dir = os.path.join(out_dir, catchment)
+        os.makedirs(catchment_dir, exist_ok=True)
+
+        # each station has its own flow regime
+        node_ids = np.arange(1, n_station + 1, dtype=np.int32)
+        base_flow = rng.lognormal(mean=2.0, sigma=1.0, size=n_station)
+        meta.append(station_metadata(ci, catchment, node_ids, rng))
+
+        for d in range(n_days):
+            fc_dt = (datetime.datetime.combine(start_date, datetime.time(FC_HOUR))
+                + datetime.timedelta(days=d))
+
+            ds_fc = fc_dataset(node_ids, base_flow, fc_dt, n_lead, n_ens,
+                missing_frac, rng)
+            fn = os.path.join(catchment_dir,
+                FC_FN_FMT.format(catchment=catchment, dt=fc_dt))
+            ds_fc.to_netcdf(fn)
+            fns.append(fn)
+
+            ds_obs = obs_dataset(node_ids, base_flow, fc_dt, n_obs_days,
+                missing_frac, rng)
+            fn = os.path.join(catchment_dir,
+                OBS_FN_FMT.format(catchment=catchment, dt=fc_dt))
+            ds_obs.to_netcdf(fn)
+            fns.append(fn)
+
+    meta_dir = os.path.join(out_dir, 'metadata')
+    os.makedirs(meta_dir, exist_ok=True)
+    pd.concat(meta).to_csv(
+        os.path.join(meta_dir, 'station_metadata.csv'), index=False)
+
+    return fns
+
+
+def fc_dataset(node_ids, base_flow, fc_dt, n_lead, n_ens, missing_frac, rng):
+    n_station = len(node_ids)
+    lead_time = np.arange(1, n_lead + 1, dtype=np.int32)
+
+    # ensemble spread grows with lead time, with a slow recession trend
+    spread = 0.1 + 0.5 * np.sqrt(lead_time / n_lead)
+    trend = np.exp(-lead_time / (10.0 * n_lead))
+    noise = rng.standard_normal((1, n_ens, n_station, n_lead))
+    q = (base_flow[None, None, :, None] * trend[None, None, None, :]
+        * np.exp(spread[None, None, None, :] * noise)).astype(np.float32)
+    q = with_missing(q, missing_frac, rng)
+
+    ds = xr.Dataset(
+        {
+            'q_fcast_ens': (('time', 'ens_member', 'station', 'lead_time'), q),
+            'station_id': (('station',), node_ids)
+        },
+        coords={
+            'time': [0],
+            'ens_member': np.arange(1, n_ens + 1, dtype=np.int32),
+            'station': np.arange(n_station, dtype=np.int32),
+            'lead_time': lead_time
+        }
+    )
+    # the ingest opens forecasts with decode_times=False as these units
+    # aren't cf compliant
+    ds['time'].attrs['units'] = 'hours since {:%Y-%m-%d %H:%M:%S}'.format(fc_dt)
+    ds['lead_time'].attrs['units'] = 'hours since time of forecast'
+    ds['q_fcast_ens'].attrs['units'] = 'm3/s'
+    ds['q_fcast_ens'].encoding['_FillValue'] = FILL_VALUE
+    return ds
+
+
+def obs_dataset(node_ids, base_flow, fc_dt, n_obs_days, missing_frac, rng):
+    n_station = len(node_ids)
+    time = pd.date_range(
+        end=fc_dt, periods=n_obs_days * 24, freq='h').values
+
+    # random walk in log space around the base flow
+    walk = np.cumsum(
+        0.05 * rng.standard_normal((len(time), n_station)), axis=0)
+    q = (base_flow[None, :] * np.exp(walk)).astype(np.float32)
+    q = with_missing(q, missing_frac, rng)
+
+    ds = xr.Dataset(
+        {
+            'q_der': (('time', 'station'), q),
+            'station_id': (('station',), node_ids)
+        },
+        coords={
+            'time': time,
+            'station': np.arange(n_station, dtype=np.int32)
+        }
+    )
+    ds['q_der'].attrs['units'] = 'm3/s'
+    ds['q_der'].encoding['_FillValue'] = FILL_VALUE
+    return ds
+
+
+def with_missing(q, missing_frac, rng):
+    if missing_frac > 0:
+        q[rng.random(q.shape) < missing_frac] = np.nan
+    return q
+
+
+def station_metadata(ci, catchment, node_ids, rng):
+    """
+        Station metadata in the columns used by `ingest_meta.py`. awrc_ids are
+        made up (but unique and within the 10 character limit).
+    """
+    lon0, lat0 = rng.uniform(140.0, 150.0), rng.uniform(-38.0, -28.0)
+    return pd.DataFrame({
+        'awrc_id': ['SYN{:02d}{:05d}'.format(ci, n) for n in node_ids],
+        'outlet_node': node_ids,
+        'catchment': catchment,
+        'region': 'SYN',
+        'station_name': ['{} synthetic {}'.format(catchment, n)
+            for n in node_ids],
+        'lon': lon0 + rng.uniform(-0.5, 0.5, len(node_ids)),
+        'lat': lat0 + rng.uniform(-0.5, 0.5, len(node_ids))
+    })
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='generate synthetic swift forecast/observed netcdf files')
+    parser.add_argument('out_dir')
+    parser.add_argument('--catchments', nargs='+', default=['synthetic'])
+    parser.add_argument('--start-date', default='2020-10-09',
+        type=lambda s: datetime.datetime.strptime(s, '%Y-%m-%d').date(),
+        help='first forecast date YYYY-mm-dd (default: 2020-10-09)')
+    parser.add_argument('--days', type=int, default=1,
+        help='number of forecast dates per catchment (default: 1)')
+    parser.add_argument('--stations', type=int, default=20)
+    parser.add_argument('--lead-times', type=int, default=240,
+        help='hourly lead times per forecast (default: 240)')
+    parser.add_argument('--ensemble', type=int, default=100,
+        help='ensemble members per forecast (default: 100)')
+    parser.add_argument('--obs-days', type=int, default=10,
+        help='days of hourly observations per file (default: 10)')
+    parser.add_argument('--missing-frac', type=float, default=0.0,
+        help='fraction of values set to missing (default: 0)')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    fns = generate(
+        args.out_dir, args.catchments, args.start_date, n_days=args.days,
+        n_station=args.stations, n_lead=args.lead_times, n_ens=args.ensemble,
+        n_obs_days=args.obs_days, missing_frac=args.missing_frac,
+        seed=args.seed)
+    print('wrote {} files to {}'.format(len(fns), args.out_dir))
@@ -1,7 +1,9 @@
+import io
 import os
+import time
+import argparse
 import pandas as pd
 import psycopg2
-import re
 import stf_conf
 
 DIR = os.path.dirname(os.path.abspath(__file__))
@@ -11,52 +13,119 @@ METADATA_CSV = os.path.join(DATA_DIR, 'metadata', 'station_metadata.csv')
 # TODO: abstract out SRID
 SRID_AUS=4283
 
-# Only use following columns for now
-# station_name, awrc_id, outlet_node, catchment, region, station_name
-
-# UPSERT if already exists
+# Only use following columns for now, in the order they're copied into the
+# staging table
+META_COLUMNS = [
+    'awrc_id', 'outlet_node', 'catchment', 'region', 'station_name', 'lon',
+    'lat'
+]
+STAGING_TABLE_NAME = 'stf_metadata_staging'
 
 
 def ingest():
-    df_meta = pd.read_csv(METADATA_CSV)
-
-    def to_sql_str(x):
-        return "'" + re.sub(r"'", r"''", str(x)) + "'"
-
-    def form_query_values(row):
-        return "({})".format(
-            ",".join([
-                to_sql_str(row['awrc_id']),
-                str(row['outlet_node']),
-                to_sql_str(row['catchment']),
-                to_sql_str(row['region']),
-                to_sql_str(row['station_name']),
-                "ST_SetSRID(ST_MakePoint({lon},{lat}),{srid})".format(
-                    lon=row['lon'], lat=row['lat'], srid=SRID_AUS
-                )
-        ]))
-
-    query_values = df_meta.apply(form_query_values, axis=1)
-    query_values_str = ',\n'.join(query_values)
-    print(query_values_str)
-
-    # since this isn't huge data we can just INSERT instead of COPY, also
-    # simpler to handle CONFLICTS this way.
-
-    # TODO: do nothing for conlifct for now as UPDATE every column is a pain
-    # esp since we may be adding more columns
-    # This will need to change on the actual ingest code
+    """
+        UPSERTs the stations in METADATA_CSV into stf_metadata:
+
+            csv -> COPY -> staging table -> INSERT ... ON CONFLICT DO UPDATE
+
+        all in one transaction. The location is built from lon/lat in the
+        database. Stations already in stf_metadata (by awrc_id) are updated
+        if anything changed, so their pk_meta (and the flow rows referring to
+        it) stay the same. If an awrc_id is listed more than once the last
+        row wins.
+    """
+    start_time = time.time()
+    df_meta = pd.read_csv(METADATA_CSV, usecols=META_COLUMNS)
+    # keep outlet_node an integer even if pandas sees missing values
+    df_meta['outlet_node'] = df_meta['outlet_node'].astype('Int64')
+
+    # empty (unquoted) fields are NULL for COPY csv
+    csv_buffer = io.StringIO()
+    df_meta[META_COLUMNS].to_csv(csv_buffer, index=False, header=False)
+    csv_buffer.seek(0)
+
     with psycopg2.connect(stf_conf.CONNECTION) as con:
         with con.cursor() as cur:
-            query = """
-                INSERT INTO stf_metadata (
-                    awrc_id, outlet_node, catchment,region, station_name, location
-                ) VALUES {} ON CONFLICT (awrc_id) DO NOTHING;
-            """.format(query_values_str)
-            # TODO: error handling?
-            cur.execute(query)
-            con.commit()
+            cur.execute(
+                """
+                    CREATE TEMP TABLE {} (
+                        row_no          BIGSERIAL,
+                        awrc_id         VARCHAR(10),
+                        outlet_node     INTEGER,
+                        catchment       VARCHAR(255),
+                        region          VARCHAR(10),
+                        station_name    TEXT,
+                        lon             DOUBLE PRECISION,
+                        lat             DOUBLE PRECISION
+                    ) ON COMMIT DROP;
+                """.format(STAGING_TABLE_NAME))
+            cur.copy_expert(
+                """
+                    COPY {} ({}) FROM STDIN WITH (FORMAT csv)
+                """.format(STAGING_TABLE_NAME, ', '.join(META_COLUMNS)),
+                csv_buffer)
+            n_copied = cur.rowcount
+
+            # xmax = 0 for freshly inserted rows, otherwise it was updated
+            cur.execute(
+                """
+                    INSERT INTO stf_metadata (
+                        awrc_id, outlet_node, catchment, region, station_name,
+                        location
+                    )
+                    SELECT DISTINCT ON (awrc_id)
+                        awrc_id, outlet_node, catchment, region, station_name,
+                        ST_SetSRID(ST_MakePoint(lon, lat), %(srid)s)
+                    FROM {}
+                    ORDER BY awrc_id, row_no DESC
+                    ON CONFLICT (awrc_id) DO UPDATE SET
+                        outlet_node = EXCLUDED.outlet_node,
+                        catchment = EXCLUDED.catchment,
+                        region = EXCLUDED.region,
+                        station_name = EXCLUDED.station_name,
+                        location = EXCLUDED.location
+                    WHERE (
+                        stf_metadata.outlet_node, stf_metadata.catchment,
+                        stf_metadata.region, stf_metadata.station_name,
+                        stf_metadata.location
+                    ) IS DISTINCT FROM (
+                        EXCLUDED.outlet_node, EXCLUDED.catchment,
+                        EXCLUDED.region, EXCLUDED.station_name,
+                        EXCLUDED.location
+                    )
+                    RETURNING (xmax = 0) AS inserted;
+                """.format(STAGING_TABLE_NAME), {'srid': SRID_AUS})
+            inserted = [r[0] for r in cur.fetchall()]
+            # invalidates the api's cached responses (see stf_ingest_version
+            # in setup_tables.sql)
+            if inserted:
+                cur.execute(
+                    """
+                        INSERT INTO stf_ingest_version (table_name, version)
+                        VALUES ('stf_metadata', 1)
+                        ON CONFLICT (table_name) DO UPDATE SET
+                            version = stf_ingest_version.version + 1,
+                            updated_at = now();
+                    """)
+
+    n_inserted = sum(inserted)
+    print('{} stations in {}: {} inserted, {} updated, {} unchanged '
+        '({:.2f}s)'.format(
+            n_copied, os.path.basename(METADATA_CSV), n_inserted,
+            len(inserted) - n_inserted,
+            df_meta['awrc_id'].nunique() - len(inserted),
+            time.time() - start_time))
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='upsert station metadata into stf_metadata')
+    parser.add_argument('metadata_csv', nargs='?', default=METADATA_CSV,
+        help='station metadata csv (default: {})'.format(METADATA_CSV))
+    parser.add_argument('--connection', default=stf_conf.CONNECTION,
+        help='database connection string (default: from stf_tsdb.cfg)')
+    args = parser.parse_args()
+
+    METADATA_CSV = args.metadata_csv
+    stf_conf.CONNECTION = args.connection
     ingest()
@@ -1,19 +1,30 @@
 import os
 import time
-import io
 import json
-import functools
 import pytz
 import dateutil.parser
+import contextlib
+import threading
+import zlib
 import psycopg2
+import psycopg2.pool
+import psycopg2.extras
 import logging
 import numpy as np
 import pandas as pd
 import xarray as xr
 import glob
+import queue
+import hashlib
+import functools
+import argparse
+import multiprocessing
 
 # config
 import stf_conf
+import stf_pgcopy
+import stf_metrics
+import stf_sinks
 
 LOGGER = logging.getLogger(__name__)
 
@@ -27,28 +38,413 @@ DIR = os.path.dirname(os.path.abspath(__file__))
 DATA_DIR = os.path.join(DIR, 'sample_data', 'netcdf')
 FC_TABLE_NAME = 'stf_fc_flow'
 OBS_TABLE_NAME = 'stf_obs_flow'
+MANIFEST_TABLE_NAME = 'stf_ingest_manifest'
+FC_DAILY_TABLE_NAME = 'stf_fc_flow_daily'
+OBS_DAILY_TABLE_NAME = 'stf_obs_flow_daily'
+ENS_TABLE_NAME = 'stf_fc_ens'
+VERSION_TABLE_NAME = 'stf_ingest_version'
+CATALOG_TABLE_NAME = 'stf_station_catalog'
+# observed daily rollups start at the forecast hour (UTC)
+ROLLUP_DAY_START_HOUR = 23
+# percentiles computed over the forecast ensemble (column name -> quantile)
+PCTL_MAP = {
+    'pctl_5': 0.05,
+    'pctl_25': 0.25,
+    'pctl_50': 0.50,
+    'pctl_75': 0.75,
+    'pctl_95': 0.95
+}
+# table columns and their postgres types for binary COPY - order matters
+FC_COLUMNS = [
+    ('fc_datetime', 'timestamptz'),
+    ('lead_time_hours', 'int4'),
+    ('meta_id', 'int4')
+] + [(k, 'float8') for k in PCTL_MAP]
+OBS_COLUMNS = [
+    ('obs_datetime', 'timestamptz'),
+    ('meta_id', 'int4'),
+    ('value', 'float8')
+]
+
+# station metadata cache: {catchment: (load_time, {outlet_node: pk_meta})}
+# This lives for as long as the process does.
+META_CACHE_TTL = 3600  # seconds
+_META_CACHE = {}
+_META_CACHE_LOCK = threading.Lock()
+
+# incremental observed flow ingest: only rows outside the obs_datetime range
+# already stored for a station are sent, if the range has no gaps, see
+# `obs_frame`.
+# cache: {meta_id: (load_time, (first, last, complete) or None)}
+OBS_INCREMENTAL = True
+OBS_TIME_STEP = np.timedelta64(1, 'h')
+_OBS_RANGE_CACHE = {}
+_OBS_RANGE_CACHE_LOCK = threading.Lock()
+
+# stations decoded at a time when building the ingest frames
+STATION_CHUNK_SIZE = 64
+# streamed forecast ingest: rows are built per chunk of STATION_CHUNK_SIZE
+# stations x LEAD_TIME_CHUNK_SIZE lead times and encoded straight into the
+# COPY stream (see `fc_frames`), so memory is bounded by the chunk sizes
+# rather than the file size. The COPY transaction stays open while the
+# percentiles are computed.
+FC_STREAM = False
+LEAD_TIME_CHUNK_SIZE = 240
+# also store the raw forecast ensemble (compressed) in ENS_TABLE_NAME, see
+# `fc_ens_rows`
+STORE_ENSEMBLE = False
+# per file advisory locks so that concurrent ingests (e.g. the lambda) don't
+# ingest the same (type, catchment, forecast datetime) at once, see
+# `ingest_lock`
+INGEST_LOCK = True
+# destinations for the ingested rows besides the database, e.g.
+# `stf_sinks.ParquetSink`. Sinks get every row of a file (i.e. observed rows
+# regardless of OBS_INCREMENTAL), streamed forecasts aren't supported.
+SINKS = []
+
+# pooled connections, see `get_db_pool`. One per pipeline stage (see
+# `run_pipeline`)
+DB_POOL_MAX_CONN = 3
+_DB_POOL = None
+_DB_POOL_LOCK = threading.Lock()
+# pooled connections idle for longer than this are checked before they are
+# used, as the database may have dropped them in the meantime. See
+# `borrow_connection`
+DB_LIVENESS_IDLE_SECS = 60
+_DB_LAST_USED = {}
+
+# parallel ingest: max number of COPY transactions in flight across all
+# worker processes, so that many workers don't swamp the database
+MAX_CONCURRENT_COPY = 2
+_COPY_SEMAPHORE = None
+
+# pipelined ingest: max files waiting between two stages, which bounds the
+# number of decoded files held in memory
+PIPELINE_QUEUE_SIZE = 1
 
 # --- func ---
 
-def ingest_stf_nc_to_db():
+def ingest_stf_nc_to_db(
+        n_workers=1, max_concurrent_copy=MAX_CONCURRENT_COPY, force=False,
+        pipeline=False):
+    """
+        Ingests every swift netcdf file in DATA_DIR. Files already in the
+        ingest manifest (same name, size and checksum) are skipped unless
+        `force` is set.
+
+        With n_workers > 1 files are ingested by a process pool. Each worker
+        has its own db connection pool and metadata cache, COPYs are limited
+        to `max_concurrent_copy` at a time across workers. Workers are forked
+        (so not on windows).
+
+        With `pipeline` files are ingested in a single process, but loading,
+        building the rows and COPYing overlap across consecutive files (see
+        `run_pipeline`). Files aren't locked against other ingests (see
+        `ingest_lock`) in this mode.
+    """
     start_time = time.time()
 
     LOGGER.info("-- Finding swift netcdf files...")
     fn_map = find_stf_nc()
     LOGGER.info("File count obs_flow={}, fc_flow={}".format(
-        len(fn_map['fc_flow']), len(fn_map['obs_flow'])))
+        len(fn_map['obs_flow']), len(fn_map['fc_flow'])))
 
-    LOGGER.info("-- Ingesting observed flow...")
-    for fn in fn_map['obs_flow']:
-        ingest_obs(fn)
+    tasks = (
+        [('obs_flow', fn) for fn in fn_map['obs_flow']]
+        + [('fc_flow', fn) for fn in fn_map['fc_flow']]
+    )
 
-    LOGGER.info("-- Ingesting forecast flow...")
-    for fn in fn_map['fc_flow']:
-        ingest_fc(fn)
+    if pipeline:
+        LOGGER.info("-- Ingesting with a load/frame/copy pipeline...")
+        # files are decoded up front in the load stage, so that the frame
+        # stage doesn't wait on disk
+        results = run_pipeline(
+            (new_result(t) for t in tasks),
+            ingest_stages(force=force, preload=True))
+        results = [finish_result(r) for r in results]
+    elif n_workers <= 1:
+        LOGGER.info("-- Ingesting observed flow then forecast flow...")
+        results = [ingest_file(t, force=force) for t in tasks]
+    else:
+        LOGGER.info("-- Ingesting with {} workers (max {} concurrent COPY)..."
+            .format(n_workers, max_concurrent_copy))
+        # workers are forked so that they inherit the settings applied by
+        # __main__ (SINKS, FC_STREAM, OBS_INCREMENTAL etc.), spawned workers
+        # would start from the module defaults
+        ctx = multiprocessing.get_context('fork')
+        copy_semaphore = ctx.BoundedSemaphore(max_concurrent_copy)
+        with ctx.Pool(
+                n_workers,
+                initializer=init_worker,
+                initargs=(copy_semaphore,)) as pool:
+            results = list(pool.imap_unordered(
+                functools.partial(ingest_file, force=force), tasks))
 
     delta_t = time.time() - start_time
+    log_ingest_summary(results, delta_t)
     LOGGER.info("Total time taken: {:.2f}s".format(delta_t))
     LOGGER.info("-- Done.")
+    return results
+
+
+def init_worker(copy_semaphore):
+    """
+        Pool initializer. Forked workers must not reuse the parent's
+        connections, so the pool and caches are reset (not closed) here and
+        get recreated lazily within the worker.
+    """
+    global _DB_POOL, _DB_LAST_USED, _META_CACHE, _OBS_RANGE_CACHE
+    global _COPY_SEMAPHORE
+    _DB_POOL = None
+    _DB_LAST_USED = {}
+    _META_CACHE = {}
+    _OBS_RANGE_CACHE = {}
+    _COPY_SEMAPHORE = copy_semaphore
+
+
+def ingest_file(task, force=False):
+    """
+        task: (stf_type, filename)
+
+        Returns a summary dict for the file. Errors are logged and reported in
+        the summary rather than raised, so that one bad file doesn't stop a
+        parallel run. Files being ingested elsewhere are skipped with
+        in_flight set, as unlike files already ingested they may still fail.
+    """
+    result = new_result(task)
+    with ingest_lock(result['stf_type'], result['fn']) as acquired:
+        if not acquired:
+            LOGGER.warning("being ingested elsewhere, skipping: {}".format(
+                result['fn']))
+            result['skipped'] = True
+            result['in_flight'] = True
+            return finish_result(result)
+        for stage in ingest_stages(force=force):
+            result = stage(result)
+    return finish_result(result)
+
+
+def new_result(task):
+    stf_type, fn = task
+    return {
+        'fn': fn, 'stf_type': stf_type, 'n_rows': 0, 'skipped': False,
+        'in_flight': False, 'error': None, 'start_time': time.time(),
+        'spans': []
+    }
+
+
+def finish_result(result):
+    result['seconds'] = time.time() - result.pop('start_time')
+    return result
+
+
+def ingest_stages(force=False, preload=False):
+    """
+        The steps to ingest a file. Each takes and returns the summary dict
+        (see `ingest_file`):
+
+            load  - skip if already in the manifest, otherwise open the file
+                    (and decode it if `preload`)
+            frame - build the rows and encode them for COPY
+            copy  - COPY into the database and mark the manifest complete
+    """
+    return [
+        ingest_stage(functools.partial(load_file, force=force, preload=preload)),
+        ingest_stage(frame_file),
+        ingest_stage(copy_file)
+    ]
+
+
+def ingest_stage(func):
+    """
+        Wraps an ingest step so that files that were skipped or failed in an
+        earlier step pass straight through, and errors are logged and recorded
+        in the summary instead of being raised.
+    """
+    def stage(result):
+        if result['skipped'] or result['error'] is not None:
+            return result
+        try:
+            with stf_metrics.context(
+                    file=os.path.basename(result['fn']),
+                    stf_type=result['stf_type']) as spans:
+                func(result)
+        except Exception as e:
+            LOGGER.exception("failed to ingest {}".format(result['fn']))
+            result['error'] = repr(e)
+            ds = result.pop('ds', None)
+            if ds is not None:
+                ds.close()
+            result.pop('buf', None)
+            result.pop('obs_ranges', None)
+            result.pop('ens_rows', None)
+            result.pop('sink_df', None)
+            try:
+                manifest_finish(result['fn'], 'failed')
+            except Exception:
+                LOGGER.exception("failed to update manifest for {}".format(
+                    result['fn']))
+        result['spans'].extend(spans)
+        return result
+    return stage
+
+
+def load_file(result, force=False, preload=False):
+    fn = result['fn']
+    file_size = os.path.getsize(fn)
+    checksum = file_checksum(fn)
+    if not force and manifest_is_complete(fn, file_size, checksum):
+        LOGGER.info("already ingested, skipping: {}".format(fn))
+        result['skipped'] = True
+        return
+    manifest_start(fn, result['stf_type'], file_size, checksum)
+
+    # decode_times = False for forecasts because "hours since time of
+    # forecast" is not recognizable
+    with stf_metrics.span('decode', n_bytes=file_size):
+        ds = xr.open_dataset(fn, decode_times=result['stf_type'] == 'obs_flow')
+        if preload:
+            ds.load()
+    result['ds'] = ds
+
+
+def frame_file(result):
+    if result['stf_type'] == 'fc_flow' and STORE_ENSEMBLE:
+        fc_dt, catchment = get_filename_info(result['fn'])
+        result['ens_rows'] = fc_ens_rows(result['ds'], fc_dt, catchment)
+    if result['stf_type'] == 'fc_flow' and FC_STREAM:
+        # rows are computed as the copy stage reads them, so the file is left
+        # open until then (closed by `copy_file`, or `ingest_stage` on error)
+        fc_dt, catchment = get_filename_info(result['fn'])
+        LOGGER.info('processing FORECAST flow for: {} @ {} (streamed)'.format(
+            catchment, fc_dt))
+        result['buf'] = stf_pgcopy.encode_frames(
+            fc_frames(result['ds'], fc_dt, catchment), FC_COLUMNS)
+        return
+    ds = result.pop('ds')
+    try:
+        fc_dt, catchment = get_filename_info(result['fn'])
+        if result['stf_type'] == 'fc_flow':
+            LOGGER.info('processing FORECAST flow for: {} @ {}'.format(
+                catchment, fc_dt))
+            df = fc_frame(ds, fc_dt, catchment)
+            columns = FC_COLUMNS
+            sink_df = df
+        else:
+            LOGGER.info('processing OBSERVED flow for: {} @ {}'.format(
+                catchment, fc_dt))
+            df = obs_frame(ds, catchment)
+            columns = OBS_COLUMNS
+            result['obs_ranges'] = obs_ranges(df)
+            sink_df = df
+            if SINKS and OBS_INCREMENTAL:
+                sink_df = obs_frame(ds, catchment, incremental=False)
+        if SINKS:
+            result['sink_df'] = sink_df
+    finally:
+        ds.close()
+    result['buf'] = encode_frame(df, columns)
+
+
+def copy_file(result):
+    result['n_rows'] = copy_to_db(result.pop('buf'), result['stf_type'])
+    # only still open for streamed forecasts
+    ds = result.pop('ds', None)
+    if ds is not None:
+        ds.close()
+    if 'obs_ranges' in result:
+        update_obs_range_cache(result.pop('obs_ranges'))
+    if 'ens_rows' in result:
+        ingest_fc_ens_to_db(result.pop('ens_rows'))
+    if 'sink_df' in result:
+        write_to_sinks(result['stf_type'], result['fn'], result.pop('sink_df'))
+    manifest_finish(result['fn'], 'complete', result['n_rows'])
+
+
+def run_pipeline(items, stages, queue_size=PIPELINE_QUEUE_SIZE):
+    """
+        Passes every item through `stages` (functions taking and returning an
+        item, which must not raise) in order. Each stage runs in its own
+        thread and consecutive stages are connected by queues holding at most
+        `queue_size` items, so e.g. file n+1 is loaded while file n is being
+        framed and file n-1 is being COPYed, with a bounded number of files in
+        flight. Returns the outputs of the last stage in the original order.
+    """
+    done = object()
+    # the last queue is drained by this thread only after all items have
+    # been fed in, so it must not block
+    queues = [queue.Queue(maxsize=queue_size) for _ in stages] + [queue.Queue()]
+
+    def run_stage(stage, q_in, q_out):
+        while True:
+            item = q_in.get()
+            if item is done:
+                q_out.put(done)
+                return
+            q_out.put(stage(item))
+
+    threads = [
+        threading.Thread(
+            target=run_stage, args=(stage, queues[i], queues[i + 1]),
+            name='ingest-stage-{}'.format(i), daemon=True)
+        for i, stage in enumerate(stages)
+    ]
+    for t in threads:
+        t.start()
+
+    for item in items:
+        queues[0].put(item)
+    queues[0].put(done)
+
+    results = []
+    while True:
+        item = queues[-1].get()
+        if item is done:
+            break
+        results.append(item)
+
+    for t in threads:
+        t.join()
+    return results
+
+
+def file_checksum(fn, block_size=1 << 20):
+    md5 = hashlib.md5()
+    with open(fn, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def log_ingest_summary(results, delta_t):
+    """
+        Aggregate throughput and per-file latency for an ingest run.
+    """
+    if not results:
+        LOGGER.info("No files ingested.")
+        return
+    n_rows = sum(r['n_rows'] for r in results)
+    n_failed = sum(r['error'] is not None for r in results)
+    n_skipped = sum(r['skipped'] for r in results)
+    n_in_flight = sum(r['in_flight'] for r in results)
+    latency = np.array([r['seconds'] for r in results])
+    LOGGER.info(
+        "Ingested {} files ({} skipped, {} in flight elsewhere, {} failed), "
+        "{} rows in {:.2f}s ({:.0f} rows/s, {:.2f} files/s)".format(
+            len(results), n_skipped, n_in_flight, n_failed, n_rows, delta_t,
+            n_rows / max(delta_t, 1e-6), len(results) / max(delta_t, 1e-6)))
+    LOGGER.info(
+        "File latency: mean={:.2f}s p50={:.2f}s p95={:.2f}s max={:.2f}s".format(
+            latency.mean(), np.percentile(latency, 50),
+            np.percentile(latency, 95), latency.max()))
+    spans = [s for r in results for s in r['spans']]
+    if spans:
+        LOGGER.info("Time per stage (spans nest, e.g. frame includes "
+            "quantile):\n{}".format(
+                stf_metrics.format_summary(stf_metrics.summarize(spans))))
+    for r in results:
+        if r['error'] is not None:
+            LOGGER.error("FAILED: {} - {}".format(r['fn'], r['error']))
 
 
 def find_stf_nc():
@@ -63,55 +459,77 @@ def find_stf_nc():
 def ingest_fc(fn):
     # decode_times = False because "hours since time of forecast" is not
     # recognizable
-    start_time = time.time()
-
-    with xr.open_dataset(fn, decode_times=False) as ds:
-        # q_fcast_ens - variable name for ensemble forecast flow
-        da_fc = ds['q_fcast_ens']
-
-        # station_id actually refers to the node_id. We will extract the actual
-        # station_id = awrc_id from the metadata later.
-        da_nodes = ds['station_id']
-
+    with stf_metrics.span('decode'):
+        ds = xr.open_dataset(fn, decode_times=False)
+    with ds:
         # forecast_start_time / catchment
         fc_dt, catchment = get_filename_info(fn)
         LOGGER.info('processing FORECAST flow for: {} @ {}'.format(
             catchment, fc_dt))
 
-        for s in da_nodes.station:
-            node_id = da_nodes.sel(station=s).item()
-            LOGGER.debug('processing outlet_node={}...'.format(node_id))
+        if FC_STREAM:
+            LOGGER.debug('streaming to timescaledb...')
+            n_rows = ingest_fc_stream(ds, fc_dt, catchment)
+        else:
+            df_ingest = fc_frame(ds, fc_dt, catchment)
 
-            da_sel = da_fc.sel(station=s)
+            LOGGER.debug('ingesting to timescaledb...')
+            n_rows = ingest_fc_to_db(df_ingest)
+            write_to_sinks('fc_flow', fn, df_ingest)
 
-            # compute quantiles
-            LOGGER.debug('  computing quantiles...')
-            df_ingest = quantiles(da_sel)
+        if STORE_ENSEMBLE:
+            ingest_fc_ens_to_db(fc_ens_rows(ds, fc_dt, catchment))
 
-            # populate forecast hour
-            df_ingest['fc_datetime'] = fc_dt
+    return n_rows
 
-            LOGGER.debug('  getting meta_id from db...')
-            # meta_id is the primary key for the metadata table containing
-            # the appropriate station information (including awrc_id)
-            meta_id = get_station_pk(node_id, catchment)
-            if meta_id is None:
-                continue
-            df_ingest['meta_id'] = meta_id
-            LOGGER.debug('  meta_id={}'.format(meta_id))
 
-            LOGGER.debug('  preparing dataframe...')
-            # drop/rename/order columns to match database
-            df_ingest.drop(columns='time', inplace=True)
-            df_ingest.rename(
-                columns={'lead_time': 'lead_time_hours'}, inplace=True)
+@stf_metrics.timed('frame')
+def fc_frame(ds, fc_dt, catchment):
+    """
+        Builds the stf_fc_flow rows for every station in a forecast dataset
+        (see `fc_frames`).
+    """
+    return pd.concat(list(fc_frames(ds, fc_dt, catchment)), ignore_index=True)
 
-            LOGGER.debug('  ingesting to timescaledb...')
-            ingest_fc_to_db(df_ingest)
 
-    delta_t = time.time() - start_time
-    LOGGER.debug('Time taken - FORECAST flow - {} @ {}: {:.2f}s'.format(
-        catchment, fc_dt, delta_t))
+def fc_frames(ds, fc_dt, catchment):
+    """
+        Returns a generator of stf_fc_flow rows, one frame per chunk of
+        STATION_CHUNK_SIZE stations x LEAD_TIME_CHUNK_SIZE lead times.
+        Percentiles are computed in a single pass per chunk (see `quantiles`),
+        so with a lazily opened dataset only one chunk of the ensemble is
+        decoded at a time.
+
+        The station metadata is looked up straight away rather than when the
+        first chunk is read.
+    """
+    # station_id actually refers to the node_id. We will extract the actual
+    # station_id = awrc_id from the metadata later.
+    node_ids = ds['station_id'].values
+
+    LOGGER.debug('getting meta_ids from db...')
+    meta_ids = station_meta_ids(node_ids, catchment)
+
+    LOGGER.debug('computing quantiles for {} stations...'.format(
+        len(node_ids)))
+    return _fc_frames(ds, fc_dt, meta_ids)
+
+
+def _fc_frames(ds, fc_dt, meta_ids):
+    n_lead_times = ds.sizes['lead_time']
+    for chunk in station_chunks(len(meta_ids)):
+        for lead_chunk in dim_chunks(n_lead_times, LEAD_TIME_CHUNK_SIZE):
+            # q_fcast_ens - variable name for ensemble forecast flow
+            df = quantiles(ds['q_fcast_ens'].isel(
+                station=chunk, lead_time=lead_chunk))
+            df['meta_id'] = meta_ids[chunk][df['station'].values]
+            df = df[df['meta_id'] >= 0]
+
+            # populate forecast hour, drop/rename columns to match database
+            df = df.drop(columns=['station', 'time'])
+            df = df.rename(columns={'lead_time': 'lead_time_hours'})
+            df['fc_datetime'] = fc_dt
+            yield df
 
 
 def ingest_obs(fn):
@@ -119,120 +537,466 @@ def ingest_obs(fn):
         similar to ingest_fc but has different variable mapping and subtleties
         so didn't combine it into one function
     """
-    start_time = time.time()
-
     # obs doesn't have reference to "hours since time of forecast" so we can
     # decode normally
-    with xr.open_dataset(fn) as ds:
-        # q_der - variable name for observed flow
-        da_obs = ds['q_der']
-        da_nodes = ds['station_id']
+    with stf_metrics.span('decode'):
+        ds = xr.open_dataset(fn)
+    with ds:
         fc_dt, catchment = get_filename_info(fn)
         LOGGER.info('processing OBSERVED flow for: {} @ {}'.format(
             catchment, fc_dt))
 
-        for s in da_nodes.station:
-            node_id = da_nodes.sel(station=s).item()
-            LOGGER.debug('processing outlet_node={}...'.format(node_id))
+        df_ingest = obs_frame(ds, catchment)
+
+        LOGGER.debug('ingesting to timescaledb...')
+        n_rows = ingest_obs_to_db(df_ingest)
+        if SINKS:
+            write_to_sinks('obs_flow', fn,
+                obs_frame(ds, catchment, incremental=False)
+                if OBS_INCREMENTAL else df_ingest)
 
-            da_sel = da_obs.sel(station=s)
-            # can convert directly dataframe since no preprocessing actually
-            # required
-            df_ingest = da_sel.to_dataframe().reset_index()
+    return n_rows
 
-            LOGGER.debug('getting meta_id from db...')
-            # meta_id is the primary key for the metadata table containing
-            # the appropriate station information (including awrc_id)
-            meta_id = get_station_pk(node_id, catchment)
-            if meta_id is None:
+
+@stf_metrics.timed('frame')
+def obs_frame(ds, catchment, incremental=None):
+    """
+        Builds the stf_obs_flow rows for every station in an observed flow
+        dataset. No preprocessing is required so the values are just unrolled
+        into long form, STATION_CHUNK_SIZE stations at a time.
+
+        Each file repeats a long observed history, so with OBS_INCREMENTAL
+        only timestamps outside the range already stored for the station are
+        kept. Stations with gaps in the stored range (e.g. files that went in
+        out of order) get every row, so the gaps are filled. Values that
+        changed within the stored range aren't sent as they wouldn't be
+        updated anyway.
+        `incremental` overrides OBS_INCREMENTAL.
+    """
+    if incremental is None:
+        incremental = OBS_INCREMENTAL
+    node_ids = ds['station_id'].values
+    obs_datetime = ds['time'].values.astype('datetime64[ns]')
+
+    LOGGER.debug('getting meta_ids from db...')
+    meta_ids = station_meta_ids(node_ids, catchment)
+
+    if incremental:
+        # NaT where nothing is stored yet, so that every row is kept
+        ranges = get_obs_ranges(meta_ids[meta_ids >= 0])
+        first = np.full(len(meta_ids), np.datetime64('NaT'), 'datetime64[ns]')
+        last = first.copy()
+        for i, meta_id in enumerate(meta_ids):
+            if ranges.get(meta_id) is not None:
+                first[i], last[i] = ranges[meta_id]
+
+    LOGGER.debug('preparing dataframe...')
+    frames = []
+    n_total = 0
+    for chunk in station_chunks(len(node_ids)):
+        # q_der - variable name for observed flow
+        da_obs = ds['q_der'].isel(station=chunk).transpose('station', 'time')
+        keep = np.repeat(meta_ids[chunk] >= 0, len(obs_datetime))
+        if incremental:
+            is_new = ~(
+                (obs_datetime[None, :] >= first[chunk, None])
+                & (obs_datetime[None, :] <= last[chunk, None]))
+            keep &= is_new.ravel()
+        values = da_obs.values.ravel()
+        n_total += len(values)
+        frames.append(pd.DataFrame({
+            'obs_datetime': np.tile(obs_datetime, da_obs.sizes['station'])[keep],
+            'meta_id': np.repeat(meta_ids[chunk], len(obs_datetime))[keep],
+            'value': values[keep]
+        }))
+
+    df = pd.concat(frames, ignore_index=True)
+    LOGGER.debug('{} of {} observed values to send'.format(len(df), n_total))
+    return df
+
+
+def fc_ens_rows(ds, fc_dt, catchment):
+    """
+        Rows for ENS_TABLE_NAME: the (lead_time, ens_member) array of every
+        station with metadata, encoded with `encode_ens`. Decoded a chunk of
+        STATION_CHUNK_SIZE stations at a time.
+    """
+    node_ids = ds['station_id'].values
+    meta_ids = station_meta_ids(node_ids, catchment)
+    lead_times = [int(x) for x in ds['lead_time'].values]
+    n_members = ds.sizes['ens_member']
+
+    rows = []
+    for chunk in station_chunks(len(node_ids)):
+        # forecast files have a single time
+        ens = ds['q_fcast_ens'].isel(station=chunk, time=0).transpose(
+            'station', 'lead_time', 'ens_member').values
+        for meta_id, values in zip(meta_ids[chunk], ens):
+            if meta_id < 0:
                 continue
-            df_ingest['meta_id'] = meta_id
+            rows.append((int(meta_id), fc_dt, lead_times, n_members,
+                encode_ens(values)))
+    return rows
 
-            LOGGER.debug('preparing dataframe...')
-            # rename appropriate columns
-            df_ingest.rename(columns={
-                'time': 'obs_datetime', 'q_der': 'value' }, inplace=True)
 
-            LOGGER.debug('ingesting to timescaledb...')
-            ingest_obs_to_db(df_ingest)
+def encode_ens(values):
+    """
+        float32 (little endian) -> byte shuffled -> zlib. Grouping the bytes
+        by significance (exponents together etc.) compresses a lot better
+        than the plain floats. The api has the matching `decode_ens`.
+    """
+    raw = np.ascontiguousarray(values, dtype='<f4').view(np.uint8)
+    return zlib.compress(raw.reshape(-1, 4).T.tobytes())
 
-    delta_t = time.time() - start_time
-    LOGGER.debug('Time taken - OBSERVED flow - {} @ {}: {:.2f}s'.format(
-        catchment, fc_dt, delta_t))
+
+def station_chunks(n_stations):
+    """ Slices along the station dimension, see `dim_chunks` """
+    return dim_chunks(n_stations, STATION_CHUNK_SIZE)
+
+
+def dim_chunks(n, chunk_size):
+    """
+        Slices of at most chunk_size along a dimension of length n. Always
+        yields at least one (possibly empty) slice so that the resulting
+        frames have their columns.
+    """
+    for start in range(0, max(n, 1), chunk_size):
+        yield slice(start, start + chunk_size)
+
+
+@stf_metrics.timed('metadata')
+def station_meta_ids(node_ids, catchment):
+    """
+        meta_id is the primary key for the metadata table containing the
+        appropriate station information (including awrc_id). Returns the
+        meta_id for each node_id, -1 marks stations without metadata.
+    """
+    meta_ids = np.full(len(node_ids), -1, dtype=np.int64)
+    for i, node_id in enumerate(node_ids):
+        meta_id = get_station_pk(node_id, catchment)
+        if meta_id is not None:
+            meta_ids[i] = meta_id
+    return meta_ids
 
 
-# TODO: Maybe combine this with COPY e.g. do INSERT instead so it's all in one
-# connection/transaction
 def get_station_pk(node_id, catchment):
-    with psycopg2.connect(stf_conf.CONNECTION) as con:
-        with con.cursor() as cur:
-            query = """
-                SELECT pk_meta FROM stf_metadata
-                WHERE outlet_node = {} AND catchment = '{}'
-            """.format(node_id, catchment)
-            cur.execute(query)
-            station_pk = cur.fetchall()
-    if len(station_pk) == 1:
-        station_pk = station_pk[0][0]
-    elif len(station_pk) == 0:
+    station_pks = get_station_pks(catchment)
+    if node_id not in station_pks:
         LOGGER.warning("metadata not found for catchment:node={}:{}".format(
             catchment, node_id))
         return None
+    # None if there were multiple ids (already logged when loading)
+    return station_pks[node_id]
+
+
+def get_station_pks(catchment, refresh=False):
+    """
+        Returns {outlet_node: pk_meta} for every station in the catchment.
+
+        The mapping is loaded with a single query and kept in a process level
+        cache for META_CACHE_TTL seconds, so subsequent files for the same
+        catchment don't hit the database. Safe to call from multiple threads.
+    """
+    cached = _META_CACHE.get(catchment)
+    if (not refresh and cached is not None
+            and time.time() - cached[0] < META_CACHE_TTL):
+        return cached[1]
+
+    # only one thread loads a catchment, the others wait and use its result
+    with _META_CACHE_LOCK:
+        cached = _META_CACHE.get(catchment)
+        if (not refresh and cached is not None
+                and time.time() - cached[0] < META_CACHE_TTL):
+            return cached[1]
+        return _load_station_pks(catchment)
+
+
+def _load_station_pks(catchment):
+    LOGGER.debug('loading metadata for catchment={}...'.format(catchment))
+    with db_connection() as con:
+        with con.cursor() as cur:
+            cur.execute(
+                """
+                    SELECT outlet_node, pk_meta FROM stf_metadata
+                    WHERE catchment = %s
+                """, (catchment,))
+            rows = cur.fetchall()
+
+    station_pks = {}
+    for node_id, pk_meta in rows:
+        if node_id in station_pks:
+            LOGGER.error(
+                "multiple ids found for catchment:node={}:{}. ids={}".format(
+                    catchment, node_id, [station_pks[node_id], pk_meta]))
+            pk_meta = None
+        station_pks[node_id] = pk_meta
+
+    _META_CACHE[catchment] = (time.time(), station_pks)
+    return station_pks
+
+
+def invalidate_meta_cache(catchment=None):
+    """
+        Drops the cached metadata for `catchment` (or all catchments), e.g.
+        after stf_metadata has been updated.
+    """
+    if catchment is None:
+        _META_CACHE.clear()
     else:
-        LOGGER.error("multiple ids found for catchment:node={}:{}. ids={}".format(
-            catchment, node_id, station_pk))
-        return None
-    return station_pk
+        _META_CACHE.pop(catchment, None)
 
 
+def get_obs_ranges(meta_ids):
+    """
+        Returns {meta_id: (first, last) obs_datetime stored or None} as naive
+        UTC datetime64. None if nothing is stored, or if the stored rows don't
+        cover every OBS_TIME_STEP from first to last, as only a complete range
+        can be skipped. Looked up with one scan per station and cached for
+        META_CACHE_TTL seconds, the cache is extended as rows are ingested
+        (see `update_obs_range_cache`).
+    """
+    now = time.time()
+    with _OBS_RANGE_CACHE_LOCK:
+        missing = [int(m) for m in meta_ids
+            if m not in _OBS_RANGE_CACHE
+                or now - _OBS_RANGE_CACHE[m][0] >= META_CACHE_TTL]
+
+    if missing:
+        LOGGER.debug('loading obs ranges for {} stations...'.format(
+            len(missing)))
+        with db_connection() as con:
+            with con.cursor() as cur:
+                cur.execute(
+                    """
+                        SELECT m.meta_id, r.first, r.last, r.n
+                        FROM unnest(%s::int[]) AS m(meta_id)
+                        CROSS JOIN LATERAL (
+                            SELECT min(obs_datetime) AS first,
+                                max(obs_datetime) AS last, count(*) AS n
+                            FROM {}
+                            WHERE meta_id = m.meta_id
+                        ) r
+                    """.format(OBS_TABLE_NAME), (missing,))
+                rows = cur.fetchall()
+        with _OBS_RANGE_CACHE_LOCK:
+            for meta_id, first, last, n in rows:
+                if first is None:
+                    _OBS_RANGE_CACHE[meta_id] = (now, None)
+                    continue
+                first, last = _to_datetime64(first), _to_datetime64(last)
+                _OBS_RANGE_CACHE[meta_id] = (
+                    now, (first, last, n == obs_steps(first, last)))
+
+    with _OBS_RANGE_CACHE_LOCK:
+        ranges = {m: _OBS_RANGE_CACHE[m][1] for m in meta_ids}
+    return {m: r[:2] if r is not None and r[2] else None
+        for m, r in ranges.items()}
+
+
+def obs_steps(first, last):
+    """ Number of OBS_TIME_STEP timestamps from first to last (inclusive) """
+    return int((last - first) // OBS_TIME_STEP) + 1
+
+
+def obs_ranges(df):
+    """ (first, last, number of rows) per meta_id in an obs frame """
+    g = df.groupby('meta_id')['obs_datetime']
+    return {
+        meta_id: (first.to_datetime64(), last.to_datetime64(), int(n))
+        for meta_id, first, last, n in zip(
+            g.min().index, g.min(), g.max(), g.size())
+    }
+
+
+def update_obs_range_cache(ranges):
+    """
+        Extends the cached ranges with rows that have just been committed.
+        Stations that aren't cached are left to be looked up, as are stations
+        where the new rows don't overlap or touch the cached range (merging
+        them would hide the gap in between).
+    """
+    with _OBS_RANGE_CACHE_LOCK:
+        for meta_id, (first, last, n) in ranges.items():
+            cached = _OBS_RANGE_CACHE.get(meta_id)
+            if cached is None:
+                continue
+            load_time, stored = cached
+            if stored is None:
+                complete = n == obs_steps(first, last)
+            elif (first > stored[1] + OBS_TIME_STEP
+                    or last < stored[0] - OBS_TIME_STEP):
+                del _OBS_RANGE_CACHE[meta_id]
+                continue
+            else:
+                # still complete if the new rows are every step of the
+                # merged range outside the stored one, i.e. an incremental
+                # frame of a complete file. A full frame also counts rows
+                # inside the stored range, so it's treated as having gaps
+                # until the next lookup
+                stored_first, stored_last, complete = stored
+                first = min(first, stored_first)
+                last = max(last, stored_last)
+                complete = complete and n == (obs_steps(first, last)
+                    - obs_steps(stored_first, stored_last))
+            _OBS_RANGE_CACHE[meta_id] = (load_time, (first, last, complete))
+
+
+def invalidate_obs_range_cache():
+    """ e.g. after rows have been deleted from stf_obs_flow """
+    with _OBS_RANGE_CACHE_LOCK:
+        _OBS_RANGE_CACHE.clear()
+
+
+def _to_datetime64(dt):
+    return pd.Timestamp(dt).tz_convert(None).to_datetime64()
+
+
+@stf_metrics.timed('quantile')
 def quantiles(da):
     """
-        Hack: I couldn't find a nice way of setting the output names of the
-        columns after doing the quantile aggregations.
-        - in sql you can use e.g. `percentile_cont(0.25) AS pctl_25`
+        Computes every percentile in `PCTL_MAP` over the ensemble members for
+        all stations and lead times with a single `np.quantile` call, instead
+        of a pandas groupby per station.
 
         This is effectively:
         ```sql
         SELECT (
+           station,
            lead_time,
+           time,
            percentile_cont(0.05) WITHIN GROUP (ORDER BY value) AS pctl_5,
-           percentile_cont(0.50) WITHIN GROUP (ORDER BY value) AS pctl_25,
-           percentile_cont(0.25) WITHIN GROUP (ORDER BY value) AS pctl_50,
+           percentile_cont(0.25) WITHIN GROUP (ORDER BY value) AS pctl_25,
+           percentile_cont(0.50) WITHIN GROUP (ORDER BY value) AS pctl_50,
            percentile_cont(0.75) WITHIN GROUP (ORDER BY value) AS pctl_75,
            percentile_cont(0.95) WITHIN GROUP (ORDER BY value) AS pctl_95
         ) FROM df
-        GROUP_BY lead_time
+        GROUP_BY station, lead_time, time
         ```
+
+        Returns a long-form dataframe with one row per station/lead_time/time.
+        `station` is the positional index along the station dimension.
     """
+    # put ens_member last so that the reduction is over the innermost axis
+    da = da.transpose('station', 'lead_time', 'time', 'ens_member')
 
-    q_dict = {
-        'pctl_5': 0.05,
-        'pctl_25': 0.25,
-        'pctl_50': 0.50,
-        'pctl_75': 0.75,
-        'pctl_95': 0.95
+    # shape: (pctl, station, lead_time, time)
+    q = np.quantile(da.values, list(PCTL_MAP.values()), axis=-1)
+
+    station, lead_time, fc_time = np.meshgrid(
+        np.arange(da.sizes['station']),
+        da['lead_time'].values,
+        da['time'].values,
+        indexing='ij'
+    )
+    columns = {
+        'station': station.ravel(),
+        'lead_time': lead_time.ravel(),
+        'time': fc_time.ravel()
     }
-    qtl_funcs = []
-
-    # create set of precentile agg functions
-    for k in q_dict:
-        f = functools.partial(np.quantile, q=q_dict[k])
-        f.__name__ = k
-        qtl_funcs.append(f)
-
-    # perform agg over created functions
-    # - drops ens_member as it is not required
-    df = (da.to_dataframe()
-            .reset_index()
-            .drop(columns="ens_member")
-            .groupby(["lead_time", "time"])
-            .agg(qtl_funcs))
-
-    # cleanup indices
-    df.columns = df.columns.droplevel()
-    df.reset_index(inplace=True)
+    for k, v in zip(PCTL_MAP, q):
+        columns[k] = v.ravel()
 
-    return df
+    return pd.DataFrame(columns)
+
+
+def manifest_is_complete(filename, file_size, checksum):
+    """
+        True if the file has already been ingested successfully with the same
+        size and checksum.
+    """
+    return manifest_status(filename, file_size, checksum) == 'complete'
+
+
+def manifest_status(filename, file_size, checksum):
+    """
+        Status of the manifest entry for the file if it has the same size and
+        checksum, otherwise None.
+    """
+    with db_connection() as con:
+        with con.cursor() as cur:
+            cur.execute(
+                """
+                    SELECT status FROM {}
+                    WHERE filename = %s AND file_size = %s AND checksum = %s
+                """.format(MANIFEST_TABLE_NAME),
+                (os.path.basename(filename), file_size, checksum))
+            row = cur.fetchone()
+            return row[0] if row is not None else None
+
+
+@contextlib.contextmanager
+def ingest_lock(stf_type, fn):
+    """
+        Session level advisory lock on the (stf_type, catchment, fc_datetime)
+        of a file, held on a pooled connection while the file is ingested.
+        Yields whether it was acquired, without waiting if another ingest
+        has it. Postgres releases it if the holder's connection dies.
+    """
+    if not INGEST_LOCK:
+        yield True
+        return
+
+    fc_dt, catchment = get_filename_info(fn)
+    key = advisory_lock_key(stf_type, catchment, fc_dt)
+    pool = get_db_pool()
+    con = borrow_connection(pool)
+    try:
+        # the lock outlives the transaction, so nothing is left open
+        with con.cursor() as cur:
+            cur.execute("SELECT pg_try_advisory_lock(%s)", (key,))
+            acquired = cur.fetchone()[0]
+        con.commit()
+        try:
+            yield acquired
+        finally:
+            if acquired and not con.closed:
+                with con.cursor() as cur:
+                    cur.execute("SELECT pg_advisory_unlock(%s)", (key,))
+                con.commit()
+    finally:
+        release_connection(pool, con)
+
+
+def advisory_lock_key(stf_type, catchment, fc_dt):
+    """ Signed 64 bit advisory lock key for a file """
+    name = '{}:{}:{:%Y%m%d%H%M}'.format(stf_type, catchment, fc_dt)
+    digest = hashlib.blake2b(name.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'big', signed=True)
+
+
+def manifest_start(filename, stf_type, file_size, checksum):
+    with db_connection() as con:
+        with con.cursor() as cur:
+            cur.execute(
+                """
+                    INSERT INTO {} (
+                        filename, stf_type, file_size, checksum, status
+                    ) VALUES (%s, %s, %s, %s, 'in_progress')
+                    ON CONFLICT (filename) DO UPDATE SET
+                        stf_type = EXCLUDED.stf_type,
+                        file_size = EXCLUDED.file_size,
+                        checksum = EXCLUDED.checksum,
+                        status = EXCLUDED.status,
+                        row_count = NULL,
+                        started_at = now(),
+                        finished_at = NULL;
+                """.format(MANIFEST_TABLE_NAME),
+                (os.path.basename(filename), stf_type, file_size, checksum))
+
+
+def manifest_finish(filename, status, row_count=None):
+    """
+        status: 'complete' or 'failed'
+    """
+    with db_connection() as con:
+        with con.cursor() as cur:
+            cur.execute(
+                """
+                    UPDATE {} SET
+                        status = %s, row_count = %s, finished_at = now()
+                    WHERE filename = %s;
+                """.format(MANIFEST_TABLE_NAME),
+                (status, row_count, os.path.basename(filename)))
 
 
 def get_filename_info(fn):
@@ -252,16 +1016,17 @@ def ingest_obs_to_db(df):
         meta_id      | integer                  | not null |
         value        | double precision         |          |
     """
-    # process dataframe into buffer
-    s_buf = io.StringIO()
+    if df.empty:
+        LOGGER.info('no new observed flow to ingest')
+        return 0
 
-    # order matters
-    df[['obs_datetime', 'meta_id', 'value']].to_csv(
-        s_buf, index=False, na_rep='NULL')
-    s_buf.seek(0)
+    # encode dataframe straight into a binary COPY buffer
+    values_buffer = encode_frame(df, OBS_COLUMNS)
 
     # copy buffer
-    copy_to_db(s_buf, stf_type='obs_flow')
+    n_rows = copy_to_db(values_buffer, stf_type='obs_flow')
+    update_obs_range_cache(obs_ranges(df))
+    return n_rows
 
 
 def ingest_fc_to_db(df):
@@ -275,17 +1040,183 @@ def ingest_fc_to_db(df):
         pctl_75         | double precision         |          |
         pctl_95         | double precision         |          |
     """
-    # process dataframe into buffer
-    s_buf = io.StringIO()
-
-    # order matters
-    df[['fc_datetime', 'lead_time_hours', 'meta_id', 'pctl_5', 'pctl_25',
-        'pctl_50', 'pctl_75', 'pctl_95'
-    ]].to_csv(s_buf, index=False, na_rep='NULL')
-    s_buf.seek(0)
+    # encode dataframe straight into a binary COPY buffer
+    values_buffer = encode_frame(df, FC_COLUMNS)
 
     # copy buffer
-    copy_to_db(s_buf, stf_type='fc_flow')
+    return copy_to_db(values_buffer, stf_type='fc_flow')
+
+
+def encode_frame(df, columns):
+    """ `stf_pgcopy.encode_frame`, timed as the encode stage """
+    with stf_metrics.span('encode', n_rows=len(df)) as s:
+        buf = stf_pgcopy.encode_frame(df, columns)
+        s.n_bytes = buf.getbuffer().nbytes
+    return buf
+
+
+def ingest_fc_ens_to_db(rows):
+    """
+        meta_id         | integer                  | not null |
+        fc_datetime     | timestamp with time zone | not null |
+        lead_time_hours | integer[]                | not null |
+        n_members       | integer                  | not null |
+        ens             | bytea                    | not null |
+    """
+    if not rows:
+        return 0
+    with copy_slot(), \
+            stf_metrics.span('ensemble', n_rows=len(rows),
+                n_bytes=sum(len(r[-1]) for r in rows),
+                table=ENS_TABLE_NAME) as s, \
+            db_connection() as con:
+        with con.cursor() as cur:
+            # one row per station so a plain (single statement) insert is
+            # enough here
+            psycopg2.extras.execute_values(
+                cur,
+                """
+                    INSERT INTO {}
+                    (meta_id, fc_datetime, lead_time_hours, n_members, ens)
+                    VALUES %s
+                    ON CONFLICT (meta_id, fc_datetime) DO NOTHING;
+                """.format(ENS_TABLE_NAME), rows, page_size=len(rows))
+            n_rows = cur.rowcount
+            if n_rows > 0:
+                cur.execute(BUMP_VERSION_SQL, (ENS_TABLE_NAME,))
+    LOGGER.info('inserted {} ensembles ({} new) into {} in {:.2f}s'.format(
+        len(rows), n_rows, ENS_TABLE_NAME, s.ms / 1000))
+    return n_rows
+
+
+def write_to_sinks(stf_type, fn, df):
+    """ Writes the rows ingested from a file to every sink in SINKS """
+    if not SINKS:
+        return
+    fc_dt, catchment = get_filename_info(fn)
+    table = {'fc_flow': FC_TABLE_NAME, 'obs_flow': OBS_TABLE_NAME}[stf_type]
+    for sink in SINKS:
+        with stf_metrics.span('sink', n_rows=len(df),
+                sink=type(sink).__name__):
+            sink.write(table, df, catchment, fc_dt, os.path.basename(fn))
+
+
+def ingest_fc_stream(ds, fc_dt, catchment):
+    """
+        Same as `fc_frame` + `ingest_fc_to_db`, but the rows are computed and
+        encoded chunk by chunk as COPY reads them instead of all up front.
+    """
+    values_stream = stf_pgcopy.encode_frames(
+        fc_frames(ds, fc_dt, catchment), FC_COLUMNS)
+    return copy_to_db(values_stream, stf_type='fc_flow')
+
+
+# Daily rollups (see stf_fc_flow_daily/stf_obs_flow_daily in setup_tables.sql)
+# are recomputed from the hourly table for every station/day in the staging
+# table. Lead day d covers lead_time_hours (d - 1) * 24 + 1 .. d * 24.
+FC_ROLLUP_SQL = """
+    INSERT INTO {fc_daily}
+    SELECT
+        f.meta_id, f.fc_datetime, (f.lead_time_hours - 1) / 24 + 1,
+        sum(f.pctl_5), avg(f.pctl_5),
+        sum(f.pctl_25), avg(f.pctl_25),
+        sum(f.pctl_50), avg(f.pctl_50),
+        sum(f.pctl_75), avg(f.pctl_75),
+        sum(f.pctl_95), avg(f.pctl_95)
+    FROM {fc} f
+    JOIN (
+        SELECT DISTINCT meta_id, fc_datetime FROM {{temp_table}}
+    ) k ON f.meta_id = k.meta_id AND f.fc_datetime = k.fc_datetime
+    GROUP BY 1, 2, 3
+    ON CONFLICT (meta_id, fc_datetime, lead_day) DO UPDATE SET
+        pctl_5_sum = EXCLUDED.pctl_5_sum,
+        pctl_5_avg = EXCLUDED.pctl_5_avg,
+        pctl_25_sum = EXCLUDED.pctl_25_sum,
+        pctl_25_avg = EXCLUDED.pctl_25_avg,
+        pctl_50_sum = EXCLUDED.pctl_50_sum,
+        pctl_50_avg = EXCLUDED.pctl_50_avg,
+        pctl_75_sum = EXCLUDED.pctl_75_sum,
+        pctl_75_avg = EXCLUDED.pctl_75_avg,
+        pctl_95_sum = EXCLUDED.pctl_95_sum,
+        pctl_95_avg = EXCLUDED.pctl_95_avg;
+""".format(fc_daily=FC_DAILY_TABLE_NAME, fc=FC_TABLE_NAME)
+
+OBS_ROLLUP_DAYS_SQL = """
+    SELECT DISTINCT
+        meta_id,
+        date_trunc('day', (obs_datetime - INTERVAL '{h} hours')
+            AT TIME ZONE 'UTC') AT TIME ZONE 'UTC'
+            + INTERVAL '{h} hours' AS day_start
+    FROM {{temp_table}}
+""".format(h=ROLLUP_DAY_START_HOUR)
+
+# Observed files of different forecast dates don't share an ingest lock but
+# can add rows to the same days, and each transaction sums a day from its own
+# snapshot. The (meta_id, day) pairs are locked until commit, in order so
+# that ingests can't deadlock (the lock calls are evaluated after the sort),
+# and the rollup then runs in a new snapshot that sees every other ingest of
+# those days that has committed.
+OBS_ROLLUP_LOCK_SQL = """
+    SELECT pg_advisory_xact_lock(
+        meta_id, (extract(epoch FROM day_start) / 86400)::int)
+    FROM ({days}) d
+    ORDER BY meta_id, day_start;
+""".format(days=OBS_ROLLUP_DAYS_SQL)
+
+OBS_ROLLUP_SQL = """
+    WITH days AS ({days})
+    INSERT INTO {obs_daily}
+    SELECT d.meta_id, d.day_start, sum(o.value), avg(o.value)
+    FROM days d
+    JOIN {obs} o ON o.meta_id = d.meta_id
+        AND o.obs_datetime >= d.day_start
+        AND o.obs_datetime < d.day_start + INTERVAL '1 day'
+    GROUP BY 1, 2
+    ON CONFLICT (meta_id, day_start) DO UPDATE SET
+        value_sum = EXCLUDED.value_sum,
+        value_avg = EXCLUDED.value_avg;
+""".format(days=OBS_ROLLUP_DAYS_SQL, obs_daily=OBS_DAILY_TABLE_NAME,
+    obs=OBS_TABLE_NAME)
+
+
+# the api caches responses until the version of the tables they read is
+# bumped (see stf_ingest_version in setup_tables.sql)
+BUMP_VERSION_SQL = """
+    INSERT INTO {0} (table_name, version) VALUES (%s, 1)
+    ON CONFLICT (table_name) DO UPDATE SET
+        version = {0}.version + 1,
+        updated_at = now();
+""".format(VERSION_TABLE_NAME)
+
+
+# Rows are moved from the staging table into the hourly table, and the
+# station catalog (see stf_station_catalog in setup_tables.sql) is updated
+# from the rows that were new in the same statement. Stations are locked in
+# order so that concurrent ingests can't deadlock on their catalog rows.
+INSERT_NEW_ROWS_SQL = """
+    WITH new_rows AS (
+        INSERT INTO {{table}}
+        SELECT * FROM {{temp_table}}
+        ON CONFLICT ({{conflict_cols}}) DO NOTHING
+        RETURNING meta_id, {{datetime_col}}
+    ), catalog AS (
+        INSERT INTO {catalog} AS c (
+            meta_id, {{prefix}}_min_datetime, {{prefix}}_max_datetime,
+            {{prefix}}_count)
+        SELECT meta_id, min({{datetime_col}}), max({{datetime_col}}), count(*)
+        FROM new_rows
+        GROUP BY meta_id
+        ORDER BY meta_id
+        ON CONFLICT (meta_id) DO UPDATE SET
+            {{prefix}}_min_datetime = LEAST(
+                c.{{prefix}}_min_datetime, EXCLUDED.{{prefix}}_min_datetime),
+            {{prefix}}_max_datetime = GREATEST(
+                c.{{prefix}}_max_datetime, EXCLUDED.{{prefix}}_max_datetime),
+            {{prefix}}_count = c.{{prefix}}_count + EXCLUDED.{{prefix}}_count,
+            updated_at = now()
+    )
+    SELECT count(*) FROM new_rows;
+""".format(catalog=CATALOG_TABLE_NAME)
 
 
 def copy_to_db(values_buffer, stf_type, ignore_duplicates=False):
@@ -293,65 +1224,201 @@ def copy_to_db(values_buffer, stf_type, ignore_duplicates=False):
         'fc_flow': {
             'table': FC_TABLE_NAME,
             'temp_table': FC_TABLE_NAME + '_temp',
-            'conflict_col': ['meta_id', 'lead_time_hours', 'fc_datetime']
+            'conflict_col': ['meta_id', 'lead_time_hours', 'fc_datetime'],
+            'datetime_col': 'fc_datetime',
+            'catalog_prefix': 'fc',
+            # forecast days only come from the file's fc_datetime, which
+            # the ingest lock already serializes
+            'rollup_lock': None,
+            'rollup': FC_ROLLUP_SQL
         },
         'obs_flow': {
             'table': OBS_TABLE_NAME,
             'temp_table': OBS_TABLE_NAME + '_temp',
-            'conflict_col': ['meta_id', 'obs_datetime']
+            'conflict_col': ['meta_id', 'obs_datetime'],
+            'datetime_col': 'obs_datetime',
+            'catalog_prefix': 'obs',
+            'rollup_lock': OBS_ROLLUP_LOCK_SQL,
+            'rollup': OBS_ROLLUP_SQL
         }
     }
     assert stf_type in stf_table_map.keys()
     d = stf_table_map[stf_type]
 
-    # transaction to copy data
-    # TODO: error handling?
-    with psycopg2.connect(stf_conf.CONNECTION) as con:
+    # single transaction to copy data, rolled back on error. The span
+    # includes the commit, but not waiting for a copy slot
+    with copy_slot(), \
+            stf_metrics.span('copy', table=d['table']) as s, \
+            db_connection() as con:
         with con.cursor() as cur:
             if ignore_duplicates:
                 cur.copy_expert(
                     """
-                        COPY {} FROM STDIN
-                        WITH CSV HEADER DELIMITER ',' NULL 'NULL'
+                        COPY {} FROM STDIN WITH (FORMAT binary)
                     """.format(d['table']), values_buffer
                 )
-                con.commit()
+                n_copied = n_rows = cur.rowcount
             else:
-                # create temporary table (and delete on commit)
+                # staging table lives as long as the (pooled) connection, and
+                # is emptied on commit so it can be reused by the next file
                 cur.execute(
                     """
-                        CREATE TEMP TABLE {} (LIKE {}) ON COMMIT DROP;
+                        CREATE TEMP TABLE IF NOT EXISTS {} (LIKE {})
+                        ON COMMIT DELETE ROWS;
                     """.format(d['temp_table'], d['table'])
                 )
                 # copy dataframe into temporary table
                 cur.copy_expert(
                     """
-                        COPY {} FROM STDIN
-                        WITH CSV HEADER DELIMITER ',' NULL 'NULL'
+                        COPY {} FROM STDIN WITH (FORMAT binary)
                     """.format(d['temp_table']), values_buffer)
-                # insert into main table with unique time/meta_id
-                conflict_col_str = ', '.join(d['conflict_col'])
-                cur.execute(
-                    """
-                        INSERT INTO {}
-                        SELECT * FROM {}
-                        ON CONFLICT ({}) DO NOTHING;
-                    """.format(d['table'], d['temp_table'], conflict_col_str)
-                )
-                con.commit()
+                n_copied = cur.rowcount
+                # insert into main table with unique time/meta_id, and
+                # update the station catalog with the new rows
+                cur.execute(INSERT_NEW_ROWS_SQL.format(
+                    table=d['table'],
+                    temp_table=d['temp_table'],
+                    conflict_cols=', '.join(d['conflict_col']),
+                    datetime_col=d['datetime_col'],
+                    prefix=d['catalog_prefix']
+                ))
+                n_rows = cur.fetchone()[0]
+                # recompute the daily rollups touched by this file in the
+                # same transaction, see OBS_ROLLUP_LOCK_SQL for concurrent
+                # ingests. (ignore_duplicates copies straight into the table
+                # so the rollups and the catalog need to be repopulated
+                # afterwards, see setup_tables.sql)
+                if n_rows > 0:
+                    if d['rollup_lock'] is not None:
+                        cur.execute(d['rollup_lock'].format(
+                            temp_table=d['temp_table']))
+                    cur.execute(d['rollup'].format(temp_table=d['temp_table']))
+            # last, as the version row stays locked until commit
+            if n_rows > 0:
+                cur.execute(BUMP_VERSION_SQL, (d['table'],))
+        s.n_rows = n_copied
+        s.n_bytes = values_buffer.tell()
+        s.fields['new_rows'] = n_rows
+
+    delta_t = s.ms / 1000
+    LOGGER.info(
+        'copied {} rows ({} new) into {} in {:.2f}s ({:.0f} rows/s)'.format(
+            n_copied, n_rows, d['table'], delta_t,
+            n_copied / max(delta_t, 1e-6)))
+    return n_rows
+
+
+@contextlib.contextmanager
+def copy_slot():
+    """
+        Waits for a free COPY slot when running as a parallel worker (see
+        `ingest_stf_nc_to_db`), otherwise a no-op.
+    """
+    if _COPY_SEMAPHORE is None:
+        yield
+        return
+    with _COPY_SEMAPHORE:
+        yield
 
 
-# for testing purposes only once duplicate handling is implemented this should
-# not be needed.
+def get_db_pool():
+    """
+        Connection pool for this worker process. Created lazily so that each
+        process (e.g. after a fork) sets up its own connections.
+    """
+    global _DB_POOL
+    if _DB_POOL is None or _DB_POOL.closed:
+        # the pipeline uses the pool from several threads, only one of them
+        # should create it
+        with _DB_POOL_LOCK:
+            if _DB_POOL is None or _DB_POOL.closed:
+                _DB_POOL = psycopg2.pool.ThreadedConnectionPool(
+                    1, DB_POOL_MAX_CONN, stf_conf.CONNECTION)
+    return _DB_POOL
+
+
+@contextlib.contextmanager
+def db_connection():
+    """
+        Borrows a pooled connection for the duration of one transaction.
+        Commits on success and rolls back on error.
+    """
+    pool = get_db_pool()
+    con = borrow_connection(pool)
+    try:
+        yield con
+        con.commit()
+    except Exception:
+        if not con.closed:
+            con.rollback()
+        raise
+    finally:
+        release_connection(pool, con)
+
+
+def borrow_connection(pool):
+    """
+        Gets a connection from the pool, replacing it with a new one if it
+        is no longer alive (see `connection_alive`).
+    """
+    con = pool.getconn()
+    if connection_alive(con):
+        return con
+    LOGGER.info('pooled connection is no longer alive, reconnecting')
+    _DB_LAST_USED.pop(id(con), None)
+    pool.putconn(con, close=True)
+    return pool.getconn()
+
+
+def release_connection(pool, con):
+    # broken connections are discarded rather than returned to the pool
+    if con.closed:
+        _DB_LAST_USED.pop(id(con), None)
+    else:
+        _DB_LAST_USED[id(con)] = time.time()
+    pool.putconn(con, close=bool(con.closed))
+
+
+def connection_alive(con):
+    """
+        `con.closed` is only set once psycopg2 notices the connection is
+        gone, so connections that have been idle for more than
+        DB_LIVENESS_IDLE_SECS are also pinged. Recently used ones aren't, to
+        save a round trip per transaction.
+    """
+    if con.closed:
+        return False
+    last_used = _DB_LAST_USED.get(id(con))
+    if (last_used is not None
+            and time.time() - last_used < DB_LIVENESS_IDLE_SECS):
+        return True
+    try:
+        with con.cursor() as cur:
+            cur.execute('SELECT 1')
+        con.rollback()
+    except psycopg2.Error:
+        return False
+    return True
+
+
+# for testing purposes only, run with --reset. Also clears the manifest, as
+# otherwise the deleted files would be skipped as already ingested.
 def delete_from_tables():
     if not TEST_MODE:
         LOGGER.info("not in test mode. retaining tables.")
         return
     LOGGER.warning("CAUTION: In test mode. deleting tables.")
-    for table_name in [FC_TABLE_NAME, OBS_TABLE_NAME]:
-        with psycopg2.connect(stf_conf.CONNECTION) as con:
+    for table_name in [FC_DAILY_TABLE_NAME, OBS_DAILY_TABLE_NAME,
+            CATALOG_TABLE_NAME, ENS_TABLE_NAME, FC_TABLE_NAME, OBS_TABLE_NAME,
+            MANIFEST_TABLE_NAME]:
+        with db_connection() as con:
             with con.cursor() as cur:
                cur.execute("DELETE FROM {}".format(table_name))
+    with db_connection() as con:
+        with con.cursor() as cur:
+            for table_name in [FC_TABLE_NAME, OBS_TABLE_NAME, ENS_TABLE_NAME]:
+                cur.execute(BUMP_VERSION_SQL, (table_name,))
+    invalidate_obs_range_cache()
 # ---
 
 # --- depreciated ---
@@ -388,9 +1455,62 @@ if __name__ == '__main__':
         format="[%(asctime)s|%(levelname)s|%(module)s.%(funcName)s]: %(message)s"
     )
 
+    parser = argparse.ArgumentParser(
+        description='ingest swift netcdf files from DATA_DIR into timescaledb')
+    parser.add_argument('--workers', type=int, default=1,
+        help='number of worker processes (default: 1, serial)')
+    parser.add_argument('--max-concurrent-copy', type=int,
+        default=MAX_CONCURRENT_COPY,
+        help='max COPY transactions in flight across workers (default: {})'
+            .format(MAX_CONCURRENT_COPY))
+    parser.add_argument('--force', action='store_true',
+        help='re-ingest files even if the manifest has them as complete')
+    parser.add_argument('--reset', action='store_true',
+        help='delete all ingested rows and the manifest before ingesting '
+            '(only in TEST_MODE)')
+    parser.add_argument('--full-obs', action='store_true',
+        help='send the full observed history of every file instead of only '
+            'the timestamps not yet in the database')
+    parser.add_argument('--pipeline', action='store_true',
+        help='overlap loading, building rows and COPY across files in a '
+            'single process (not combined with --workers)')
+    parser.add_argument('--stream', action='store_true',
+        help='compute forecast percentiles in chunks of stations x lead '
+            'times and stream them into COPY, bounding memory use for large '
+            'files (not combined with --pipeline)')
+    parser.add_argument('--store-ensemble', action='store_true',
+        help='also store the raw forecast ensembles (compressed) so that '
+            'other quantiles can be computed later by the api')
+    parser.add_argument('--parquet-dir',
+        help='also write the ingested rows as parquet, partitioned by '
+            'catchment/date, under this directory (requires pyarrow)')
+    parser.add_argument('--metrics-log',
+        help='append the time, rows and bytes of every ingest stage to this '
+            'file as json lines (see stf_metrics)')
+    args = parser.parse_args()
+    if args.pipeline and args.workers > 1:
+        parser.error('--pipeline and --workers are mutually exclusive')
+    if args.pipeline and args.stream:
+        parser.error('--pipeline and --stream are mutually exclusive')
+    if args.stream:
+        FC_STREAM = True
+    if args.store_ensemble:
+        STORE_ENSEMBLE = True
+    if args.parquet_dir:
+        if args.stream:
+            parser.error('--parquet-dir and --stream are mutually exclusive')
+        SINKS.append(stf_sinks.ParquetSink(args.parquet_dir))
+    if args.full_obs:
+        OBS_INCREMENTAL = False
+    if args.metrics_log:
+        stf_metrics.configure(args.metrics_log)
+
     if TEST_MODE:
         LOGGER.setLevel(logging.DEBUG)
+    if args.reset:
         delete_from_tables()
 
-    ingest_stf_nc_to_db()
+    ingest_stf_nc_to_db(
+        n_workers=args.workers, max_concurrent_copy=args.max_concurrent_copy,
+        force=args.force, pipeline=args.pipeline)
 
@@ -0,0 +1,164 @@
+"""
+    Encodes dataframe columns into the PostgreSQL binary COPY format:
+    https://www.postgresql.org/docs/current/sql-copy.html (Binary Format)
+
+    Similar idea to `pgcopy` (see `scripts/python_quickstart/quickstart.py`)
+    but the rows are built with numpy in one go rather than tuple by tuple,
+    and the column types are given up front instead of being introspected
+    from the database.
+
+    NOTE: the lambda has a copy of this file, keep them in sync.
+"""
+import io
+import struct
+import numpy as np
+import pandas as pd
+
+# signature + flags + header extension length
+COPY_HEADER = b'PGCOPY\n\377\r\n\0' + struct.pack('!ii', 0, 0)
+# field count of -1
+COPY_TRAILER = struct.pack('!h', -1)
+
+# microseconds between the unix epoch and the postgres epoch (2000-01-01)
+PG_EPOCH_OFFSET_US = 946684800 * 1000000
+
+# postgres type -> wire format (network byte order)
+PG_TYPES = {
+    'timestamptz': np.dtype('>i8'),
+    'int4': np.dtype('>i4'),
+    'int8': np.dtype('>i8'),
+    'float4': np.dtype('>f4'),
+    'float8': np.dtype('>f8')
+}
+
+
+def encode_frame(df, columns):
+    """
+        Returns a buffer with `df` encoded for `COPY ... WITH (FORMAT binary)`
+
+        columns: list of (column name, postgres type), in table order.
+        NaN/NaT values are written as NULL. Naive datetimes are taken as UTC.
+    """
+    return encode_columns([(df[c].to_numpy(), t) for c, t in columns])
+
+
+def encode_columns(columns):
+    """
+        columns: list of (values, postgres type), values being array-like of
+        equal length.
+    """
+    buf = io.BytesIO()
+    buf.write(COPY_HEADER)
+    buf.write(encode_rows(columns))
+    buf.write(COPY_TRAILER)
+    buf.seek(0)
+    return buf
+
+
+def encode_frames(frames, columns):
+    """
+        Like `encode_frame` for an iterable of dataframes, but returns a
+        file-like `CopyStream` that encodes each frame only as it is read. So
+        the frames can come from a generator and only one is held at a time.
+    """
+    def chunks():
+        yield COPY_HEADER
+        for df in frames:
+            yield encode_rows([(df[c].to_numpy(), t) for c, t in columns])
+        yield COPY_TRAILER
+    return CopyStream(chunks())
+
+
+class CopyStream():
+    """
+        Read-only file-like object over an iterable of bytes, e.g. for
+        `cursor.copy_expert` which pulls the data with `read(size)`.
+    """
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._chunk = memoryview(b'')
+        self._pos = 0
+        self._n_read = 0
+
+    def tell(self):
+        """ Number of bytes read so far """
+        return self._n_read
+
+    def read(self, size=-1):
+        parts = []
+        n = 0
+        while size < 0 or n < size:
+            if self._pos >= len(self._chunk):
+                try:
+                    self._chunk = memoryview(next(self._chunks))
+                except StopIteration:
+                    break
+                self._pos = 0
+                continue
+            end = len(self._chunk) if size < 0 else min(
+                len(self._chunk), self._pos + size - n)
+            parts.append(self._chunk[self._pos:end])
+            n += end - self._pos
+            self._pos = end
+        self._n_read += n
+        return b''.join(parts)
+
+
+def encode_rows(columns):
+    """
+        Encodes the rows only, without the COPY header/trailer. Takes the same
+        columns as `encode_columns`.
+
+        Every row is laid out as a fixed size record:
+
+            n_fields (int16) | len (int32) | value | len (int32) | value ...
+
+        which is built as a numpy structured array. For NULLs the length is
+        set to -1 and the value bytes are masked out when flattening.
+    """
+    n_rows = len(columns[0][0]) if columns else 0
+    fields = [('n_fields', '>i2')]
+    encoded = []
+    for i, (values, pg_type) in enumerate(columns):
+        values, nulls = _to_wire(values, pg_type)
+        fields += [('len_{}'.format(i), '>i4'), ('val_{}'.format(i), values.dtype)]
+        encoded.append((values, nulls))
+
+    rows = np.zeros(n_rows, dtype=np.dtype(fields))
+    rows['n_fields'] = len(columns)
+    for i, (values, nulls) in enumerate(encoded):
+        rows['len_{}'.format(i)] = np.where(nulls, -1, values.dtype.itemsize)
+        rows['val_{}'.format(i)] = values
+
+    raw = rows.view(np.uint8).reshape(n_rows, rows.dtype.itemsize)
+    if any(nulls.any() for _, nulls in encoded):
+        keep = np.ones(raw.shape, dtype=bool)
+        for i, (values, nulls) in enumerate(encoded):
+            offset = rows.dtype.fields['val_{}'.format(i)][1]
+            keep[nulls, offset:offset + values.dtype.itemsize] = False
+        # boolean indexing flattens in row order, dropping the null values
+        body = raw[keep]
+    else:
+        body = raw.ravel()
+
+    return body.tobytes()
+
+
+def _to_wire(values, pg_type):
+    """
+        Converts values into the big endian representation used on the wire.
+        Returns (values, null mask).
+    """
+    dtype = PG_TYPES[pg_type]
+    if pg_type == 'timestamptz':
+        dt = pd.DatetimeIndex(pd.to_datetime(values, utc=True)).tz_convert(None)
+        dt = np.asarray(dt, dtype='datetime64[us]')
+        nulls = np.isnat(dt)
+        values = np.where(nulls, 0, dt.astype(np.int64) - PG_EPOCH_OFFSET_US)
+    elif dtype.kind == 'f':
+        values = np.asarray(values, dtype=np.float64)
+        nulls = np.isnan(values)
+    else:
+        values = np.asarray(values)
+        nulls = np.zeros(len(values), dtype=bool)
+    return values.astype(dtype), nulls
@@ -0,0 +1,66 @@
+"""
+    Destinations for the frames built by the ingest besides the database, so
+    that they can be used for offline analysis or bulk reloads without
+    re-reading the netcdf files or querying the database. Configured through
+    `ingest_stf_flow.SINKS`, every sink has:
+
+        write(table, df, catchment, fc_dt, source)
+
+    table     - table the rows belong to (stf_fc_flow/stf_obs_flow)
+    df        - the rows, with the table's columns
+    catchment - catchment of the netcdf file
+    fc_dt     - forecast datetime of the netcdf file
+    source    - netcdf file name
+"""
+import os
+
+
+class ParquetSink():
+    """
+        Writes the rows of each netcdf file to their own parquet file, hive
+        partitioned by catchment and forecast date:
+
+            <root>/<table>/catchment=<catchment>/date=<YYYY-mm-dd>/<source>.parquet
+
+        Re-ingesting a file overwrites its parquet file. The partitions can be
+        read back as a dataset, e.g.
+
+            pd.read_parquet(
+                '<root>/stf_fc_flow', filters=[('catchment', '=', 'kiewa')])
+
+        NOTE: every observed file repeats a long history, so stf_obs_flow rows
+        overlap between files (drop duplicates on meta_id, obs_datetime).
+    """
+    def __init__(self, root, compression='snappy'):
+        # optional dependency, only needed when writing parquet
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            raise ImportError('ParquetSink requires pyarrow')
+        self.root = root
+        self.compression = compression
+
+    def path(self, table, catchment, fc_dt, source):
+        return os.path.join(
+            self.root, table,
+            'catchment={}'.format(catchment),
+            'date={:%Y-%m-%d}'.format(fc_dt),
+            os.path.splitext(os.path.basename(source))[0] + '.parquet')
+
+    def write(self, table, df, catchment, fc_dt, source):
+        path = self.path(table, catchment, fc_dt, source)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write then rename. Dataset reads skip files starting with '.', so
+        # the temporary file isn't read while it's being written, or after a
+        # crash left it behind (it's overwritten by the next write)
+        tmp_path = os.path.join(
+            os.path.dirname(path), '.' + os.path.basename(path) + '.tmp')
+        try:
+            df.to_parquet(tmp_path, engine='pyarrow', index=False,
+                compression=self.compression)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return path
@@ -3,6 +3,9 @@
     flask + sqlalchemy + geoalchemy
 """
 # coding: utf-8
+import zlib
+import numpy as np
+
 from .base import db
 # from sqlalchemy import (
 #     BigInteger, Column, DateTime, Float, ForeignKey, Index,
@@ -112,3 +115,89 @@ class StfObsFlow(db.Model):
         ]
     }
 
+
+
+# daily rollups maintained by the ingest (see setup_tables.sql)
+PCTL_COLUMNS = ['pctl_5', 'pctl_25', 'pctl_50', 'pctl_75', 'pctl_95']
+
+class StfFcFlowDaily(db.Model):
+    __tablename__ = 'stf_fc_flow_daily'
+
+    meta_id = db.Column(db.ForeignKey('stf_metadata.pk_meta'), primary_key=True)
+    fc_datetime = db.Column(db.DateTime(True), primary_key=True)
+    # lead day d covers lead_time_hours (d - 1) * 24 + 1 .. d * 24
+    lead_day = db.Column(db.Integer, primary_key=True)
+    pctl_5_sum = db.Column(db.Float(53))
+    pctl_5_avg = db.Column(db.Float(53))
+    pctl_25_sum = db.Column(db.Float(53))
+    pctl_25_avg = db.Column(db.Float(53))
+    pctl_50_sum = db.Column(db.Float(53))
+    pctl_50_avg = db.Column(db.Float(53))
+    pctl_75_sum = db.Column(db.Float(53))
+    pctl_75_avg = db.Column(db.Float(53))
+    pctl_95_sum = db.Column(db.Float(53))
+    pctl_95_avg = db.Column(db.Float(53))
+
+
+class StfObsFlowDaily(db.Model):
+    __tablename__ = 'stf_obs_flow_daily'
+
+    # days start at 23:00 UTC i.e. [day_start, day_start + 1 day)
+    DAY_START_HOUR = 23
+
+    meta_id = db.Column(db.ForeignKey('stf_metadata.pk_meta'), primary_key=True)
+    day_start = db.Column(db.DateTime(True), primary_key=True)
+    value_sum = db.Column(db.Float(53))
+    value_avg = db.Column(db.Float(53))
+
+
+class StfFcEns(db.Model):
+    """
+        Raw forecast ensembles, optionally stored by the ingest. `ens` is the
+        compressed (lead time, ensemble member) array, see `decode_ens`.
+    """
+    __tablename__ = 'stf_fc_ens'
+
+    meta_id = db.Column(db.ForeignKey('stf_metadata.pk_meta'), primary_key=True)
+    fc_datetime = db.Column(db.DateTime(True), primary_key=True)
+    lead_time_hours = db.Column(db.ARRAY(db.Integer), nullable=False)
+    n_members = db.Column(db.Integer, nullable=False)
+    ens = db.Column(db.LargeBinary, nullable=False)
+
+    def decode_ens(self):
+        """
+            Returns the float32 array of shape (lead time, ensemble member).
+            Reverses the ingest's `encode_ens`: zlib -> byte unshuffle.
+        """
+        raw = np.frombuffer(zlib.decompress(self.ens), dtype=np.uint8)
+        raw = np.ascontiguousarray(raw.reshape(4, -1).T)
+        return raw.view('<f4').reshape(len(self.lead_time_hours), self.n_members)
+
+
+class StfIngestVersion(db.Model):
+    """
+        Bumped by the ingest whenever it changes a table, see
+        `stf_api.services.cache`.
+    """
+    __tablename__ = 'stf_ingest_version'
+
+    table_name = db.Column(db.String(63), primary_key=True)
+    version = db.Column(db.BigInteger, nullable=False)
+    updated_at = db.Column(db.DateTime(True), nullable=False)
+
+
+class StfStationCatalog(db.Model):
+    """
+        Per station date ranges and row counts of the hourly tables,
+        maintained by the ingest. Datetimes are NULL if there are no rows.
+    """
+    __tablename__ = 'stf_station_catalog'
+
+    meta_id = db.Column(db.ForeignKey('stf_metadata.pk_meta'), primary_key=True)
+    fc_min_datetime = db.Column(db.DateTime(True))
+    fc_max_datetime = db.Column(db.DateTime(True))
+    fc_count = db.Column(db.BigInteger, nullable=False)
+    obs_min_datetime = db.Column(db.DateTime(True))
+    obs_max_datetime = db.Column(db.DateTime(True))
+    obs_count = db.Column(db.BigInteger, nullable=False)
+    updated_at = db.Column(db.DateTime(True), nullable=False)
@@ -0,0 +1,95 @@
+"""
+    Encodings for tabular responses (keys + rows), picked with `?format=` or
+    otherwise the Accept header:
+
+        json        application/json (default)
+                    {"keys": [...], "entries": [[row], ...]}
+        columnar    application/vnd.stf.columnar+json
+                    {"keys": [...], "columns": [[column], ...],
+                     "epoch_ms": [keys of the datetime columns]}
+        arrow       application/vnd.apache.arrow.stream
+                    Arrow IPC stream of one record batch (requires pyarrow)
+
+    In the columnar and arrow encodings datetimes are milliseconds since the
+    epoch (timestamp[ms, UTC] for arrow), so clients don't have to parse
+    datetime strings, which costs more than the query for hourly series.
+"""
+import datetime
+from flask import abort, json
+from pytz import timezone
+
+# optional dependency, arrow responses are only offered with it
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+JSON_MIMETYPE = 'application/json'
+COLUMNAR_MIMETYPE = 'application/vnd.stf.columnar+json'
+ARROW_MIMETYPE = 'application/vnd.apache.arrow.stream'
+
+# in order of preference when the Accept header doesn't prefer one, json
+# first so that clients that don't ask get what they always have
+FORMATS = {
+    'json': JSON_MIMETYPE,
+    'columnar': COLUMNAR_MIMETYPE
+}
+if pa is not None:
+    FORMATS['arrow'] = ARROW_MIMETYPE
+
+
+def negotiate_format(request):
+    """ Response format for the request, one of FORMATS """
+    fmt = request.args.get('format')
+    if fmt is not None:
+        if fmt not in FORMATS:
+            abort(400, 'format must be one of: {}'.format(', '.join(FORMATS)))
+        return fmt
+    mimetype = request.accept_mimetypes.best_match(
+        list(FORMATS.values()), default=JSON_MIMETYPE)
+    return {v: k for k, v in FORMATS.items()}[mimetype]
+
+
+def encode_rows(keys, rows, fmt):
+    """ Returns the encoded body for `fmt` (see `negotiate_format`) """
+    if fmt == 'json':
+        return json_dumps({'keys': keys, 'entries': rows})
+
+    columns = [list(c) for c in zip(*rows)] if rows else [[] for _ in keys]
+    epoch_ms = []
+    for k, c in zip(keys, columns):
+        first = next((v for v in c if v is not None), None)
+        if isinstance(first, datetime.datetime):
+            c[:] = [to_epoch_ms(v) for v in c]
+            epoch_ms.append(k)
+
+    if fmt == 'columnar':
+        return json_dumps(
+            {'keys': keys, 'columns': columns, 'epoch_ms': epoch_ms})
+
+    arrays = [
+        pa.array(c, type=pa.timestamp('ms', tz='UTC')) if k in epoch_ms
+        else pa.array(c)
+        for k, c in zip(keys, columns)
+    ]
+    table = pa.Table.from_arrays(arrays, names=keys)
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+def to_epoch_ms(dt):
+    if dt is None:
+        return None
+    # naive datetimes are taken as UTC
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone('utc'))
+    return int(round(dt.timestamp() * 1000))
+
+
+def json_dumps(obj):
+    try:
+        return json.dumps(obj, namedtuple_as_object=False)
+    except Exception as e:
+        return json.dumps(obj)
@@ -1,16 +1,23 @@
+import datetime
 import dateutil.parser
+import numpy as np
 from flask import Blueprint
-from flask import jsonify, make_response, request, json
+from flask import abort, jsonify, make_response, request, json
 from pytz import timezone
-from sqlalchemy import func, and_, distinct
-from sqlalchemy.dialects.postgresql import INTERVAL
-from sqlalchemy import DateTime
+from sqlalchemy import func, and_, any_, bindparam
+from sqlalchemy.dialects.postgresql import INTERVAL, ARRAY
+from sqlalchemy import DateTime, String, Integer
 from sqlalchemy.sql.functions import concat
 
 from stf_api.models.test_models import (
-    StfObsFlow, StfFcFlow, StfMetadatum, StfGeomSubarea, StfGeomSubcatch
+    StfObsFlow, StfFcFlow, StfMetadatum, StfGeomSubarea, StfGeomSubcatch,
+    StfFcFlowDaily, StfObsFlowDaily, StfFcEns, StfStationCatalog, PCTL_COLUMNS
 )
 from stf_api.models.base import db
+from stf_api.services import response_cache
+from stf_api.routes.encoding import (
+    FORMATS, negotiate_format, encode_rows, json_dumps
+)
 
 
 stf_bp = Blueprint('stf_api', __name__, url_prefix='/stf_api')
@@ -18,6 +25,15 @@ agg_map = {
     'sum': func.sum,
     'avg': func.avg
 }
+# tables each endpoint reads, responses are cached until the ingest updates
+# one of them (the daily rollups are updated along with their table)
+FC_TABLES = ['stf_fc_flow', 'stf_metadata']
+OBS_TABLES = ['stf_obs_flow', 'stf_metadata']
+META_TABLES = ['stf_metadata']
+ENS_TABLES = ['stf_fc_ens', 'stf_metadata']
+CATALOG_TABLES = ['stf_fc_flow', 'stf_obs_flow', 'stf_metadata']
+# most stations a batch endpoint serves in one request
+MAX_BATCH_STATIONS = 200
 
 @stf_bp.route('/fc/<awrc_id>/<fc_dt>')
 def stf_fc_flow(awrc_id, fc_dt):
@@ -50,41 +66,61 @@ def stf_fc_flow(awrc_id, fc_dt):
     daily = request.args.get('daily', False)
     daily_agg_method = request.args.get('daily_agg_method', 'sum')
 
+    stations = StfMetadatum.awrc_id == awrc_id
     if daily:
-        q = stf_fc_flow_daily(awrc_id, dt_utc, daily_agg_method)
+        q = stf_fc_flow_daily(stations, dt_utc, daily_agg_method)
     else: # hourly
-        q = stf_fc_flow_hourly(awrc_id, dt_utc)
+        q = stf_fc_flow_hourly(stations, dt_utc)
 
     # TODO: send 404 if entry is empty...?
-    return ts_response(q)
+    return ts_response(q, FC_TABLES)
+
 
+def stf_fc_flow_daily(stations, dt_utc, agg_type='sum', grouped=False):
+    """
+        Days are lead_time_hours / 24 from the forecast datetime, i.e. lead
+        hours 1-23 are the first day. This isn't the lead day of the daily
+        rollup (lead hours 1-24), so it's aggregated from the hourly rows of
+        the forecast.
 
-def stf_fc_flow_daily(awrc_id, dt_utc, agg_type='sum'):
+        `stations` filters stf_metadata, see `station_columns` for `grouped`.
+    """
     assert agg_type in agg_map
     agg_func = agg_map[agg_type]
 
     q = StfFcFlow.query.with_entities(
+        *station_columns(grouped),
         (
+            # floor so that it's integer division whichever way sqlalchemy
+            # renders `/` for integers
             StfFcFlow.fc_datetime
-            + (StfFcFlow.lead_time_hours / 24) * func.cast(concat(1, ' DAY'), INTERVAL)
+            + func.floor(StfFcFlow.lead_time_hours / 24) * func.cast(concat(1, ' DAY'), INTERVAL)
         ).label('timestamp'),
-        agg_func(StfFcFlow.pctl_5).label('pctl_5'),
-        agg_func(StfFcFlow.pctl_25).label('pctl_25'),
-        agg_func(StfFcFlow.pctl_50).label('pctl_50'),
-        agg_func(StfFcFlow.pctl_75).label('pctl_75'),
-        agg_func(StfFcFlow.pctl_95).label('pctl_95')
+        *[agg_func(getattr(StfFcFlow, c)).label(c) for c in PCTL_COLUMNS]
     ).join(
         StfMetadatum, StfMetadatum.pk_meta == StfFcFlow.meta_id
     ).filter(
         func.date_trunc('hour', StfFcFlow.fc_datetime) == func.date_trunc('hour', dt_utc),
-        StfMetadatum.awrc_id == awrc_id
-    ).group_by('timestamp').order_by('timestamp')
+        stations
+    ).group_by(
+        *station_columns(grouped), 'timestamp'
+    ).order_by(*station_columns(grouped), 'timestamp')
 
     return q
 
 
-def stf_fc_flow_hourly(awrc_id, dt_utc):
+def fc_daily_columns(agg_type):
+    """ pctl_<x>_<agg_type> rollup columns, labelled as pctl_<x> """
+    assert agg_type in agg_map
+    return [
+        getattr(StfFcFlowDaily, '{}_{}'.format(c, agg_type)).label(c)
+        for c in PCTL_COLUMNS
+    ]
+
+
+def stf_fc_flow_hourly(stations, dt_utc, grouped=False):
     q = StfFcFlow.query.with_entities(
+        *station_columns(grouped),
         (
             StfFcFlow.fc_datetime
             + StfFcFlow.lead_time_hours * func.cast(concat(1, ' HOURS'), INTERVAL)
@@ -98,12 +134,99 @@ def stf_fc_flow_hourly(awrc_id, dt_utc):
         StfMetadatum, StfMetadatum.pk_meta == StfFcFlow.meta_id
     ).filter(
         func.date_trunc('hour', StfFcFlow.fc_datetime) == func.date_trunc('hour', dt_utc),
-        StfMetadatum.awrc_id == awrc_id
-    ).order_by('timestamp')
+        stations
+    ).order_by(*station_columns(grouped), 'timestamp')
 
     return q
 
 
+@stf_bp.route('/fc_ens/<awrc_id>/<fc_dt>')
+def stf_fc_ens(awrc_id, fc_dt):
+    """
+        API:
+        stf_api/fc_ens/<awrc_id>/<fc_dt>?quantiles=0.1,0.9&exceed=50,100
+
+        Computed from the raw ensembles, so only available for forecasts
+        ingested with --store-ensemble.
+
+        IN:
+            - awrc_id: AWRC ID of station (required)
+            - fc_dt: forecast datetime (required)
+            - quantiles: comma separated quantiles in [0, 1]
+            - exceed: comma separated flow thresholds
+            (at least one of quantiles/exceed is required)
+        OUT (json, or see `ts_response` for other formats):
+            - pctl_<100 * quantile> for each quantile and exceed_<threshold>
+              (probability of the flow being above the threshold) for each
+              threshold, timestamped to each lead hour from forecast date.
+              404 if the ensemble isn't stored for the forecast.
+    """
+    FORCE_FC_HOUR = 23
+    dt_utc = parse_dt_to_utc(fc_dt)
+    # force the forecast hour to 23:00
+    dt_utc = dt_utc.replace(hour=FORCE_FC_HOUR)
+    quantiles = parse_float_list(request.args.get('quantiles'))
+    thresholds = parse_float_list(request.args.get('exceed'))
+
+    if not quantiles and not thresholds:
+        abort(400, 'quantiles and/or exceed are required')
+    if any(q < 0 or q > 1 for q in quantiles):
+        abort(400, 'quantiles must be between 0 and 1')
+
+    fmt = negotiate_format(request)
+
+    def encode():
+        r = fc_ens_stats(awrc_id, dt_utc, quantiles, thresholds)
+        return encode_rows(r['keys'], r['entries'], fmt)
+
+    # computing the quantiles is the expensive part, so the response is
+    # cached the same as `ts_response`, until the ensembles are re-ingested
+    try:
+        body = response_cache.cached(ENS_TABLES,
+            ('fc_ens', awrc_id, dt_utc, quantiles, thresholds, fmt), encode)
+    except LookupError as e:
+        abort(404, str(e))
+    return encoded_response(body, fmt)
+
+
+def fc_ens_stats(awrc_id, dt_utc, quantiles, thresholds):
+    """
+        Raises LookupError if there's no ensemble for the forecast (not
+        cached by `stf_fc_ens`, so that it's picked up once ingested).
+
+        Quantiles are computed the same way as the ingest's percentiles, i.e.
+        a lead time with any missing member gives null.
+    """
+    row = StfFcEns.query.join(
+        StfMetadatum, StfMetadatum.pk_meta == StfFcEns.meta_id
+    ).filter(
+        StfMetadatum.awrc_id == awrc_id,
+        StfFcEns.fc_datetime == dt_utc
+    ).one_or_none()
+    if row is None:
+        raise LookupError('no ensemble stored for {} @ {}'.format(
+            awrc_id, dt_utc))
+
+    # shape: (lead_time, ens_member)
+    ens = row.decode_ens()
+    columns = {}
+    if quantiles:
+        for q, v in zip(quantiles, np.quantile(ens, quantiles, axis=1)):
+            columns['pctl_{:g}'.format(100 * q)] = v
+    # probability over the members that aren't missing
+    with np.errstate(invalid='ignore', divide='ignore'):
+        n_valid = (~np.isnan(ens)).sum(axis=1)
+        for x in thresholds:
+            columns['exceed_{:g}'.format(x)] = (ens > x).sum(axis=1) / n_valid
+
+    entries = [
+        [row.fc_datetime + datetime.timedelta(hours=h)]
+        + [None if np.isnan(v[i]) else float(v[i]) for v in columns.values()]
+        for i, h in enumerate(row.lead_time_hours)
+    ]
+    return {'keys': ['timestamp'] + list(columns), 'entries': entries}
+
+
 # TODO: maybe we need to split fc, obs and metadata into different blueprints
 # - This should really be part of the fc API
 @stf_bp.route('/fc_lead/<awrc_id>/<lead_day>/<start_dt>/<end_dt>')
@@ -153,24 +276,40 @@ def stf_fc_by_lead_day(awrc_id, lead_day, start_dt, end_dt):
         q = stf_fc_lead_flow_hourly(awrc_id, lead_day, dt_start_utc, dt_end_utc)
 
     # TODO: send 404 if entry is empty...?
-    return ts_response(q)
+    return ts_response(q, FC_TABLES)
 
 
 def stf_fc_lead_flow_daily(
         awrc_id, lead_day, dt_start_utc, dt_end_utc, agg_type='sum'):
-    assert agg_type in agg_map
-    agg_func = agg_map[agg_type]
+    q = StfFcFlowDaily.query.with_entities(
+        (
+            # lead_day - 1 since the timestamp is the start of the day
+            StfFcFlowDaily.fc_datetime + func.cast(concat(lead_day - 1, ' DAY'), INTERVAL)
+        ).label('timestamp'),
+        *fc_daily_columns(agg_type)
+    ).join(
+        StfMetadatum, StfMetadatum.pk_meta == StfFcFlowDaily.meta_id
+    ).filter(
+        StfFcFlowDaily.fc_datetime >= dt_start_utc,
+        StfFcFlowDaily.fc_datetime < dt_end_utc,
+        StfFcFlowDaily.lead_day == lead_day,
+        StfMetadatum.awrc_id == awrc_id
+    ).order_by('timestamp')
 
+    return q
+
+
+def stf_fc_lead_flow_hourly(awrc_id, lead_day, dt_start_utc, dt_end_utc):
     q = StfFcFlow.query.with_entities(
         (
-            # lead_day - 1 since the timestamp is the start of the day
-            StfFcFlow.fc_datetime + func.cast(concat(lead_day - 1, ' DAY'), INTERVAL)
+            StfFcFlow.fc_datetime
+            + StfFcFlow.lead_time_hours * func.cast(concat(1, ' HOURS'), INTERVAL)
         ).label('timestamp'),
-        agg_func(StfFcFlow.pctl_5).label('pctl_5'),
-        agg_func(StfFcFlow.pctl_25).label('pctl_25'),
-        agg_func(StfFcFlow.pctl_50).label('pctl_50'),
-        agg_func(StfFcFlow.pctl_75).label('pctl_75'),
-        agg_func(StfFcFlow.pctl_95).label('pctl_95')
+        StfFcFlow.pctl_5,
+        StfFcFlow.pctl_25,
+        StfFcFlow.pctl_50,
+        StfFcFlow.pctl_75,
+        StfFcFlow.pctl_95
     ).join(
         StfMetadatum, StfMetadatum.pk_meta == StfFcFlow.meta_id
     ).filter(
@@ -179,13 +318,85 @@ def stf_fc_lead_flow_daily(
         StfFcFlow.lead_time_hours <= 24 * lead_day,
         StfFcFlow.lead_time_hours > 24 * (lead_day - 1),
         StfMetadatum.awrc_id == awrc_id
-    ).group_by('timestamp').order_by('timestamp')
+    ).order_by('timestamp')
 
     return q
 
 
-def stf_fc_lead_flow_hourly(awrc_id, lead_day, dt_start_utc, dt_end_utc):
+@stf_bp.route('/fc_leads/<awrc_id>/<start_dt>/<end_dt>')
+def stf_fc_all_lead_days(awrc_id, start_dt, end_dt):
+    """
+        API:
+        stf_api/fc_leads/<awrc_id>/<start_dt>/<end_dt>
+
+        IN:
+            - awrc_id: AWRC ID of station (required)
+            - start_dt: starting forecast datetime (required)
+            - end_dt: ending forecast datetime (required)
+            - daily, daily_agg_method: as for `stf_fc_by_lead_day`
+        OUT (json, or see `ts_response` for other formats):
+            - `stf_fc_by_lead_day` for every lead day, with lead_day as the
+              first column, ordered by lead_day and timestamp
+
+        Reads the forecasts in the range once, instead of once per lead day:
+
+        ```sql
+        SELECT
+            CEIL(lead_time_hours / 24.0)::INTEGER AS lead_day,
+            fc_datetime + INTERVAL '1 HOUR' * lead_time_hours AS timestamp,
+            pctl_5, pctl_25, pctl_50, pctl_75, pctl_95
+        FROM stf_fc_flow
+        INNER JOIN stf_metadata ON stf_metadata.pk_meta = stf_fc_flow.meta_id
+        WHERE
+            awrc_id = <awrc_id> AND
+            fc_datetime >= start_dt AND
+            fc_datetime < end_dt
+        ORDER BY lead_day, timestamp;
+        ```
+    """
+    FORCE_FC_HOUR = 23
+    # force the forecast hour to 23:00
+    dt_start_utc = parse_dt_to_utc(start_dt).replace(hour=FORCE_FC_HOUR)
+    dt_end_utc = parse_dt_to_utc(end_dt).replace(hour=FORCE_FC_HOUR)
+    daily = request.args.get('daily', False)
+    daily_agg_method = request.args.get('daily_agg_method', 'sum')
+
+    if daily:
+        q = stf_fc_all_lead_days_daily(
+            awrc_id, dt_start_utc, dt_end_utc, daily_agg_method)
+    else: # hourly
+        q = stf_fc_all_lead_days_hourly(awrc_id, dt_start_utc, dt_end_utc)
+
+    return ts_response(q, FC_TABLES)
+
+
+def stf_fc_all_lead_days_daily(
+        awrc_id, dt_start_utc, dt_end_utc, agg_type='sum'):
+    q = StfFcFlowDaily.query.with_entities(
+        StfFcFlowDaily.lead_day,
+        (
+            StfFcFlowDaily.fc_datetime
+            + (StfFcFlowDaily.lead_day - 1) * func.cast(concat(1, ' DAY'), INTERVAL)
+        ).label('timestamp'),
+        *fc_daily_columns(agg_type)
+    ).join(
+        StfMetadatum, StfMetadatum.pk_meta == StfFcFlowDaily.meta_id
+    ).filter(
+        StfFcFlowDaily.fc_datetime >= dt_start_utc,
+        StfFcFlowDaily.fc_datetime < dt_end_utc,
+        StfMetadatum.awrc_id == awrc_id
+    ).order_by(StfFcFlowDaily.lead_day, 'timestamp')
+
+    return q
+
+
+def stf_fc_all_lead_days_hourly(awrc_id, dt_start_utc, dt_end_utc):
+    # lead day d covers lead_time_hours (d - 1) * 24 + 1 .. d * 24
+    lead_day = func.cast(
+        func.ceil(StfFcFlow.lead_time_hours / 24.0), Integer
+    ).label('lead_day')
     q = StfFcFlow.query.with_entities(
+        lead_day,
         (
             StfFcFlow.fc_datetime
             + StfFcFlow.lead_time_hours * func.cast(concat(1, ' HOURS'), INTERVAL)
@@ -200,10 +411,8 @@ def stf_fc_lead_flow_hourly(awrc_id, lead_day, dt_start_utc, dt_end_utc):
     ).filter(
         StfFcFlow.fc_datetime >= dt_start_utc,
         StfFcFlow.fc_datetime < dt_end_utc,
-        StfFcFlow.lead_time_hours <= 24 * lead_day,
-        StfFcFlow.lead_time_hours > 24 * (lead_day - 1),
         StfMetadatum.awrc_id == awrc_id
-    ).order_by('timestamp')
+    ).order_by('lead_day', 'timestamp')
 
     return q
 
@@ -238,19 +447,32 @@ def stf_obs_flow(awrc_id, start_dt, end_dt):
     daily = request.args.get('daily', False)
     daily_agg_method = request.args.get('daily_agg_method', 'sum')
 
+    stations = StfMetadatum.awrc_id == awrc_id
     if daily:
-        q = stf_obs_flow_daily(awrc_id, start_dt_utc, end_dt_utc, daily_agg_method)
+        q = stf_obs_flow_daily(stations, start_dt_utc, end_dt_utc, daily_agg_method)
     else: # hourly
-        q = stf_obs_flow_hourly(awrc_id, start_dt_utc, end_dt_utc)
+        q = stf_obs_flow_hourly(stations, start_dt_utc, end_dt_utc)
 
-    return ts_response(q)
+    return ts_response(q, OBS_TABLES)
 
 
-def stf_obs_flow_daily(awrc_id, start_dt_utc, end_dt_utc, agg_type='sum'):
+def stf_obs_flow_daily(
+        stations, start_dt_utc, end_dt_utc, agg_type='sum', grouped=False):
     assert agg_type in agg_map
+
+    # days in the rollup start on the hour, so it can only be used when the
+    # requested range lines up with them
+    if all(
+            dt.hour == StfObsFlowDaily.DAY_START_HOUR
+            and (dt.minute, dt.second, dt.microsecond) == (0, 0, 0)
+            for dt in (start_dt_utc, end_dt_utc)):
+        return stf_obs_flow_daily_rollup(
+            stations, start_dt_utc, end_dt_utc, agg_type, grouped)
+
     agg_func = agg_map[agg_type]
 
     q = StfObsFlow.query.with_entities(
+            *station_columns(grouped),
             (
                 # so that the date interval starts at the start_dt
                 func.cast(start_dt_utc, DateTime(True)) + func.date_part(
@@ -262,29 +484,147 @@ def stf_obs_flow_daily(awrc_id, start_dt_utc, end_dt_utc, agg_type='sum'):
         ).join(
             StfMetadatum, StfMetadatum.pk_meta == StfObsFlow.meta_id
         ).filter(and_(
-            StfMetadatum.awrc_id == awrc_id,
+            stations,
             StfObsFlow.obs_datetime >= start_dt_utc,
             StfObsFlow.obs_datetime < end_dt_utc
-        )).group_by('timestamp').order_by('timestamp')
+        )).group_by(
+            *station_columns(grouped), 'timestamp'
+        ).order_by(*station_columns(grouped), 'timestamp')
 
     return q
 
 
-def stf_obs_flow_hourly(awrc_id, start_dt_utc, end_dt_utc):
+def stf_obs_flow_daily_rollup(
+        stations, start_dt_utc, end_dt_utc, agg_type, grouped=False):
+    q = StfObsFlowDaily.query.with_entities(
+            *station_columns(grouped),
+            StfObsFlowDaily.day_start.label('timestamp'),
+            getattr(StfObsFlowDaily, 'value_{}'.format(agg_type)).label('value')
+        ).join(
+            StfMetadatum, StfMetadatum.pk_meta == StfObsFlowDaily.meta_id
+        ).filter(and_(
+            stations,
+            StfObsFlowDaily.day_start >= start_dt_utc,
+            StfObsFlowDaily.day_start < end_dt_utc
+        )).order_by(*station_columns(grouped), 'timestamp')
+
+    return q
+
+
+def stf_obs_flow_hourly(stations, start_dt_utc, end_dt_utc, grouped=False):
     q = StfObsFlow.query.with_entities(
+            *station_columns(grouped),
             StfObsFlow.obs_datetime.label('timestamp'),
             StfObsFlow.value
         ).join(
             StfMetadatum, StfMetadatum.pk_meta == StfObsFlow.meta_id
         ).filter(and_(
-            StfMetadatum.awrc_id == awrc_id,
+            stations,
             StfObsFlow.obs_datetime >= start_dt_utc,
             StfObsFlow.obs_datetime < end_dt_utc
-        )).order_by('timestamp')
+        )).order_by(*station_columns(grouped), 'timestamp')
 
     return q
 
 
+@stf_bp.route('/batch/fc/<fc_dt>')
+def stf_fc_flow_batch(fc_dt):
+    """
+        API:
+        stf_api/batch/fc/<fc_dt>?awrc_ids=<awrc_id>,<awrc_id>,...
+        stf_api/batch/fc/<fc_dt>?catchment=<catchment>
+
+        IN:
+            - fc_dt: forecast datetime (required)
+            - awrc_ids or catchment: the stations (one of them is required,
+              at most MAX_BATCH_STATIONS awrc_ids)
+            - daily, daily_agg_method: as for `stf_fc_flow`
+        OUT (json, or see `ts_response` for other formats):
+            - same as `stf_fc_flow` for every station, with awrc_id as the
+              first column and grouped by it, i.e. ordered by awrc_id and
+              timestamp. Stations without the forecast have no rows.
+
+        All the stations are read with one query:
+
+        ```sql
+        SELECT stf_metadata.awrc_id, <stf_fc_flow columns>
+        ...
+        WHERE ... AND stf_metadata.awrc_id = ANY(<awrc_ids>)
+        ORDER BY awrc_id, timestamp ASC;
+        ```
+    """
+    FORCE_FC_HOUR = 23
+    dt_utc = parse_dt_to_utc(fc_dt).replace(hour=FORCE_FC_HOUR)
+    daily = request.args.get('daily', False)
+    daily_agg_method = request.args.get('daily_agg_method', 'sum')
+
+    stations = parse_stations(request)
+    if daily:
+        q = stf_fc_flow_daily(stations, dt_utc, daily_agg_method, grouped=True)
+    else: # hourly
+        q = stf_fc_flow_hourly(stations, dt_utc, grouped=True)
+
+    return ts_response(q, FC_TABLES)
+
+
+@stf_bp.route('/batch/obs/<start_dt>/<end_dt>')
+def stf_obs_flow_batch(start_dt, end_dt):
+    """
+        API:
+        stf_api/batch/obs/<start_dt>/<end_dt>?awrc_ids=<awrc_id>,...
+        stf_api/batch/obs/<start_dt>/<end_dt>?catchment=<catchment>
+
+        IN:
+            - start_dt, end_dt, daily, daily_agg_method: as for `stf_obs_flow`
+            - awrc_ids or catchment: as for `stf_fc_flow_batch`
+        OUT (json, or see `ts_response` for other formats):
+            - same as `stf_obs_flow` for every station, with awrc_id as the
+              first column, ordered by awrc_id and timestamp
+    """
+    start_dt_utc = parse_dt_to_utc(start_dt)
+    end_dt_utc = parse_dt_to_utc(end_dt)
+    daily = request.args.get('daily', False)
+    daily_agg_method = request.args.get('daily_agg_method', 'sum')
+
+    stations = parse_stations(request)
+    if daily:
+        q = stf_obs_flow_daily(
+            stations, start_dt_utc, end_dt_utc, daily_agg_method, grouped=True)
+    else: # hourly
+        q = stf_obs_flow_hourly(
+            stations, start_dt_utc, end_dt_utc, grouped=True)
+
+    return ts_response(q, OBS_TABLES)
+
+
+def parse_stations(request):
+    """
+        stf_metadata filter for the `awrc_ids` (comma separated) or
+        `catchment` args of a batch endpoint. The awrc_ids are bound as one
+        array, so the query is the same whatever the number of stations.
+    """
+    awrc_ids = request.args.get('awrc_ids')
+    catchment = request.args.get('catchment')
+    if (awrc_ids is None) == (catchment is None):
+        abort(400, 'one of awrc_ids or catchment is required')
+    if catchment is not None:
+        return StfMetadatum.catchment == catchment
+
+    awrc_ids = sorted(set(x.strip() for x in awrc_ids.split(',') if x.strip()))
+    if not awrc_ids or len(awrc_ids) > MAX_BATCH_STATIONS:
+        abort(400, 'expected 1 to {} awrc_ids'.format(MAX_BATCH_STATIONS))
+    return StfMetadatum.awrc_id == any_(
+        bindparam('awrc_ids', awrc_ids, type_=ARRAY(String)))
+
+
+def station_columns(grouped):
+    """
+        Leading columns of a query: awrc_id for batch (`grouped`) responses,
+        which also sort by it so each station's series is contiguous.
+    """
+    return [StfMetadatum.awrc_id] if grouped else []
+
+
 @stf_bp.route('/geo/catchment_boundaries')
 def stf_catchment_boundaries():
     """
@@ -353,7 +693,7 @@ def stf_station_info_for_catchment(catchment, awrc_id=None):
 
     filt = [StfMetadatum.catchment == catchment]
     q = query_station_info(filt)
-    return ts_response(q)
+    return ts_response(q, META_TABLES)
 
 
 @stf_bp.route('/meta/list_station/<awrc_id>')
@@ -364,29 +704,28 @@ def stf_station_info_for_awrc_id(awrc_id):
     """
     filt = [StfMetadatum.awrc_id == awrc_id]
     q = query_station_info(filt)
-    return ts_response(q)
+    return ts_response(q, META_TABLES)
 
 
 # --- helper APIs ---
+# served from the station catalog maintained by the ingest, rather than
+# scanning stf_fc_flow (see stf_station_catalog in setup_tables.sql)
 
 @stf_bp.route('/awrc_ids')
 def stf_awrc_ids():
     """
         ```sql
-        WITH unique_meta_id AS (
-                SELECT distinct(meta_id) FROM stf_fc_flow
-            )
-        SELECT awrc_id FROM stf_metadata
-        INNER JOIN unique meta_id ON stf_metadata.pk_meta = unique_meta_id.meta_id
+        SELECT awrc_id FROM stf_station_catalog
+        INNER JOIN stf_metadata ON stf_metadata.pk_meta = stf_station_catalog.meta_id
+        WHERE fc_count > 0
+        ORDER BY awrc_id
         ```
     """
-    t_unique_meta_id = StfFcFlow.query.with_entities(
-        distinct(StfFcFlow.meta_id).label('meta_id')
-    ).cte('unique_meta_id')
-
     q_awrc_ids = StfMetadatum.query.with_entities(
         StfMetadatum.awrc_id
-    ).join(t_unique_meta_id, t_unique_meta_id.c.meta_id == StfMetadatum.pk_meta)
+    ).join(
+        StfStationCatalog, StfStationCatalog.meta_id == StfMetadatum.pk_meta
+    ).filter(StfStationCatalog.fc_count > 0).order_by(StfMetadatum.awrc_id)
 
     return my_jsonify(q_awrc_ids.all())
 
@@ -397,25 +736,48 @@ def stf_awrc_ids():
 def stf_fc_dates(awrc_id):
     """
         ```sql
-        WITH t_meta_id AS (
-                SELECT pk_meta AS meta_id FROM stf_metadata
-                WHERE awrc_id = <awrc_id>
-            )
-        SELECT MIN(fc_datetime), MAX(fc_datetime) FROM stf_metadata
-        WHERE meta_id IN (SELECT pk_meta FROM t_meta_id)
+        SELECT fc_min_datetime, fc_max_datetime FROM stf_station_catalog
+        INNER JOIN stf_metadata ON stf_metadata.pk_meta = stf_station_catalog.meta_id
+        WHERE awrc_id = <awrc_id>
         ```
     """
-    t_meta_id = StfMetadatum.query.with_entities(
-        StfMetadatum.pk_meta.label('meta_id')
-    ).filter(StfMetadatum.awrc_id == awrc_id
-    ).cte('t_meta_id')
+    q_fc_dates = StfStationCatalog.query.with_entities(
+        StfStationCatalog.fc_min_datetime.label('min_fc_date'),
+        StfStationCatalog.fc_max_datetime.label('max_fc_date')
+    ).join(
+        StfMetadatum, StfMetadatum.pk_meta == StfStationCatalog.meta_id
+    ).filter(StfMetadatum.awrc_id == awrc_id)
+
+    # a single (null, null) row for stations without forecasts, as MIN/MAX
+    # over stf_fc_flow gave
+    return my_jsonify(q_fc_dates.all() or [(None, None)])
 
-    q_fc_dates = StfFcFlow.query.with_entities(
-        func.min(StfFcFlow.fc_datetime).label('min_fc_date'),
-        func.max(StfFcFlow.fc_datetime).label('max_fc_date')
-    ).filter(StfFcFlow.meta_id.in_(t_meta_id))
 
-    return my_jsonify(q_fc_dates.all())
+@stf_bp.route('/meta/catalog')
+def stf_station_catalog():
+    """
+        API:
+            stf_api/meta/catalog
+
+        OUT (json, or see `ts_response` for other formats):
+            - for every station with data: awrc_id, catchment and the first
+              and last forecast/observation datetime and number of hourly
+              rows of each
+    """
+    q = StfStationCatalog.query.with_entities(
+        StfMetadatum.awrc_id,
+        StfMetadatum.catchment,
+        StfStationCatalog.fc_min_datetime,
+        StfStationCatalog.fc_max_datetime,
+        StfStationCatalog.fc_count,
+        StfStationCatalog.obs_min_datetime,
+        StfStationCatalog.obs_max_datetime,
+        StfStationCatalog.obs_count
+    ).join(
+        StfMetadatum, StfMetadatum.pk_meta == StfStationCatalog.meta_id
+    ).order_by(StfMetadatum.awrc_id)
+
+    return ts_response(q, CATALOG_TABLES)
 
 
 # --- helper funcs ---
@@ -429,21 +791,55 @@ def parse_dt_to_utc(dt_str):
     return dt_utc
 
 
-def ts_response(q):
+def parse_float_list(s):
+    """ '0.1,0.5' -> (0.1, 0.5), hashable for the response cache key """
+    if not s:
+        return ()
+    try:
+        return tuple(float(x) for x in s.split(','))
+    except ValueError:
+        abort(400, 'expected comma separated numbers, got: {}'.format(s))
+
+
+def ts_response(q, tables):
+    """
+        Rows of `q` as {'keys': [...], 'entries': [...]}, or columnar json /
+        arrow depending on the `format` arg or Accept header (see
+        `stf_api.routes.encoding`).
+
+        The encoded response is cached until the ingest updates one of
+        `tables` (see `stf_api.services.cache`), keyed on the endpoint, the
+        compiled query and the format. So requests that only differ in how
+        they spell a datetime share an entry.
+    """
     # TODO: enable this if using from browser
     # if 'Cache-Control' not in r.headers:
     #     r.headers['Cache-Control'] = 'public, max-age=86400, must-revalidate'
     # requires simplejson
-    return my_jsonify({
-        'keys': [ x['name'] for x in q.column_descriptions ],
-        'entries': q.all()
-    })
+    fmt = negotiate_format(request)
+
+    def encode():
+        return encode_rows(
+            [ x['name'] for x in q.column_descriptions ], q.all(), fmt)
+
+    body = response_cache.cached(tables, query_cache_key(q) + (fmt,), encode)
+    return encoded_response(body, fmt)
+
+
+def encoded_response(body, fmt):
+    r = make_response(body)
+    r.mimetype = FORMATS[fmt]
+    # the same url has different responses depending on the Accept header
+    r.vary.add('Accept')
+    return r
+
+
+def query_cache_key(q):
+    compiled = q.statement.compile()
+    return (request.endpoint, str(compiled), sorted(compiled.params.items()))
 
 
 def my_jsonify(obj):
-    try:
-        r = make_response(json.dumps(obj, namedtuple_as_object=False))
-    except Exception as e:
-        r = make_response(json.dumps(obj))
+    r = make_response(json_dumps(obj))
     r.mimetype = "application/json"
     return r
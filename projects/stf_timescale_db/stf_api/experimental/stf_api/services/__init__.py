@@ -0,0 +1,5 @@
+from .cache import response_cache
+
+
+def init_app(app):
+    response_cache.init_app(app)
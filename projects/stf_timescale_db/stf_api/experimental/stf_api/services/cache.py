@@ -0,0 +1,199 @@
+"""
+    Cache for encoded api responses. Ingested rows don't change, so a cached
+    response stays valid until the ingest bumps the version of one of the
+    tables it was read from (stf_ingest_version, see setup_tables.sql). The
+    versions are part of the cache key, so entries for old versions are never
+    read again and just age out.
+
+    Entries are kept in an in process LRU, and optionally in a backend shared
+    by every worker process, set with STF_CACHE_URL:
+
+        redis://host:6379/0     - redis (requires the `redis` package)
+        file:///path/to/dir     - a directory, e.g. on a shared volume
+
+    Versions are looked up at most every STF_CACHE_VERSION_TTL seconds, so a
+    response can be that many seconds out of date after an ingest.
+"""
+import os
+import time
+import pickle
+import hashlib
+import logging
+import threading
+import collections
+import urllib.parse
+
+from sqlalchemy import exc
+
+from stf_api.models.base import db
+from stf_api.models.test_models import StfIngestVersion
+
+LOGGER = logging.getLogger(__name__)
+
+
+class LRUBackend():
+    """ In process, holds up to `maxsize` entries """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+
+class FileBackend():
+    """ One file per entry in `directory`, expired after `ttl` seconds """
+    def __init__(self, directory, ttl):
+        self.directory = directory
+        self.ttl = ttl
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key)
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            if time.time() - os.path.getmtime(path) > self.ttl:
+                return None
+            with open(path, 'rb') as f:
+                return pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+
+    def set(self, key, value):
+        # write then rename so that readers never see a partial entry
+        path = self._path(key)
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(value, f)
+        os.replace(tmp_path, path)
+
+
+class RedisBackend():
+    """ Shared redis, entries expire after `ttl` seconds """
+    def __init__(self, url, ttl):
+        # optional dependency, only needed for a redis cache
+        try:
+            import redis
+        except ImportError:
+            raise ImportError('a redis STF_CACHE_URL requires redis')
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+
+    def get(self, key):
+        value = self.client.get(key)
+        return pickle.loads(value) if value is not None else None
+
+    def set(self, key, value):
+        self.client.set(key, pickle.dumps(value), ex=self.ttl)
+
+
+def backend_from_url(url, ttl):
+    parts = urllib.parse.urlparse(url)
+    if parts.scheme in ['redis', 'rediss', 'unix']:
+        return RedisBackend(url, ttl)
+    if parts.scheme == 'file':
+        return FileBackend(parts.path, ttl)
+    raise ValueError('unsupported STF_CACHE_URL: {}'.format(url))
+
+
+class ResponseCache():
+    """
+        Usage:
+        >>> body = response_cache.cached(
+        >>>     ['stf_fc_flow'], ('fc', awrc_id, dt_utc), lambda: encode(q))
+
+        `compute` is only called on a miss. Caching is off if the version
+        table doesn't exist.
+    """
+    def __init__(self):
+        self.local = LRUBackend(0)
+        self.shared = None
+        self.version_ttl = 0
+        self._versions = None
+        self._versions_time = 0
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.local = LRUBackend(app.config.get('STF_CACHE_SIZE', 256))
+        url = app.config.get('STF_CACHE_URL')
+        ttl = app.config.get('STF_CACHE_TTL', 24 * 3600)
+        self.shared = backend_from_url(url, ttl) if url else None
+        self.version_ttl = app.config.get('STF_CACHE_VERSION_TTL', 5)
+
+    def versions(self, tables):
+        """
+            Current version of each table (0 if it hasn't been ingested
+            since the version table was added), or None if unknown.
+        """
+        with self._lock:
+            if (self._versions is None
+                    or time.time() - self._versions_time > self.version_ttl):
+                self._versions = self._load_versions()
+                self._versions_time = time.time()
+            versions = self._versions
+        if versions is None:
+            return None
+        return tuple(versions.get(t, 0) for t in tables)
+
+    def _load_versions(self):
+        try:
+            return dict(db.session.query(
+                StfIngestVersion.table_name, StfIngestVersion.version).all())
+        except exc.ProgrammingError:
+            db.session.rollback()
+            LOGGER.warning('no stf_ingest_version table, responses are not '
+                'cached')
+            return None
+
+    def cached(self, tables, key_parts, compute):
+        """
+            Returns the cached value for `key_parts` at the current version
+            of `tables`, computing (and caching) it on a miss.
+        """
+        versions = self.versions(tables)
+        if versions is None:
+            return compute()
+        key = hashlib.sha256(repr(
+            (tuple(tables), versions, key_parts)).encode()).hexdigest()
+
+        value = self.local.get(key)
+        if value is None:
+            value = self._shared('get', key)
+            if value is not None:
+                self.local.set(key, value)
+        if value is not None:
+            return value
+
+        value = compute()
+        self.local.set(key, value)
+        self._shared('set', key, value)
+        return value
+
+    def _shared(self, method, *args):
+        # the shared backend being down only costs the cache hits
+        if self.shared is None:
+            return None
+        try:
+            return getattr(self.shared, method)(*args)
+        except Exception:
+            LOGGER.exception('shared response cache {} failed'.format(method))
+            return None
+
+
+response_cache = ResponseCache()
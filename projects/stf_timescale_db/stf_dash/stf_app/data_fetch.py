@@ -7,6 +7,12 @@ import dateutil
 from dateutil.relativedelta import relativedelta
 from pytz import timezone
 
+# optional dependency, without it time series are fetched as columnar json
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
 DEBUG_STF_API_URI = 'http://localhost:8052/stf_api'
 STF_API_URI = 'http://stf_api:8052/stf_api'
 DEFAULT_AWRC_ID = '403227'
@@ -14,12 +20,49 @@ DT_FMT = '%Y-%m-%d %H:%M %Z'
 
 # TODO: lot of duplication in some of these functions
 
+COLUMNAR_MIMETYPE = 'application/vnd.stf.columnar+json'
+ARROW_MIMETYPE = 'application/vnd.apache.arrow.stream'
+
 # underlying assumption that all forecasts are at this hour (in UTC)
 FORCE_FC_HOUR = 23
 
 
 # TODO: create intermediate store with datetime
 
+def fetch_dataframe(uri, params=None, index=None):
+    """
+        Fetches a {'keys', 'entries'} endpoint as a dataframe, indexed by the
+        `index` column if given. Asks for arrow (or columnar json without
+        pyarrow), whose timestamps don't need parsing, see
+        stf_api.routes.encoding.
+    """
+    accept = [COLUMNAR_MIMETYPE, 'application/json;q=0.5']
+    if pa is not None:
+        accept.insert(0, ARROW_MIMETYPE)
+    r = requests.get(uri, params=params, headers={'Accept': ', '.join(accept)})
+    if not r.ok:
+        return None
+
+    mimetype = r.headers.get('Content-Type', '').split(';')[0]
+    if mimetype == ARROW_MIMETYPE:
+        df = pa.ipc.open_stream(r.content).read_all().to_pandas()
+    elif mimetype == COLUMNAR_MIMETYPE:
+        d = r.json()
+        df = pd.DataFrame(dict(zip(d['keys'], d['columns'])), columns=d['keys'])
+        for k in d['epoch_ms']:
+            df[k] = pd.to_datetime(df[k], unit='ms', utc=True)
+    else:
+        # older api, only json
+        d = r.json()
+        df = pd.DataFrame(data=d['entries'], columns=d['keys'])
+        if index is not None:
+            # NOTE: to_datetime is slow, takes about 100ms
+            df[index] = pd.to_datetime(df[index])
+
+    if index is not None:
+        df = df.set_index(index)
+    return df
+
 def get_awrc_ids():
     # TODO: this can be cached with expiry timestamp
     uri = os.path.join(STF_API_URI, 'awrc_ids')
@@ -52,14 +95,7 @@ def get_obs_dataframe(
         agg = agg or 'sum'
         payload = { 'daily': True, 'daily_agg_method': agg }
 
-    r = requests.get(uri, params=payload)
-
-    if r.ok:
-        d = r.json()
-        df = pd.DataFrame(data=d['entries'], columns=d['keys'])
-        df = df.set_index('timestamp')
-        df.index = pd.to_datetime(df.index)
-        return df
+    return fetch_dataframe(uri, params=payload, index='timestamp')
 
 
 def get_fc_dataframe(fc_dt, awrc_id=DEFAULT_AWRC_ID, daily=False, agg=None):
@@ -71,15 +107,7 @@ def get_fc_dataframe(fc_dt, awrc_id=DEFAULT_AWRC_ID, daily=False, agg=None):
         agg = agg or 'sum'
         payload = { 'daily': True, 'daily_agg_method': agg }
 
-    r = requests.get(uri, params=payload)
-
-    if r.ok:
-        d = r.json()
-        df = pd.DataFrame(data=d['entries'], columns=d['keys'])
-        df = df.set_index('timestamp')
-        # NOTE: to_datetime is slow, takes about 100ms
-        df.index = pd.to_datetime(df.index)
-        return df
+    return fetch_dataframe(uri, params=payload, index='timestamp')
 
 def get_fc_lead_dataframe(
         start_date, end_date, lead_day, awrc_id=DEFAULT_AWRC_ID, daily=False,
@@ -96,15 +124,24 @@ def get_fc_lead_dataframe(
         agg = agg or 'sum'
         payload = { 'daily': True, 'daily_agg_method': agg }
 
-    r = requests.get(uri, params=payload)
+    return fetch_dataframe(uri, params=payload, index='timestamp')
 
-    if r.ok:
-        d = r.json()
-        df = pd.DataFrame(data=d['entries'], columns=d['keys'])
-        df = df.set_index('timestamp')
-        # NOTE: to_datetime is slow, takes about 100ms
-        df.index = pd.to_datetime(df.index)
-        return df
+def get_fc_all_lead_days_dataframe(
+        start_date, end_date, awrc_id=DEFAULT_AWRC_ID, daily=False, agg=None):
+    """
+        `get_fc_lead_dataframe` for every lead day in one request, with a
+        lead_day column, e.g. df.groupby('lead_day') for lead time analysis
+    """
+    uri = os.path.join(
+        STF_API_URI, 'fc_leads', awrc_id,
+        start_date.strftime(DT_FMT), end_date.strftime(DT_FMT))
+    payload = None
+
+    if daily:
+        agg = agg or 'sum'
+        payload = { 'daily': True, 'daily_agg_method': agg }
+
+    return fetch_dataframe(uri, params=payload, index='timestamp')
 
 def get_catchment_boundaries():
     uri = os.path.join(STF_API_URI, 'geo', 'catchment_boundaries')
@@ -116,21 +153,13 @@ def get_catchment_boundaries():
 def get_station_info_for_catchment(catchment):
     uri = os.path.join(
         STF_API_URI, 'meta', 'list_stations', catchment)
-    r = requests.get(uri)
-    if r.ok:
-        d = r.json()
-        df = pd.DataFrame(data=d['entries'], columns=d['keys'])
-        return df
+    return fetch_dataframe(uri)
 
 
 def get_station_info_for_awrc_id(awrc_id):
     uri = os.path.join(
         STF_API_URI, 'meta', 'list_station', awrc_id)
-    r = requests.get(uri)
-    if r.ok:
-        d = r.json()
-        df = pd.DataFrame(data=d['entries'], columns=d['keys'])
-        return df
+    return fetch_dataframe(uri)
 
 
 def store_current_product():
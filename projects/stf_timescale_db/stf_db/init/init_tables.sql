@@ -87,3 +87,174 @@ CREATE UNIQUE INDEX station_id_lead_time_hours_fc_datetime_idx
     ON stf_fc_flow(meta_id, lead_time_hours, fc_datetime);
 ---
 
+--- stf_ingest_manifest ---
+-- one entry per ingested netcdf file so that re-runs and duplicate s3 events
+-- can skip files that have already been loaded
+
+CREATE TABLE IF NOT EXISTS "stf_ingest_manifest" (
+    filename     TEXT PRIMARY KEY,       -- basename of the netcdf file
+    stf_type     VARCHAR(16) NOT NULL,   -- fc_flow | obs_flow
+    file_size    BIGINT NOT NULL,
+    checksum     TEXT NOT NULL,          -- md5 of the file (or s3 ETag)
+    status       VARCHAR(16) NOT NULL,   -- in_progress | complete | failed
+    row_count    INTEGER,                -- new rows inserted
+    started_at   TIMESTAMPTZ NOT NULL DEFAULT now(),
+    finished_at  TIMESTAMPTZ
+);
+
+---
+
+--- stf_fc_flow_daily / stf_obs_flow_daily ---
+-- daily rollups of the hourly flow, maintained by the ingest in the same
+-- transaction as the hourly rows so that daily queries don't scan them.
+--
+-- forecast: one row per station, forecast and lead day, where lead day d
+-- covers lead_time_hours (d - 1) * 24 + 1 .. d * 24
+-- observed: one row per station and day, days start at 23:00 UTC (the
+-- forecast hour) i.e. [day_start, day_start + 1 day)
+
+CREATE TABLE IF NOT EXISTS "stf_fc_flow_daily" (
+    meta_id         INTEGER NOT NULL,
+    fc_datetime     TIMESTAMPTZ NOT NULL,
+    lead_day        INTEGER NOT NULL,
+    pctl_5_sum      DOUBLE PRECISION,
+    pctl_5_avg      DOUBLE PRECISION,
+    pctl_25_sum     DOUBLE PRECISION,
+    pctl_25_avg     DOUBLE PRECISION,
+    pctl_50_sum     DOUBLE PRECISION,
+    pctl_50_avg     DOUBLE PRECISION,
+    pctl_75_sum     DOUBLE PRECISION,
+    pctl_75_avg     DOUBLE PRECISION,
+    pctl_95_sum     DOUBLE PRECISION,
+    pctl_95_avg     DOUBLE PRECISION,
+    PRIMARY KEY (meta_id, fc_datetime, lead_day),
+    CONSTRAINT fk_meta
+        FOREIGN KEY(meta_id)
+	    REFERENCES stf_metadata(pk_meta)
+);
+
+-- for lead day queries over a range of forecasts
+CREATE INDEX IF NOT EXISTS fc_daily_lead_day_idx
+    ON stf_fc_flow_daily (meta_id, lead_day, fc_datetime);
+
+CREATE TABLE IF NOT EXISTS "stf_obs_flow_daily" (
+    meta_id         INTEGER NOT NULL,
+    day_start       TIMESTAMPTZ NOT NULL,
+    value_sum       DOUBLE PRECISION,
+    value_avg       DOUBLE PRECISION,
+    PRIMARY KEY (meta_id, day_start),
+    CONSTRAINT fk_meta
+        FOREIGN KEY(meta_id)
+	    REFERENCES stf_metadata(pk_meta)
+);
+
+-- populate from any existing hourly data
+INSERT INTO stf_fc_flow_daily
+SELECT
+    meta_id, fc_datetime, (lead_time_hours - 1) / 24 + 1 AS lead_day,
+    sum(pctl_5), avg(pctl_5), sum(pctl_25), avg(pctl_25),
+    sum(pctl_50), avg(pctl_50), sum(pctl_75), avg(pctl_75),
+    sum(pctl_95), avg(pctl_95)
+FROM stf_fc_flow
+GROUP BY 1, 2, 3
+ON CONFLICT DO NOTHING;
+
+INSERT INTO stf_obs_flow_daily
+SELECT
+    meta_id,
+    date_trunc('day', (obs_datetime - INTERVAL '23 hours') AT TIME ZONE 'UTC')
+        AT TIME ZONE 'UTC' + INTERVAL '23 hours' AS day_start,
+    sum(value), avg(value)
+FROM stf_obs_flow
+GROUP BY 1, 2
+ON CONFLICT DO NOTHING;
+
+---
+
+--- stf_fc_ens ---
+-- optional raw ensemble storage (ingest with --store-ensemble, or
+-- STF_STORE_ENSEMBLE=1 for the lambda) so that other quantiles/exceedance
+-- probabilities can be computed by the api without re-ingesting.
+--
+-- one row per station and forecast, `ens` holds the (lead time, ensemble
+-- member) float32 array for `lead_time_hours` (row major, little endian),
+-- byte shuffled (all first bytes, then all second bytes, ...) and zlib
+-- compressed. Missing values are NaN.
+
+CREATE TABLE IF NOT EXISTS "stf_fc_ens" (
+    meta_id         INTEGER NOT NULL,
+    fc_datetime     TIMESTAMPTZ NOT NULL,
+    lead_time_hours INTEGER[] NOT NULL,
+    n_members       INTEGER NOT NULL,
+    ens             BYTEA NOT NULL,
+    PRIMARY KEY (meta_id, fc_datetime),
+    CONSTRAINT fk_meta
+        FOREIGN KEY(meta_id)
+	    REFERENCES stf_metadata(pk_meta)
+);
+
+---
+
+--- stf_ingest_version ---
+-- bumped by the ingest in the same transaction as every change to a table,
+-- so that the api can tell when its cached responses for the table are out
+-- of date. One row per table, created on its first ingest.
+
+CREATE TABLE IF NOT EXISTS "stf_ingest_version" (
+    table_name  VARCHAR(63) PRIMARY KEY,
+    version     BIGINT NOT NULL,
+    updated_at  TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+---
+
+--- stf_station_catalog ---
+-- per station summary of the stored series, updated by the ingest in the
+-- same transaction as the rows it inserts (from the rows actually inserted,
+-- so duplicates aren't counted), so that the api can list stations and
+-- their forecast dates without scanning the hypertables.
+--
+-- *_count are the number of hourly rows, NULL datetimes if there are none.
+
+CREATE TABLE IF NOT EXISTS "stf_station_catalog" (
+    meta_id             INTEGER PRIMARY KEY,
+    fc_min_datetime     TIMESTAMPTZ,
+    fc_max_datetime     TIMESTAMPTZ,
+    fc_count            BIGINT NOT NULL DEFAULT 0,
+    obs_min_datetime    TIMESTAMPTZ,
+    obs_max_datetime    TIMESTAMPTZ,
+    obs_count           BIGINT NOT NULL DEFAULT 0,
+    updated_at          TIMESTAMPTZ NOT NULL DEFAULT now(),
+    CONSTRAINT fk_meta
+        FOREIGN KEY(meta_id)
+	    REFERENCES stf_metadata(pk_meta)
+);
+
+-- populate from any existing hourly data (also needed after ingesting with
+-- ignore_duplicates, which copies straight into the hourly tables)
+INSERT INTO stf_station_catalog
+SELECT
+    m.pk_meta, fc.min_dt, fc.max_dt, coalesce(fc.n, 0),
+    obs.min_dt, obs.max_dt, coalesce(obs.n, 0), now()
+FROM stf_metadata m
+LEFT JOIN (
+    SELECT meta_id, min(fc_datetime) AS min_dt, max(fc_datetime) AS max_dt,
+        count(*) AS n
+    FROM stf_fc_flow GROUP BY meta_id
+) fc ON fc.meta_id = m.pk_meta
+LEFT JOIN (
+    SELECT meta_id, min(obs_datetime) AS min_dt, max(obs_datetime) AS max_dt,
+        count(*) AS n
+    FROM stf_obs_flow GROUP BY meta_id
+) obs ON obs.meta_id = m.pk_meta
+WHERE fc.n IS NOT NULL OR obs.n IS NOT NULL
+ON CONFLICT (meta_id) DO UPDATE SET
+    fc_min_datetime = EXCLUDED.fc_min_datetime,
+    fc_max_datetime = EXCLUDED.fc_max_datetime,
+    fc_count = EXCLUDED.fc_count,
+    obs_min_datetime = EXCLUDED.obs_min_datetime,
+    obs_max_datetime = EXCLUDED.obs_max_datetime,
+    obs_count = EXCLUDED.obs_count,
+    updated_at = now();
+
+---
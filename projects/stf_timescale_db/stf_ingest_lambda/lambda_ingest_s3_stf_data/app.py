@@ -1,17 +1,30 @@
 import os
+import sys
 import time
 import io
 import json
-import functools
+import hashlib
 import pytz
 import dateutil.parser
+import tempfile
+import urllib.parse
+import concurrent.futures
+import contextlib
+import threading
+import zlib
 import psycopg2
+import psycopg2.pool
+import psycopg2.extras
 import logging
 import numpy as np
 import pandas as pd
 import xarray as xr
 import boto3
 from botocore.client import Config
+from boto3.s3.transfer import TransferConfig
+
+import stf_pgcopy
+import stf_metrics
  
 # --- const ---
 
@@ -30,123 +43,466 @@ STFDB_CONNECTION = 'postgres://{user}:{passwd}@{hostname}:{port}/{dbname}'.forma
 )
 FC_TABLE_NAME = 'stf_fc_flow'
 OBS_TABLE_NAME = 'stf_obs_flow'
+MANIFEST_TABLE_NAME = 'stf_ingest_manifest'
+FC_DAILY_TABLE_NAME = 'stf_fc_flow_daily'
+OBS_DAILY_TABLE_NAME = 'stf_obs_flow_daily'
+ENS_TABLE_NAME = 'stf_fc_ens'
+VERSION_TABLE_NAME = 'stf_ingest_version'
+CATALOG_TABLE_NAME = 'stf_station_catalog'
+# observed daily rollups start at the forecast hour (UTC)
+ROLLUP_DAY_START_HOUR = 23
+# percentiles computed over the forecast ensemble (column name -> quantile)
+PCTL_MAP = {
+    'pctl_5': 0.05,
+    'pctl_25': 0.25,
+    'pctl_50': 0.50,
+    'pctl_75': 0.75,
+    'pctl_95': 0.95
+}
+# table columns and their postgres types for binary COPY - order matters
+FC_COLUMNS = [
+    ('fc_datetime', 'timestamptz'),
+    ('lead_time_hours', 'int4'),
+    ('meta_id', 'int4')
+] + [(k, 'float8') for k in PCTL_MAP]
+OBS_COLUMNS = [
+    ('obs_datetime', 'timestamptz'),
+    ('meta_id', 'int4'),
+    ('value', 'float8')
+]
 AWS_REGION = 'ap-southeast-2'
 LOGGER = logging.getLogger(__name__)
 
 LOGGER.setLevel(logging.INFO)
 
+# station metadata cache: {catchment: (load_time, {outlet_node: pk_meta})}
+# This lives for as long as the process does (including warm lambda
+# invocations).
+META_CACHE_TTL = int(os.environ.get('STF_META_CACHE_TTL', 3600))  # seconds
+_META_CACHE = {}
+_META_CACHE_LOCK = threading.Lock()
+
+# incremental observed flow ingest: only rows outside the obs_datetime range
+# already stored for a station are sent, if the range has no gaps, see
+# `obs_frame`. Off by default as files arrive out of order here, which leaves
+# gaps and then every row is sent anyway.
+# cache: {meta_id: (load_time, (first, last, complete) or None)}
+OBS_INCREMENTAL = os.environ.get('STF_OBS_INCREMENTAL', '0') == '1'
+OBS_TIME_STEP = np.timedelta64(1, 'h')
+_OBS_RANGE_CACHE = {}
+_OBS_RANGE_CACHE_LOCK = threading.Lock()
+
+# how s3 objects are fetched before being opened by xarray:
+#   spool  - streamed in ranged parts to a temporary file in STF_SPOOL_DIR and
+#            opened lazily, so memory is bounded by the part size/concurrency
+#            and STATION_CHUNK_SIZE rather than the file size
+#   memory - downloaded whole into an in-memory buffer
+S3_FETCH_MODE = os.environ.get('STF_S3_FETCH_MODE', 'spool')
+SPOOL_DIR = os.environ.get('STF_SPOOL_DIR', '/tmp')
+S3_PART_SIZE = int(os.environ.get('STF_S3_PART_SIZE', 8 * 1024 * 1024))
+S3_MAX_CONCURRENCY = int(os.environ.get('STF_S3_MAX_CONCURRENCY', 4))
+# stations decoded at a time when building the ingest frames
+STATION_CHUNK_SIZE = int(os.environ.get('STF_STATION_CHUNK_SIZE', 64))
+# streamed forecast ingest: rows are built per chunk of STATION_CHUNK_SIZE
+# stations x LEAD_TIME_CHUNK_SIZE lead times and encoded straight into the
+# COPY stream (see `fc_frames`), so memory is bounded by the chunk sizes
+# rather than the file size. The COPY transaction stays open while the
+# percentiles are computed.
+FC_STREAM = os.environ.get('STF_FC_STREAM', '0') == '1'
+LEAD_TIME_CHUNK_SIZE = int(os.environ.get('STF_LEAD_TIME_CHUNK_SIZE', 240))
+# also store the raw forecast ensemble (compressed) in ENS_TABLE_NAME, see
+# `fc_ens_rows`
+STORE_ENSEMBLE = os.environ.get('STF_STORE_ENSEMBLE', '0') == '1'
+# per file advisory locks so that concurrent invocations don't ingest the
+# same (type, catchment, forecast datetime) at once, see `ingest_lock`
+INGEST_LOCK = os.environ.get('STF_INGEST_LOCK', '1') == '1'
+
+# pooled connections, see `get_db_pool`
+DB_POOL_MAX_CONN = int(os.environ.get('STFDB_POOL_MAX_CONN', 4))
+_DB_POOL = None
+_DB_POOL_LOCK = threading.Lock()
+# pooled connections idle for longer than this are checked before they are
+# used, as the database (or the network in between) may have dropped them
+# while the container was frozen between invocations. See `borrow_connection`
+DB_LIVENESS_IDLE_SECS = int(os.environ.get('STFDB_LIVENESS_IDLE_SECS', 60))
+_DB_LAST_USED = {}
+
+# s3 client, created on first use and reused by warm invocations, see
+# `get_s3_client`
+_S3_CLIENT = None
+_S3_CLIENT_LOCK = threading.Lock()
+
+# stage metrics (see `stf_metrics`) are printed to stdout in CloudWatch
+# embedded metric format by default, so they show up as metrics per stage.
+# 'json' for plain json lines, 'off' to disable.
+METRICS_FORMAT = os.environ.get('STF_METRICS_FORMAT', 'emf')
+if METRICS_FORMAT != 'off':
+    stf_metrics.configure(sys.stdout, emf=METRICS_FORMAT == 'emf')
+
+# cold/warm start tracking, see `lambda_handler`
+_LOADED_AT = time.time()
+_INVOCATIONS = 0
+
+# records in an event batch ingested concurrently. Each record holds one
+# pooled connection at a time (plus one for its lock with INGEST_LOCK) so
+# this is capped by DB_POOL_MAX_CONN.
+RECORD_CONCURRENCY = int(os.environ.get('STF_RECORD_CONCURRENCY', 2))
+
 # --- func ---
 
 def lambda_handler(event, context):
-    if not event['Records'][0]['eventName'].startswith('ObjectCreated'):
-        LOGGER.error("Only s3:ObjectCreated* events supported")
-        return
+    """
+        Ingests every S3 record in the event, delivered either directly by S3
+        or batched through SQS (each message body being an S3 event). Records
+        are processed by up to RECORD_CONCURRENCY threads, which share the
+        metadata cache and db connection pool.
+
+        Returns the per-record results. For SQS, failed messages are listed in
+        `batchItemFailures` (requires ReportBatchItemFailures on the event
+        source mapping) so only those are retried. So are records whose file
+        is being ingested by another invocation (see `ingest_lock`), unless
+        it's the same object in which case they are skipped. Otherwise the invocation
+        fails if any record failed so that it is retried, records that were
+        already ingested are then skipped through the manifest.
+
+        The s3 client, db connection pool and metadata cache are module level
+        so warm invocations reuse them. Whether this was a cold start and how
+        long setting them up took is logged and returned under `invocation`.
+    """
+    global _INVOCATIONS
+    start_t = time.time()
+    _INVOCATIONS += 1
+    cold_start = _INVOCATIONS == 1
+    LOGGER.info('Connection={}'.format(STFDB_CONNECTION))
 
-    bucket = event['Records'][0]['s3']['bucket']['name']
-    s3_file = event['Records'][0]['s3']['object']['key']
+    setup_t = warm_up()
+    LOGGER.info('{} start (invocation {}, container up {:.0f}s): setup took '
+        '{:.3f}s'.format('cold' if cold_start else 'warm', _INVOCATIONS,
+            start_t - _LOADED_AT, setup_t))
+
+    records = list(s3_records(event))
+    connections_per_record = 2 if INGEST_LOCK else 1
+    n_workers = max(1, min(RECORD_CONCURRENCY,
+        DB_POOL_MAX_CONN // connections_per_record, len(records)))
+    with concurrent.futures.ThreadPoolExecutor(n_workers) as executor:
+        results = list(executor.map(ingest_record, [r for _, r in records]))
+
+    failed = set()
+    for (message_id, _), result in zip(records, results):
+        if message_id is not None:
+            result['message_id'] = message_id
+        # in flight records are retried later, by when the other invocation
+        # has finished with the file
+        if result['status'] in ['failed', 'in_flight']:
+            failed.add(message_id)
 
-    LOGGER.info('Connection={}'.format(STFDB_CONNECTION))
-    LOGGER.info('Bucket={}'.format(bucket))
+    delta_t = time.time() - start_t
+    LOGGER.info('processed {} records in {:.2f}s ({} start): {}'.format(
+        len(results), delta_t, 'cold' if cold_start else 'warm', {
+            s: sum(r['status'] == s for r in results)
+            for s in ['ingested', 'skipped', 'ignored', 'in_flight', 'failed']
+        }))
+
+    response = {
+        'results': results,
+        'invocation': {
+            'cold_start': cold_start,
+            'setup_seconds': round(setup_t, 3),
+            'seconds': round(delta_t, 3)
+        }
+    }
+    if any(message_id is not None for message_id, _ in records):
+        response['batchItemFailures'] = [
+            {'itemIdentifier': message_id} for message_id in sorted(failed)
+        ]
+    elif failed:
+        retry = [r['key'] for r in results
+            if r['status'] in ['failed', 'in_flight']]
+        raise RuntimeError('failed to ingest {} of {} records: {}'.format(
+            len(retry), len(results), retry))
+    return response
+
+
+def warm_up():
+    """
+        Creates the s3 client and db connection pool if this container
+        doesn't have them yet (i.e. on a cold start) and checks that the
+        pooled connection is still alive. Returns the time taken.
+
+        A database that can't be reached is only logged here, the records
+        then fail (and are reported) individually.
+    """
+    start_t = time.time()
+    get_s3_client()
+    try:
+        with db_connection():
+            pass
+    except psycopg2.Error as e:
+        LOGGER.warning('could not connect to the database: {}'.format(e))
+    return time.time() - start_t
 
 
+def s3_records(event):
+    """
+        Yields (sqs message id or None, s3 event record) for every S3 record
+        in the event.
+    """
+    for record in event.get('Records', []):
+        if record.get('eventSource') == 'aws:sqs':
+            # s3:TestEvent messages have no records
+            body = json.loads(record['body'])
+            for s3_record in body.get('Records', []):
+                yield record['messageId'], s3_record
+        else:
+            yield None, record
+
+
+def ingest_record(record):
+    """
+        Ingests the object of a single S3 event record. Returns a summary
+        dict, errors are logged and reported in it rather than raised. It
+        includes the time spent in each stage (see `stf_metrics.summarize`).
+    """
+    start_time = time.time()
+    s3_object = record['s3']['object']
+    # keys are url encoded in s3 events
+    s3_file = urllib.parse.unquote_plus(s3_object['key'])
+    result = {'key': s3_file, 'status': 'ignored', 'n_rows': 0, 'error': None}
+
+    with stf_metrics.context(file=s3_file) as spans:
+        try:
+            result['status'], result['n_rows'] = _ingest_record(
+                record, s3_file)
+        except Exception as e:
+            LOGGER.exception("failed to ingest {}".format(s3_file))
+            result['status'] = 'failed'
+            result['error'] = repr(e)
+    result['seconds'] = time.time() - start_time
+    result['stages'] = stf_metrics.summarize(spans)
+
+    return result
+
+
+def _ingest_record(record, s3_file):
+    if not record['eventName'].startswith('ObjectCreated'):
+        LOGGER.error("Only s3:ObjectCreated* events supported")
+        return 'ignored', 0
+
+    bucket = record['s3']['bucket']['name']
+    s3_object = record['s3']['object']
+
+    LOGGER.info('Bucket={} Key={}'.format(bucket, s3_file))
+
     if os.path.splitext(s3_file)[1] != '.nc':
         LOGGER.error("Incorrect file format. required *.nc")
-        return
-    else:
-        if 'Observed-Flow' in s3_file:
-            f = get_ds_s3(bucket, s3_file)
+        return 'ignored', 0
 
+    if 'Observed-Flow' in s3_file:
+        stf_type, ingest_func = 'obs_flow', ingest_obs
+    elif 'Forecast-Flow' in s3_file:
+        stf_type, ingest_func = 'fc_flow', ingest_fc
+    else:
+        LOGGER.error("Invalid stf netcdf filename")
+        return 'ignored', 0
+
+    # duplicate/retried s3 events for an object that has already been
+    # ingested are skipped. ETag stands in for the checksum.
+    etag = s3_object.get('eTag')
+    file_size = s3_object.get('size')
+    use_manifest = etag is not None and file_size is not None
+    if not use_manifest:
+        LOGGER.warning("no eTag/size in event, not using ingest manifest")
+
+    with ingest_lock(stf_type, s3_file) as acquired:
+        if acquired:
+            return _ingest_locked_record(
+                bucket, s3_file, stf_type, ingest_func, file_size, etag,
+                use_manifest)
+
+    if (use_manifest and
+            manifest_status(s3_file, file_size, etag) == 'in_progress'):
+        LOGGER.info("already being ingested, skipping: {}".format(s3_file))
+        return 'skipped', 0
+    LOGGER.warning("being ingested by another invocation: {}".format(s3_file))
+    return 'in_flight', 0
+
+
+def _ingest_locked_record(
+        bucket, s3_file, stf_type, ingest_func, file_size, etag, use_manifest):
+    if use_manifest and manifest_is_complete(s3_file, file_size, etag):
+        LOGGER.info("already ingested, skipping: {}".format(s3_file))
+        return 'skipped', 0
+
+    if use_manifest:
+        manifest_start(s3_file, stf_type, file_size, etag)
+    try:
+        with open_s3_object(bucket, s3_file) as f:
             # TODO: remove in prod
             # This is set late to avoid getting the boto junk but still get
             # debug for xarray stuff
             LOGGER.setLevel(logging.DEBUG)
 
-            ingest_obs(f, s3_file)
-        elif 'Forecast-Flow' in s3_file:
-            f = get_ds_s3(bucket, s3_file)
+            n_rows = ingest_func(f, s3_file)
+    except Exception:
+        if use_manifest:
+            manifest_finish(s3_file, 'failed')
+        raise
+    if use_manifest:
+        manifest_finish(s3_file, 'complete', n_rows)
 
-            # TODO: remove in prod
-            # This is set late to avoid getting the boto junk but still get
-            # debug for xarray stuff
-            LOGGER.setLevel(logging.DEBUG)
+    return 'ingested', n_rows
 
-            ingest_fc(f, s3_file)
-        else:
-            LOGGER.error("Invalid stf netcdf filename")
-            return
+
+@contextlib.contextmanager
+def open_s3_object(bucket, key):
+    """
+        Yields something `xr.open_dataset` can read for the s3 object,
+        depending on S3_FETCH_MODE: the path to a spooled temporary file
+        (removed on exit) or an in-memory buffer.
+    """
+    if S3_FETCH_MODE == 'memory':
+        yield get_ds_s3(bucket, key)
+        return
+
+    path = spool_s3(bucket, key)
+    try:
+        yield path
+    finally:
+        os.remove(path)
+
+
+def get_s3_client():
+    """
+        S3 client shared by every record and warm invocation. Clients are
+        thread safe but creating them (and their session) isn't, hence the
+        lock.
+    """
+    global _S3_CLIENT
+    with _S3_CLIENT_LOCK:
+        if _S3_CLIENT is None:
+            session = boto3.Session()
+            _S3_CLIENT = session.client('s3', region_name=AWS_REGION,
+                config=Config( s3={'addressing_style': 'path'}))
+        return _S3_CLIENT
 
 
 def get_ds_s3(bucket, key):
     # TODO: use `s3fs` instead of this as it may handle things better
-    start_t = time.time()
-
-    session = boto3.Session()
-    s3 = session.client('s3', region_name=AWS_REGION,
-        config=Config( s3={'addressing_style': 'path'}))
+    with stf_metrics.span('download', mode='memory') as s:
+        s3 = get_s3_client()
 
-    nc_buffer = io.BytesIO()
-    s3.download_fileobj(bucket, key, nc_buffer)
-    nc_buffer.seek(0)
+        nc_buffer = io.BytesIO()
+        s3.download_fileobj(bucket, key, nc_buffer)
+        nc_buffer.seek(0)
+        s.n_bytes = nc_buffer.getbuffer().nbytes
 
-    delta_t = time.time() - start_t
     LOGGER.info("Successfully retrieved dataset from S3.")
-    LOGGER.info("--- [get_ds_s3] time taken: {:.2f}s ---".format(delta_t))
+    LOGGER.info("--- [get_ds_s3] time taken: {:.2f}s ---".format(s.ms / 1000))
 
     return nc_buffer
 
 
-def ingest_fc(f_obj, fn):
-    # decode_times = False because "hours since time of forecast" is not
-    # recognizable
-    start_time = time.time()
+def spool_s3(bucket, key):
+    """
+        Streams the s3 object to a temporary file in SPOOL_DIR using ranged
+        GETs of S3_PART_SIZE bytes and returns its path. The caller is
+        responsible for removing the file.
+    """
+    transfer_config = TransferConfig(
+        multipart_threshold=S3_PART_SIZE,
+        multipart_chunksize=S3_PART_SIZE,
+        max_concurrency=S3_MAX_CONCURRENCY)
 
-    with xr.open_dataset(f_obj, decode_times=False) as ds:
-        # q_fcast_ens - variable name for ensemble forecast flow
-        da_fc = ds['q_fcast_ens']
+    fd, path = tempfile.mkstemp(suffix='.nc', dir=SPOOL_DIR)
+    try:
+        with stf_metrics.span('download', mode='spool') as s, \
+                os.fdopen(fd, 'wb') as f:
+            get_s3_client().download_fileobj(
+                bucket, key, f, Config=transfer_config)
+            s.n_bytes = f.tell()
+    except Exception:
+        os.remove(path)
+        raise
 
-        # station_id actually refers to the node_id. We will extract the actual
-        # station_id = awrc_id from the metadata later.
-        da_nodes = ds['station_id']
+    LOGGER.info("Successfully spooled dataset from S3 to {}.".format(path))
+    LOGGER.info("--- [spool_s3] time taken: {:.2f}s ---".format(s.ms / 1000))
 
+    return path
+
+
+def ingest_fc(f_obj, fn):
+    # decode_times = False because "hours since time of forecast" is not
+    # recognizable
+    with stf_metrics.span('decode'):
+        ds = xr.open_dataset(f_obj, decode_times=False)
+    with ds:
         # forecast_start_time / catchment
         fc_dt, catchment = get_filename_info(fn)
         LOGGER.info('processing FORECAST flow for: {} @ {}'.format(
             catchment, fc_dt))
 
-        for s in da_nodes.station:
-            node_id = da_nodes.sel(station=s).item()
-            LOGGER.debug('processing outlet_node={}...'.format(node_id))
+        if FC_STREAM:
+            LOGGER.debug('streaming to timescaledb...')
+            n_rows = ingest_fc_stream(ds, fc_dt, catchment)
+        else:
+            df_ingest = fc_frame(ds, fc_dt, catchment)
 
-            da_sel = da_fc.sel(station=s)
+            LOGGER.debug('ingesting to timescaledb...')
+            n_rows = ingest_fc_to_db(df_ingest)
 
-            # compute quantiles
-            LOGGER.debug('  computing quantiles...')
-            df_ingest = quantiles(da_sel)
+        if STORE_ENSEMBLE:
+            ingest_fc_ens_to_db(fc_ens_rows(ds, fc_dt, catchment))
 
-            # populate forecast hour
-            df_ingest['fc_datetime'] = fc_dt
+    return n_rows
 
-            LOGGER.debug('  getting meta_id from db...')
-            # meta_id is the primary key for the metadata table containing
-            # the appropriate station information (including awrc_id)
-            meta_id = get_station_pk(node_id, catchment)
-            if meta_id is None:
-                continue
-            df_ingest['meta_id'] = meta_id
-            LOGGER.debug('  meta_id={}'.format(meta_id))
 
-            LOGGER.debug('  preparing dataframe...')
-            # drop/rename/order columns to match database
-            df_ingest.drop(columns='time', inplace=True)
-            df_ingest.rename(
-                columns={'lead_time': 'lead_time_hours'}, inplace=True)
+@stf_metrics.timed('frame')
+def fc_frame(ds, fc_dt, catchment):
+    """
+        Builds the stf_fc_flow rows for every station in a forecast dataset
+        (see `fc_frames`).
+    """
+    return pd.concat(list(fc_frames(ds, fc_dt, catchment)), ignore_index=True)
+
+
+def fc_frames(ds, fc_dt, catchment):
+    """
+        Returns a generator of stf_fc_flow rows, one frame per chunk of
+        STATION_CHUNK_SIZE stations x LEAD_TIME_CHUNK_SIZE lead times.
+        Percentiles are computed in a single pass per chunk (see `quantiles`),
+        so with a lazily opened dataset only one chunk of the ensemble is
+        decoded at a time.
+
+        The station metadata is looked up straight away rather than when the
+        first chunk is read.
+    """
+    # station_id actually refers to the node_id. We will extract the actual
+    # station_id = awrc_id from the metadata later.
+    node_ids = ds['station_id'].values
 
-            LOGGER.debug('  ingesting to timescaledb...')
-            ingest_fc_to_db(df_ingest)
+    LOGGER.debug('getting meta_ids from db...')
+    meta_ids = station_meta_ids(node_ids, catchment)
 
-    delta_t = time.time() - start_time
-    LOGGER.debug('Time taken - FORECAST flow - {} @ {}: {:.2f}s'.format(
-        catchment, fc_dt, delta_t))
+    LOGGER.debug('computing quantiles for {} stations...'.format(
+        len(node_ids)))
+    return _fc_frames(ds, fc_dt, meta_ids)
+
+
+def _fc_frames(ds, fc_dt, meta_ids):
+    n_lead_times = ds.sizes['lead_time']
+    for chunk in station_chunks(len(meta_ids)):
+        for lead_chunk in dim_chunks(n_lead_times, LEAD_TIME_CHUNK_SIZE):
+            # q_fcast_ens - variable name for ensemble forecast flow
+            df = quantiles(ds['q_fcast_ens'].isel(
+                station=chunk, lead_time=lead_chunk))
+            df['meta_id'] = meta_ids[chunk][df['station'].values]
+            df = df[df['meta_id'] >= 0]
+
+            # populate forecast hour, drop/rename columns to match database
+            df = df.drop(columns=['station', 'time'])
+            df = df.rename(columns={'lead_time': 'lead_time_hours'})
+            df['fc_datetime'] = fc_dt
+            yield df
 
 
 def ingest_obs(f_obj, fn):
@@ -154,120 +510,463 @@ def ingest_obs(f_obj, fn):
         similar to ingest_fc but has different variable mapping and subtleties
         so didn't combine it into one function
     """
-    start_time = time.time()
-
     # obs doesn't have reference to "hours since time of forecast" so we can
     # decode normally
-    with xr.open_dataset(f_obj) as ds:
-        # q_der - variable name for observed flow
-        da_obs = ds['q_der']
-        da_nodes = ds['station_id']
+    with stf_metrics.span('decode'):
+        ds = xr.open_dataset(f_obj)
+    with ds:
         fc_dt, catchment = get_filename_info(fn)
         LOGGER.info('processing OBSERVED flow for: {} @ {}'.format(
             catchment, fc_dt))
 
-        for s in da_nodes.station:
-            node_id = da_nodes.sel(station=s).item()
-            LOGGER.debug('processing outlet_node={}...'.format(node_id))
+        df_ingest = obs_frame(ds, catchment)
+
+        LOGGER.debug('ingesting to timescaledb...')
+        n_rows = ingest_obs_to_db(df_ingest)
+
+    return n_rows
+
+
+@stf_metrics.timed('frame')
+def obs_frame(ds, catchment, incremental=None):
+    """
+        Builds the stf_obs_flow rows for every station in an observed flow
+        dataset. No preprocessing is required so the values are just unrolled
+        into long form, STATION_CHUNK_SIZE stations at a time.
+
+        Each file repeats a long observed history, so with OBS_INCREMENTAL
+        only timestamps outside the range already stored for the station are
+        kept. Stations with gaps in the stored range (e.g. files that went in
+        out of order) get every row, so the gaps are filled. Values that
+        changed within the stored range aren't sent as they wouldn't be
+        updated anyway.
+        `incremental` overrides OBS_INCREMENTAL.
+    """
+    if incremental is None:
+        incremental = OBS_INCREMENTAL
+    node_ids = ds['station_id'].values
+    obs_datetime = ds['time'].values.astype('datetime64[ns]')
+
+    LOGGER.debug('getting meta_ids from db...')
+    meta_ids = station_meta_ids(node_ids, catchment)
+
+    if incremental:
+        # NaT where nothing is stored yet, so that every row is kept
+        ranges = get_obs_ranges(meta_ids[meta_ids >= 0])
+        first = np.full(len(meta_ids), np.datetime64('NaT'), 'datetime64[ns]')
+        last = first.copy()
+        for i, meta_id in enumerate(meta_ids):
+            if ranges.get(meta_id) is not None:
+                first[i], last[i] = ranges[meta_id]
+
+    LOGGER.debug('preparing dataframe...')
+    frames = []
+    n_total = 0
+    for chunk in station_chunks(len(node_ids)):
+        # q_der - variable name for observed flow
+        da_obs = ds['q_der'].isel(station=chunk).transpose('station', 'time')
+        keep = np.repeat(meta_ids[chunk] >= 0, len(obs_datetime))
+        if incremental:
+            is_new = ~(
+                (obs_datetime[None, :] >= first[chunk, None])
+                & (obs_datetime[None, :] <= last[chunk, None]))
+            keep &= is_new.ravel()
+        values = da_obs.values.ravel()
+        n_total += len(values)
+        frames.append(pd.DataFrame({
+            'obs_datetime': np.tile(obs_datetime, da_obs.sizes['station'])[keep],
+            'meta_id': np.repeat(meta_ids[chunk], len(obs_datetime))[keep],
+            'value': values[keep]
+        }))
+
+    df = pd.concat(frames, ignore_index=True)
+    LOGGER.debug('{} of {} observed values to send'.format(len(df), n_total))
+    return df
 
-            da_sel = da_obs.sel(station=s)
-            # can convert directly dataframe since no preprocessing actually
-            # required
-            df_ingest = da_sel.to_dataframe().reset_index()
 
-            LOGGER.debug('getting meta_id from db...')
-            # meta_id is the primary key for the metadata table containing
-            # the appropriate station information (including awrc_id)
-            meta_id = get_station_pk(node_id, catchment)
-            if meta_id is None:
+def fc_ens_rows(ds, fc_dt, catchment):
+    """
+        Rows for ENS_TABLE_NAME: the (lead_time, ens_member) array of every
+        station with metadata, encoded with `encode_ens`. Decoded a chunk of
+        STATION_CHUNK_SIZE stations at a time.
+    """
+    node_ids = ds['station_id'].values
+    meta_ids = station_meta_ids(node_ids, catchment)
+    lead_times = [int(x) for x in ds['lead_time'].values]
+    n_members = ds.sizes['ens_member']
+
+    rows = []
+    for chunk in station_chunks(len(node_ids)):
+        # forecast files have a single time
+        ens = ds['q_fcast_ens'].isel(station=chunk, time=0).transpose(
+            'station', 'lead_time', 'ens_member').values
+        for meta_id, values in zip(meta_ids[chunk], ens):
+            if meta_id < 0:
                 continue
-            df_ingest['meta_id'] = meta_id
+            rows.append((int(meta_id), fc_dt, lead_times, n_members,
+                encode_ens(values)))
+    return rows
 
-            LOGGER.debug('preparing dataframe...')
-            # rename appropriate columns
-            df_ingest.rename(columns={
-                'time': 'obs_datetime', 'q_der': 'value' }, inplace=True)
 
-            LOGGER.debug('ingesting to timescaledb...')
-            ingest_obs_to_db(df_ingest)
+def encode_ens(values):
+    """
+        float32 (little endian) -> byte shuffled -> zlib. Grouping the bytes
+        by significance (exponents together etc.) compresses a lot better
+        than the plain floats. The api has the matching `decode_ens`.
+    """
+    raw = np.ascontiguousarray(values, dtype='<f4').view(np.uint8)
+    return zlib.compress(raw.reshape(-1, 4).T.tobytes())
+
 
-    delta_t = time.time() - start_time
-    LOGGER.debug('Time taken - OBSERVED flow - {} @ {}: {:.2f}s'.format(
-        catchment, fc_dt, delta_t))
+def station_chunks(n_stations):
+    """ Slices along the station dimension, see `dim_chunks` """
+    return dim_chunks(n_stations, STATION_CHUNK_SIZE)
+
+
+def dim_chunks(n, chunk_size):
+    """
+        Slices of at most chunk_size along a dimension of length n. Always
+        yields at least one (possibly empty) slice so that the resulting
+        frames have their columns.
+    """
+    for start in range(0, max(n, 1), chunk_size):
+        yield slice(start, start + chunk_size)
+
+
+@stf_metrics.timed('metadata')
+def station_meta_ids(node_ids, catchment):
+    """
+        meta_id is the primary key for the metadata table containing the
+        appropriate station information (including awrc_id). Returns the
+        meta_id for each node_id, -1 marks stations without metadata.
+    """
+    meta_ids = np.full(len(node_ids), -1, dtype=np.int64)
+    for i, node_id in enumerate(node_ids):
+        meta_id = get_station_pk(node_id, catchment)
+        if meta_id is not None:
+            meta_ids[i] = meta_id
+    return meta_ids
 
 
-# TODO: Maybe combine this with COPY e.g. do INSERT instead so it's all in one
-# connection/transaction
 def get_station_pk(node_id, catchment):
-    with psycopg2.connect(STFDB_CONNECTION) as con:
-        with con.cursor() as cur:
-            query = """
-                SELECT pk_meta FROM stf_metadata
-                WHERE outlet_node = {} AND catchment = '{}'
-            """.format(node_id, catchment)
-            cur.execute(query)
-            station_pk = cur.fetchall()
-    if len(station_pk) == 1:
-        station_pk = station_pk[0][0]
-    elif len(station_pk) == 0:
+    station_pks = get_station_pks(catchment)
+    if node_id not in station_pks:
         LOGGER.warning("metadata not found for catchment:node={}:{}".format(
             catchment, node_id))
         return None
+    # None if there were multiple ids (already logged when loading)
+    return station_pks[node_id]
+
+
+def get_station_pks(catchment, refresh=False):
+    """
+        Returns {outlet_node: pk_meta} for every station in the catchment.
+
+        The mapping is loaded with a single query and kept in a process level
+        cache for META_CACHE_TTL seconds, so subsequent files (or warm lambda
+        invocations) for the same catchment don't hit the database. Safe to
+        call from multiple threads.
+    """
+    cached = _META_CACHE.get(catchment)
+    if (not refresh and cached is not None
+            and time.time() - cached[0] < META_CACHE_TTL):
+        return cached[1]
+
+    # only one thread loads a catchment, the others wait and use its result
+    with _META_CACHE_LOCK:
+        cached = _META_CACHE.get(catchment)
+        if (not refresh and cached is not None
+                and time.time() - cached[0] < META_CACHE_TTL):
+            return cached[1]
+        return _load_station_pks(catchment)
+
+
+def _load_station_pks(catchment):
+    LOGGER.debug('loading metadata for catchment={}...'.format(catchment))
+    with db_connection() as con:
+        with con.cursor() as cur:
+            cur.execute(
+                """
+                    SELECT outlet_node, pk_meta FROM stf_metadata
+                    WHERE catchment = %s
+                """, (catchment,))
+            rows = cur.fetchall()
+
+    station_pks = {}
+    for node_id, pk_meta in rows:
+        if node_id in station_pks:
+            LOGGER.error(
+                "multiple ids found for catchment:node={}:{}. ids={}".format(
+                    catchment, node_id, [station_pks[node_id], pk_meta]))
+            pk_meta = None
+        station_pks[node_id] = pk_meta
+
+    _META_CACHE[catchment] = (time.time(), station_pks)
+    return station_pks
+
+
+def invalidate_meta_cache(catchment=None):
+    """
+        Drops the cached metadata for `catchment` (or all catchments), e.g.
+        after stf_metadata has been updated.
+    """
+    if catchment is None:
+        _META_CACHE.clear()
     else:
-        LOGGER.error("multiple ids found for catchment:node={}:{}. ids={}".format(
-            catchment, node_id, station_pk))
-        return None
-    return station_pk
+        _META_CACHE.pop(catchment, None)
+
+
+def get_obs_ranges(meta_ids):
+    """
+        Returns {meta_id: (first, last) obs_datetime stored or None} as naive
+        UTC datetime64. None if nothing is stored, or if the stored rows don't
+        cover every OBS_TIME_STEP from first to last, as only a complete range
+        can be skipped. Looked up with one scan per station and cached for
+        META_CACHE_TTL seconds, the cache is extended as rows are ingested
+        (see `update_obs_range_cache`).
+    """
+    now = time.time()
+    with _OBS_RANGE_CACHE_LOCK:
+        missing = [int(m) for m in meta_ids
+            if m not in _OBS_RANGE_CACHE
+                or now - _OBS_RANGE_CACHE[m][0] >= META_CACHE_TTL]
+
+    if missing:
+        LOGGER.debug('loading obs ranges for {} stations...'.format(
+            len(missing)))
+        with db_connection() as con:
+            with con.cursor() as cur:
+                cur.execute(
+                    """
+                        SELECT m.meta_id, r.first, r.last, r.n
+                        FROM unnest(%s::int[]) AS m(meta_id)
+                        CROSS JOIN LATERAL (
+                            SELECT min(obs_datetime) AS first,
+                                max(obs_datetime) AS last, count(*) AS n
+                            FROM {}
+                            WHERE meta_id = m.meta_id
+                        ) r
+                    """.format(OBS_TABLE_NAME), (missing,))
+                rows = cur.fetchall()
+        with _OBS_RANGE_CACHE_LOCK:
+            for meta_id, first, last, n in rows:
+                if first is None:
+                    _OBS_RANGE_CACHE[meta_id] = (now, None)
+                    continue
+                first, last = _to_datetime64(first), _to_datetime64(last)
+                _OBS_RANGE_CACHE[meta_id] = (
+                    now, (first, last, n == obs_steps(first, last)))
+
+    with _OBS_RANGE_CACHE_LOCK:
+        ranges = {m: _OBS_RANGE_CACHE[m][1] for m in meta_ids}
+    return {m: r[:2] if r is not None and r[2] else None
+        for m, r in ranges.items()}
+
+
+def obs_steps(first, last):
+    """ Number of OBS_TIME_STEP timestamps from first to last (inclusive) """
+    return int((last - first) // OBS_TIME_STEP) + 1
+
+
+def obs_ranges(df):
+    """ (first, last, number of rows) per meta_id in an obs frame """
+    g = df.groupby('meta_id')['obs_datetime']
+    return {
+        meta_id: (first.to_datetime64(), last.to_datetime64(), int(n))
+        for meta_id, first, last, n in zip(
+            g.min().index, g.min(), g.max(), g.size())
+    }
 
 
+def update_obs_range_cache(ranges):
+    """
+        Extends the cached ranges with rows that have just been committed.
+        Stations that aren't cached are left to be looked up, as are stations
+        where the new rows don't overlap or touch the cached range (merging
+        them would hide the gap in between).
+    """
+    with _OBS_RANGE_CACHE_LOCK:
+        for meta_id, (first, last, n) in ranges.items():
+            cached = _OBS_RANGE_CACHE.get(meta_id)
+            if cached is None:
+                continue
+            load_time, stored = cached
+            if stored is None:
+                complete = n == obs_steps(first, last)
+            elif (first > stored[1] + OBS_TIME_STEP
+                    or last < stored[0] - OBS_TIME_STEP):
+                del _OBS_RANGE_CACHE[meta_id]
+                continue
+            else:
+                # still complete if the new rows are every step of the
+                # merged range outside the stored one, i.e. an incremental
+                # frame of a complete file. A full frame also counts rows
+                # inside the stored range, so it's treated as having gaps
+                # until the next lookup
+                stored_first, stored_last, complete = stored
+                first = min(first, stored_first)
+                last = max(last, stored_last)
+                complete = complete and n == (obs_steps(first, last)
+                    - obs_steps(stored_first, stored_last))
+            _OBS_RANGE_CACHE[meta_id] = (load_time, (first, last, complete))
+
+
+def invalidate_obs_range_cache():
+    """ e.g. after rows have been deleted from stf_obs_flow """
+    with _OBS_RANGE_CACHE_LOCK:
+        _OBS_RANGE_CACHE.clear()
+
+
+def _to_datetime64(dt):
+    return pd.Timestamp(dt).tz_convert(None).to_datetime64()
+
+
+@stf_metrics.timed('quantile')
 def quantiles(da):
     """
-        Hack: I couldn't find a nice way of setting the output names of the
-        columns after doing the quantile aggregations.
-        - in sql you can use e.g. `percentile_cont(0.25) AS pctl_25`
+        Computes every percentile in `PCTL_MAP` over the ensemble members for
+        all stations and lead times with a single `np.quantile` call, instead
+        of a pandas groupby per station.
 
         This is effectively:
         ```sql
         SELECT (
+           station,
            lead_time,
+           time,
            percentile_cont(0.05) WITHIN GROUP (ORDER BY value) AS pctl_5,
-           percentile_cont(0.50) WITHIN GROUP (ORDER BY value) AS pctl_25,
-           percentile_cont(0.25) WITHIN GROUP (ORDER BY value) AS pctl_50,
+           percentile_cont(0.25) WITHIN GROUP (ORDER BY value) AS pctl_25,
+           percentile_cont(0.50) WITHIN GROUP (ORDER BY value) AS pctl_50,
            percentile_cont(0.75) WITHIN GROUP (ORDER BY value) AS pctl_75,
            percentile_cont(0.95) WITHIN GROUP (ORDER BY value) AS pctl_95
         ) FROM df
-        GROUP_BY lead_time
+        GROUP_BY station, lead_time, time
         ```
-    """
 
-    q_dict = {
-        'pctl_5': 0.05,
-        'pctl_25': 0.25,
-        'pctl_50': 0.50,
-        'pctl_75': 0.75,
-        'pctl_95': 0.95
+        Returns a long-form dataframe with one row per station/lead_time/time.
+        `station` is the positional index along the station dimension.
+    """
+    # put ens_member last so that the reduction is over the innermost axis
+    da = da.transpose('station', 'lead_time', 'time', 'ens_member')
+
+    # shape: (pctl, station, lead_time, time)
+    q = np.quantile(da.values, list(PCTL_MAP.values()), axis=-1)
+
+    station, lead_time, fc_time = np.meshgrid(
+        np.arange(da.sizes['station']),
+        da['lead_time'].values,
+        da['time'].values,
+        indexing='ij'
+    )
+    columns = {
+        'station': station.ravel(),
+        'lead_time': lead_time.ravel(),
+        'time': fc_time.ravel()
     }
-    qtl_funcs = []
-
-    # create set of precentile agg functions
-    for k in q_dict:
-        f = functools.partial(np.quantile, q=q_dict[k])
-        f.__name__ = k
-        qtl_funcs.append(f)
-
-    # perform agg over created functions
-    # - drops ens_member as it is not required
-    df = (da.to_dataframe()
-            .reset_index()
-            .drop(columns="ens_member")
-            .groupby(["lead_time", "time"])
-            .agg(qtl_funcs))
-
-    # cleanup indices
-    df.columns = df.columns.droplevel()
-    df.reset_index(inplace=True)
+    for k, v in zip(PCTL_MAP, q):
+        columns[k] = v.ravel()
 
-    return df
+    return pd.DataFrame(columns)
+
+
+def manifest_is_complete(filename, file_size, checksum):
+    """
+        True if the file has already been ingested successfully with the same
+        size and checksum.
+    """
+    return manifest_status(filename, file_size, checksum) == 'complete'
+
+
+def manifest_status(filename, file_size, checksum):
+    """
+        Status of the manifest entry for the file if it has the same size and
+        checksum, otherwise None.
+    """
+    with db_connection() as con:
+        with con.cursor() as cur:
+            cur.execute(
+                """
+                    SELECT status FROM {}
+                    WHERE filename = %s AND file_size = %s AND checksum = %s
+                """.format(MANIFEST_TABLE_NAME),
+                (os.path.basename(filename), file_size, checksum))
+            row = cur.fetchone()
+            return row[0] if row is not None else None
+
+
+@contextlib.contextmanager
+def ingest_lock(stf_type, fn):
+    """
+        Session level advisory lock on the (stf_type, catchment, fc_datetime)
+        of a file, held on a pooled connection while the file is ingested.
+        Yields whether it was acquired, without waiting if another ingest
+        has it. Postgres releases it if the holder's connection dies.
+    """
+    if not INGEST_LOCK:
+        yield True
+        return
+
+    fc_dt, catchment = get_filename_info(fn)
+    key = advisory_lock_key(stf_type, catchment, fc_dt)
+    pool = get_db_pool()
+    con = borrow_connection(pool)
+    try:
+        # the lock outlives the transaction, so nothing is left open
+        with con.cursor() as cur:
+            cur.execute("SELECT pg_try_advisory_lock(%s)", (key,))
+            acquired = cur.fetchone()[0]
+        con.commit()
+        try:
+            yield acquired
+        finally:
+            if acquired and not con.closed:
+                with con.cursor() as cur:
+                    cur.execute("SELECT pg_advisory_unlock(%s)", (key,))
+                con.commit()
+    finally:
+        release_connection(pool, con)
+
+
+def advisory_lock_key(stf_type, catchment, fc_dt):
+    """ Signed 64 bit advisory lock key for a file """
+    name = '{}:{}:{:%Y%m%d%H%M}'.format(stf_type, catchment, fc_dt)
+    digest = hashlib.blake2b(name.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'big', signed=True)
+
+
+def manifest_start(filename, stf_type, file_size, checksum):
+    with db_connection() as con:
+        with con.cursor() as cur:
+            cur.execute(
+                """
+                    INSERT INTO {} (
+                        filename, stf_type, file_size, checksum, status
+                    ) VALUES (%s, %s, %s, %s, 'in_progress')
+                    ON CONFLICT (filename) DO UPDATE SET
+                        stf_type = EXCLUDED.stf_type,
+                        file_size = EXCLUDED.file_size,
+                        checksum = EXCLUDED.checksum,
+                        status = EXCLUDED.status,
+                        row_count = NULL,
+                        started_at = now(),
+                        finished_at = NULL;
+                """.format(MANIFEST_TABLE_NAME),
+                (os.path.basename(filename), stf_type, file_size, checksum))
+
+
+def manifest_finish(filename, status, row_count=None):
+    """
+        status: 'complete' or 'failed'
+    """
+    with db_connection() as con:
+        with con.cursor() as cur:
+            cur.execute(
+                """
+                    UPDATE {} SET
+                        status = %s, row_count = %s, finished_at = now()
+                    WHERE filename = %s;
+                """.format(MANIFEST_TABLE_NAME),
+                (status, row_count, os.path.basename(filename)))
 
 
 def get_filename_info(fn):
@@ -287,16 +986,17 @@ def ingest_obs_to_db(df):
         meta_id      | integer                  | not null |
         value        | double precision         |          |
     """
-    # process dataframe into buffer
-    s_buf = io.StringIO()
+    if df.empty:
+        LOGGER.info('no new observed flow to ingest')
+        return 0
 
-    # order matters
-    df[['obs_datetime', 'meta_id', 'value']].to_csv(
-        s_buf, index=False, na_rep='NULL')
-    s_buf.seek(0)
+    # encode dataframe straight into a binary COPY buffer
+    values_buffer = encode_frame(df, OBS_COLUMNS)
 
     # copy buffer
-    copy_to_db(s_buf, stf_type='obs_flow')
+    n_rows = copy_to_db(values_buffer, stf_type='obs_flow')
+    update_obs_range_cache(obs_ranges(df))
+    return n_rows
 
 
 def ingest_fc_to_db(df):
@@ -310,17 +1010,171 @@ def ingest_fc_to_db(df):
         pctl_75         | double precision         |          |
         pctl_95         | double precision         |          |
     """
-    # process dataframe into buffer
-    s_buf = io.StringIO()
-
-    # order matters
-    df[['fc_datetime', 'lead_time_hours', 'meta_id', 'pctl_5', 'pctl_25',
-        'pctl_50', 'pctl_75', 'pctl_95'
-    ]].to_csv(s_buf, index=False, na_rep='NULL')
-    s_buf.seek(0)
+    # encode dataframe straight into a binary COPY buffer
+    values_buffer = encode_frame(df, FC_COLUMNS)
 
     # copy buffer
-    copy_to_db(s_buf, stf_type='fc_flow')
+    return copy_to_db(values_buffer, stf_type='fc_flow')
+
+
+def encode_frame(df, columns):
+    """ `stf_pgcopy.encode_frame`, timed as the encode stage """
+    with stf_metrics.span('encode', n_rows=len(df)) as s:
+        buf = stf_pgcopy.encode_frame(df, columns)
+        s.n_bytes = buf.getbuffer().nbytes
+    return buf
+
+
+def ingest_fc_ens_to_db(rows):
+    """
+        meta_id         | integer                  | not null |
+        fc_datetime     | timestamp with time zone | not null |
+        lead_time_hours | integer[]                | not null |
+        n_members       | integer                  | not null |
+        ens             | bytea                    | not null |
+    """
+    if not rows:
+        return 0
+    with stf_metrics.span(
+                'ensemble', n_rows=len(rows),
+                n_bytes=sum(len(r[-1]) for r in rows),
+                table=ENS_TABLE_NAME) as s, \
+            db_connection() as con:
+        with con.cursor() as cur:
+            # one row per station so a plain (single statement) insert is
+            # enough here
+            psycopg2.extras.execute_values(
+                cur,
+                """
+                    INSERT INTO {}
+                    (meta_id, fc_datetime, lead_time_hours, n_members, ens)
+                    VALUES %s
+                    ON CONFLICT (meta_id, fc_datetime) DO NOTHING;
+                """.format(ENS_TABLE_NAME), rows, page_size=len(rows))
+            n_rows = cur.rowcount
+            if n_rows > 0:
+                cur.execute(BUMP_VERSION_SQL, (ENS_TABLE_NAME,))
+    LOGGER.info('inserted {} ensembles ({} new) into {} in {:.2f}s'.format(
+        len(rows), n_rows, ENS_TABLE_NAME, s.ms / 1000))
+    return n_rows
+
+
+def ingest_fc_stream(ds, fc_dt, catchment):
+    """
+        Same as `fc_frame` + `ingest_fc_to_db`, but the rows are computed and
+        encoded chunk by chunk as COPY reads them instead of all up front.
+    """
+    values_stream = stf_pgcopy.encode_frames(
+        fc_frames(ds, fc_dt, catchment), FC_COLUMNS)
+    return copy_to_db(values_stream, stf_type='fc_flow')
+
+
+# Daily rollups (see stf_fc_flow_daily/stf_obs_flow_daily in setup_tables.sql)
+# are recomputed from the hourly table for every station/day in the staging
+# table. Lead day d covers lead_time_hours (d - 1) * 24 + 1 .. d * 24.
+FC_ROLLUP_SQL = """
+    INSERT INTO {fc_daily}
+    SELECT
+        f.meta_id, f.fc_datetime, (f.lead_time_hours - 1) / 24 + 1,
+        sum(f.pctl_5), avg(f.pctl_5),
+        sum(f.pctl_25), avg(f.pctl_25),
+        sum(f.pctl_50), avg(f.pctl_50),
+        sum(f.pctl_75), avg(f.pctl_75),
+        sum(f.pctl_95), avg(f.pctl_95)
+    FROM {fc} f
+    JOIN (
+        SELECT DISTINCT meta_id, fc_datetime FROM {{temp_table}}
+    ) k ON f.meta_id = k.meta_id AND f.fc_datetime = k.fc_datetime
+    GROUP BY 1, 2, 3
+    ON CONFLICT (meta_id, fc_datetime, lead_day) DO UPDATE SET
+        pctl_5_sum = EXCLUDED.pctl_5_sum,
+        pctl_5_avg = EXCLUDED.pctl_5_avg,
+        pctl_25_sum = EXCLUDED.pctl_25_sum,
+        pctl_25_avg = EXCLUDED.pctl_25_avg,
+        pctl_50_sum = EXCLUDED.pctl_50_sum,
+        pctl_50_avg = EXCLUDED.pctl_50_avg,
+        pctl_75_sum = EXCLUDED.pctl_75_sum,
+        pctl_75_avg = EXCLUDED.pctl_75_avg,
+        pctl_95_sum = EXCLUDED.pctl_95_sum,
+        pctl_95_avg = EXCLUDED.pctl_95_avg;
+""".format(fc_daily=FC_DAILY_TABLE_NAME, fc=FC_TABLE_NAME)
+
+OBS_ROLLUP_DAYS_SQL = """
+    SELECT DISTINCT
+        meta_id,
+        date_trunc('day', (obs_datetime - INTERVAL '{h} hours')
+            AT TIME ZONE 'UTC') AT TIME ZONE 'UTC'
+            + INTERVAL '{h} hours' AS day_start
+    FROM {{temp_table}}
+""".format(h=ROLLUP_DAY_START_HOUR)
+
+# Observed files of different forecast dates don't share an ingest lock but
+# can add rows to the same days, and each transaction sums a day from its own
+# snapshot. The (meta_id, day) pairs are locked until commit, in order so
+# that ingests can't deadlock (the lock calls are evaluated after the sort),
+# and the rollup then runs in a new snapshot that sees every other ingest of
+# those days that has committed.
+OBS_ROLLUP_LOCK_SQL = """
+    SELECT pg_advisory_xact_lock(
+        meta_id, (extract(epoch FROM day_start) / 86400)::int)
+    FROM ({days}) d
+    ORDER BY meta_id, day_start;
+""".format(days=OBS_ROLLUP_DAYS_SQL)
+
+OBS_ROLLUP_SQL = """
+    WITH days AS ({days})
+    INSERT INTO {obs_daily}
+    SELECT d.meta_id, d.day_start, sum(o.value), avg(o.value)
+    FROM days d
+    JOIN {obs} o ON o.meta_id = d.meta_id
+        AND o.obs_datetime >= d.day_start
+        AND o.obs_datetime < d.day_start + INTERVAL '1 day'
+    GROUP BY 1, 2
+    ON CONFLICT (meta_id, day_start) DO UPDATE SET
+        value_sum = EXCLUDED.value_sum,
+        value_avg = EXCLUDED.value_avg;
+""".format(days=OBS_ROLLUP_DAYS_SQL, obs_daily=OBS_DAILY_TABLE_NAME,
+    obs=OBS_TABLE_NAME)
+
+
+# the api caches responses until the version of the tables they read is
+# bumped (see stf_ingest_version in setup_tables.sql)
+BUMP_VERSION_SQL = """
+    INSERT INTO {0} (table_name, version) VALUES (%s, 1)
+    ON CONFLICT (table_name) DO UPDATE SET
+        version = {0}.version + 1,
+        updated_at = now();
+""".format(VERSION_TABLE_NAME)
+
+
+# Rows are moved from the staging table into the hourly table, and the
+# station catalog (see stf_station_catalog in setup_tables.sql) is updated
+# from the rows that were new in the same statement. Stations are locked in
+# order so that concurrent ingests can't deadlock on their catalog rows.
+INSERT_NEW_ROWS_SQL = """
+    WITH new_rows AS (
+        INSERT INTO {{table}}
+        SELECT * FROM {{temp_table}}
+        ON CONFLICT ({{conflict_cols}}) DO NOTHING
+        RETURNING meta_id, {{datetime_col}}
+    ), catalog AS (
+        INSERT INTO {catalog} AS c (
+            meta_id, {{prefix}}_min_datetime, {{prefix}}_max_datetime,
+            {{prefix}}_count)
+        SELECT meta_id, min({{datetime_col}}), max({{datetime_col}}), count(*)
+        FROM new_rows
+        GROUP BY meta_id
+        ORDER BY meta_id
+        ON CONFLICT (meta_id) DO UPDATE SET
+            {{prefix}}_min_datetime = LEAST(
+                c.{{prefix}}_min_datetime, EXCLUDED.{{prefix}}_min_datetime),
+            {{prefix}}_max_datetime = GREATEST(
+                c.{{prefix}}_max_datetime, EXCLUDED.{{prefix}}_max_datetime),
+            {{prefix}}_count = c.{{prefix}}_count + EXCLUDED.{{prefix}}_count,
+            updated_at = now()
+    )
+    SELECT count(*) FROM new_rows;
+""".format(catalog=CATALOG_TABLE_NAME)
 
 
 def copy_to_db(values_buffer, stf_type, ignore_duplicates=False):
@@ -328,50 +1182,165 @@ def copy_to_db(values_buffer, stf_type, ignore_duplicates=False):
         'fc_flow': {
             'table': FC_TABLE_NAME,
             'temp_table': FC_TABLE_NAME + '_temp',
-            'conflict_col': ['meta_id', 'lead_time_hours', 'fc_datetime']
+            'conflict_col': ['meta_id', 'lead_time_hours', 'fc_datetime'],
+            'datetime_col': 'fc_datetime',
+            'catalog_prefix': 'fc',
+            # forecast days only come from the file's fc_datetime, which
+            # the ingest lock already serializes
+            'rollup_lock': None,
+            'rollup': FC_ROLLUP_SQL
         },
         'obs_flow': {
             'table': OBS_TABLE_NAME,
             'temp_table': OBS_TABLE_NAME + '_temp',
-            'conflict_col': ['meta_id', 'obs_datetime']
+            'conflict_col': ['meta_id', 'obs_datetime'],
+            'datetime_col': 'obs_datetime',
+            'catalog_prefix': 'obs',
+            'rollup_lock': OBS_ROLLUP_LOCK_SQL,
+            'rollup': OBS_ROLLUP_SQL
         }
     }
     assert stf_type in stf_table_map.keys()
     d = stf_table_map[stf_type]
 
-    # transaction to copy data
-    # TODO: error handling?
-    with psycopg2.connect(STFDB_CONNECTION) as con:
+    # single transaction to copy data, rolled back on error. The span
+    # includes the commit
+    with stf_metrics.span('copy', table=d['table']) as s, \
+            db_connection() as con:
         with con.cursor() as cur:
             if ignore_duplicates:
                 cur.copy_expert(
                     """
-                        COPY {} FROM STDIN
-                        WITH CSV HEADER DELIMITER ',' NULL 'NULL'
+                        COPY {} FROM STDIN WITH (FORMAT binary)
                     """.format(d['table']), values_buffer
                 )
-                con.commit()
+                n_copied = n_rows = cur.rowcount
             else:
-                # create temporary table (and delete on commit)
+                # staging table lives as long as the (pooled) connection, and
+                # is emptied on commit so it can be reused by the next file
                 cur.execute(
                     """
-                        CREATE TEMP TABLE {} (LIKE {}) ON COMMIT DROP;
+                        CREATE TEMP TABLE IF NOT EXISTS {} (LIKE {})
+                        ON COMMIT DELETE ROWS;
                     """.format(d['temp_table'], d['table'])
                 )
                 # copy dataframe into temporary table
                 cur.copy_expert(
                     """
-                        COPY {} FROM STDIN
-                        WITH CSV HEADER DELIMITER ',' NULL 'NULL'
+                        COPY {} FROM STDIN WITH (FORMAT binary)
                     """.format(d['temp_table']), values_buffer)
-                # insert into main table with unique time/meta_id
-                conflict_col_str = ', '.join(d['conflict_col'])
-                cur.execute(
-                    """
-                        INSERT INTO {}
-                        SELECT * FROM {}
-                        ON CONFLICT ({}) DO NOTHING;
-                    """.format(d['table'], d['temp_table'], conflict_col_str)
-                )
-                con.commit()
+                n_copied = cur.rowcount
+                # insert into main table with unique time/meta_id, and
+                # update the station catalog with the new rows
+                cur.execute(INSERT_NEW_ROWS_SQL.format(
+                    table=d['table'],
+                    temp_table=d['temp_table'],
+                    conflict_cols=', '.join(d['conflict_col']),
+                    datetime_col=d['datetime_col'],
+                    prefix=d['catalog_prefix']
+                ))
+                n_rows = cur.fetchone()[0]
+                # recompute the daily rollups touched by this file in the
+                # same transaction, see OBS_ROLLUP_LOCK_SQL for concurrent
+                # ingests. (ignore_duplicates copies straight into the table
+                # so the rollups and the catalog need to be repopulated
+                # afterwards, see setup_tables.sql)
+                if n_rows > 0:
+                    if d['rollup_lock'] is not None:
+                        cur.execute(d['rollup_lock'].format(
+                            temp_table=d['temp_table']))
+                    cur.execute(d['rollup'].format(temp_table=d['temp_table']))
+            # last, as the version row stays locked until commit
+            if n_rows > 0:
+                cur.execute(BUMP_VERSION_SQL, (d['table'],))
+        s.n_rows = n_copied
+        s.n_bytes = values_buffer.tell()
+        s.fields['new_rows'] = n_rows
+
+    delta_t = s.ms / 1000
+    LOGGER.info(
+        'copied {} rows ({} new) into {} in {:.2f}s ({:.0f} rows/s)'.format(
+            n_copied, n_rows, d['table'], delta_t,
+            n_copied / max(delta_t, 1e-6)))
+    return n_rows
+
+
+def get_db_pool():
+    """
+        Connection pool for this worker process. Created lazily so that each
+        process (e.g. after a fork) sets up its own connections.
+    """
+    global _DB_POOL
+    if _DB_POOL is None or _DB_POOL.closed:
+        # records are ingested by STF_RECORD_CONCURRENCY threads, only one
+        # of them should create the pool
+        with _DB_POOL_LOCK:
+            if _DB_POOL is None or _DB_POOL.closed:
+                _DB_POOL = psycopg2.pool.ThreadedConnectionPool(
+                    1, DB_POOL_MAX_CONN, STFDB_CONNECTION)
+    return _DB_POOL
+
+
+@contextlib.contextmanager
+def db_connection():
+    """
+        Borrows a pooled connection for the duration of one transaction.
+        Commits on success and rolls back on error.
+    """
+    pool = get_db_pool()
+    con = borrow_connection(pool)
+    try:
+        yield con
+        con.commit()
+    except Exception:
+        if not con.closed:
+            con.rollback()
+        raise
+    finally:
+        release_connection(pool, con)
+
+
+def borrow_connection(pool):
+    """
+        Gets a connection from the pool, replacing it with a new one if it
+        is no longer alive (see `connection_alive`).
+    """
+    con = pool.getconn()
+    if connection_alive(con):
+        return con
+    LOGGER.info('pooled connection is no longer alive, reconnecting')
+    _DB_LAST_USED.pop(id(con), None)
+    pool.putconn(con, close=True)
+    return pool.getconn()
+
+
+def release_connection(pool, con):
+    # broken connections are discarded rather than returned to the pool
+    if con.closed:
+        _DB_LAST_USED.pop(id(con), None)
+    else:
+        _DB_LAST_USED[id(con)] = time.time()
+    pool.putconn(con, close=bool(con.closed))
+
+
+def connection_alive(con):
+    """
+        `con.closed` is only set once psycopg2 notices the connection is
+        gone, so connections that have been idle for more than
+        DB_LIVENESS_IDLE_SECS are also pinged. Recently used ones aren't, to
+        save a round trip per transaction.
+    """
+    if con.closed:
+        return False
+    last_used = _DB_LAST_USED.get(id(con))
+    if (last_used is not None
+            and time.time() - last_used < DB_LIVENESS_IDLE_SECS):
+        return True
+    try:
+        with con.cursor() as cur:
+            cur.execute('SELECT 1')
+        con.rollback()
+    except psycopg2.Error:
+        return False
+    return True
 
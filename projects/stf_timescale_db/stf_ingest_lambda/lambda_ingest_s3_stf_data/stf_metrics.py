@@ -0,0 +1,201 @@
+"""
+    Structured timing of the ingest stages. A stage is timed with a span,
+    which can carry the rows and bytes it handled:
+
+        with stf_metrics.span('copy', table='stf_fc_flow') as s:
+            ...
+            s.n_rows = n_rows
+            s.n_bytes = n_bytes
+
+    Every span that finishes is written as a json line to the output set by
+    `configure` (nothing is written by default), e.g.
+
+        {"stage": "copy", "ms": 41.2, "rows": 192, "bytes": 10263,
+         "table": "stf_fc_flow", "file": "SWIFT-...nc", "timestamp": ...}
+
+    With `emf` the lines are also in CloudWatch embedded metric format, so on
+    lambda (printed to stdout) ms/rows/bytes become metrics per stage without
+    any calls to CloudWatch.
+
+    Functions can also be timed as a whole with the `timed` decorator.
+
+    Fields given to `context` (e.g. the file being ingested) are added to the
+    spans within it on the same thread, and it collects those spans so that
+    they can be summarised per stage (`summarize`/`format_summary`).
+
+    Spans nest, and time is inclusive: e.g. a forecast `frame` span includes
+    its `metadata` and `quantile` spans.
+
+    NOTE: the lambda has a copy of this file, keep them in sync.
+"""
+import json
+import time
+import functools
+import threading
+import contextlib
+
+EMF_NAMESPACE = 'stf_ingest'
+EMF_METRICS = [
+    ('ms', 'Milliseconds'),
+    ('rows', 'Count'),
+    ('bytes', 'Bytes')
+]
+
+_OUTPUT = None
+_EMF = False
+_OUTPUT_LOCK = threading.Lock()
+_LOCAL = threading.local()
+
+
+def configure(output=None, emf=False):
+    """
+        output: file-like object (e.g. sys.stdout) or path of a file to
+                append the spans to. None to stop writing them.
+        emf:    write in CloudWatch embedded metric format
+    """
+    global _OUTPUT, _EMF
+    if isinstance(output, str):
+        # line buffered, so that lines from several processes don't mix
+        output = open(output, 'a', buffering=1)
+    _OUTPUT = output
+    _EMF = emf
+
+
+class Span():
+    def __init__(self, stage, fields, n_rows=None, n_bytes=None):
+        self.stage = stage
+        self.fields = fields
+        self.n_rows = n_rows
+        self.n_bytes = n_bytes
+        self.ms = None
+        self.error = False
+
+    def record(self):
+        rec = dict(self.fields)
+        rec.update({
+            'stage': self.stage,
+            'ms': round(self.ms, 3),
+            'rows': self.n_rows,
+            'bytes': self.n_bytes,
+            'error': self.error,
+            'timestamp': int(time.time() * 1000)
+        })
+        return rec
+
+
+@contextlib.contextmanager
+def context(**fields):
+    """
+        Adds `fields` to every span on this thread until exit. Yields the
+        list of span records finished within it.
+    """
+    parent = getattr(_LOCAL, 'context', None)
+    spans = []
+    _LOCAL.context = (
+        dict(parent[0] if parent else {}, **fields), spans, parent)
+    try:
+        yield spans
+    finally:
+        _LOCAL.context = parent
+
+
+@contextlib.contextmanager
+def span(stage, n_rows=None, n_bytes=None, **fields):
+    """
+        Times the block as `stage`, yielding the `Span` so that its n_rows
+        and n_bytes can be set once known. Spans that raise are recorded
+        with error=True.
+    """
+    ctx = getattr(_LOCAL, 'context', None)
+    s = Span(stage, dict(ctx[0] if ctx else {}, **fields), n_rows, n_bytes)
+    start = time.perf_counter()
+    try:
+        yield s
+    except BaseException:
+        s.error = True
+        raise
+    finally:
+        s.ms = 1000 * (time.perf_counter() - start)
+        _emit(s.record())
+
+
+def timed(stage, **fields):
+    """
+        Decorator that times every call as a span, with n_rows set to the
+        length of the result.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(stage, **fields) as s:
+                result = func(*args, **kwargs)
+                s.n_rows = len(result)
+            return result
+        return wrapper
+    return decorator
+
+
+def _emit(rec):
+    # every enclosing context collects the span
+    ctx = getattr(_LOCAL, 'context', None)
+    while ctx is not None:
+        ctx[1].append(rec)
+        ctx = ctx[2]
+    if _OUTPUT is None:
+        return
+    line = json.dumps(emf_record(rec) if _EMF else rec, default=str)
+    with _OUTPUT_LOCK:
+        _OUTPUT.write(line + '\n')
+
+
+def emf_record(rec):
+    """ Span record in CloudWatch embedded metric format, by stage """
+    metrics = [{'Name': name, 'Unit': unit} for name, unit in EMF_METRICS
+        if rec.get(name) is not None]
+    return dict(rec, _aws={
+        'Timestamp': rec['timestamp'],
+        'CloudWatchMetrics': [{
+            'Namespace': EMF_NAMESPACE,
+            'Dimensions': [['stage']],
+            'Metrics': metrics
+        }]
+    })
+
+
+def summarize(spans):
+    """
+        Totals per stage for span records (e.g. collected by `context`, or
+        read back from the json lines):
+
+            {stage: {'count', 'errors', 'seconds', 'rows', 'bytes'}}
+    """
+    totals = {}
+    for rec in spans:
+        t = totals.setdefault(rec['stage'], {
+            'count': 0, 'errors': 0, 'seconds': 0.0, 'rows': 0, 'bytes': 0})
+        t['count'] += 1
+        t['errors'] += bool(rec.get('error'))
+        t['seconds'] += rec['ms'] / 1000
+        t['rows'] += rec.get('rows') or 0
+        t['bytes'] += rec.get('bytes') or 0
+    return totals
+
+
+def format_summary(totals):
+    """ Table of `summarize` totals, one line per stage """
+    lines = ['{:<10}{:>7}{:>7}{:>11}{:>10}{:>12}{:>10}{:>12}'.format(
+        'stage', 'count', 'errors', 'total (s)', 'ms/span', 'rows', 'MiB',
+        'rows/s')]
+    for stage, t in totals.items():
+        lines.append(
+            '{:<10}{:>7}{:>7}{:>11.3f}{:>10.2f}{:>12}{:>10.1f}{:>12.0f}'.format(
+                stage, t['count'], t['errors'], t['seconds'],
+                1000 * t['seconds'] / max(t['count'], 1), t['rows'],
+                t['bytes'] / 2**20, t['rows'] / max(t['seconds'], 1e-6)))
+    return '\n'.join(lines)
+
+
+def read_spans(path):
+    """ Span records from a json lines file written by `configure` """
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
@@ -0,0 +1,8 @@
+import os
+import sys
+
+# modules packaged alongside app.py are imported as top level modules in the
+# lambda runtime (e.g. `import stf_pgcopy`)
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'lambda_ingest_s3_stf_data'))
@@ -0,0 +1,39 @@
+import zlib
+
+import numpy as np
+import xarray as xr
+
+from lambda_ingest_s3_stf_data import app
+
+
+def decode(buf, n_lead, n_members):
+    """ same as the api's `StfFcEns.decode_ens` """
+    raw = np.frombuffer(zlib.decompress(bytes(buf)), dtype=np.uint8)
+    raw = np.ascontiguousarray(raw.reshape(4, -1).T)
+    return raw.view('<f4').reshape(n_lead, n_members)
+
+
+def test_fc_ens_rows_round_trip(monkeypatch):
+    # 3 stations, 4 lead times, 5 members
+    q = np.arange(60, dtype=np.float32).reshape(1, 5, 3, 4)
+    q[0, 2, 1, 3] = np.nan
+    ds = xr.Dataset(
+        {
+            'q_fcast_ens': (('time', 'ens_member', 'station', 'lead_time'), q),
+            'station_id': (('station',), np.array([1, 2, 3]))
+        },
+        coords={'lead_time': np.arange(1, 5), 'ens_member': np.arange(5)}
+    )
+    monkeypatch.setattr(app, 'STATION_CHUNK_SIZE', 2)
+    # node 2 has no metadata
+    monkeypatch.setattr(app, 'station_meta_ids',
+        lambda node_ids, catchment: np.array([10, -1, 30]))
+
+    rows = app.fc_ens_rows(ds, 'fc_dt', 'kiewa')
+
+    assert [r[0] for r in rows] == [10, 30]
+    for (meta_id, fc_dt, lead_times, n_members, ens), s in zip(rows, [0, 2]):
+        assert fc_dt == 'fc_dt'
+        assert lead_times == [1, 2, 3, 4]
+        np.testing.assert_array_equal(
+            decode(ens, len(lead_times), n_members), q[0, :, s, :].T)
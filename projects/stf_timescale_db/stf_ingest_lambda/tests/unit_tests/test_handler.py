@@ -1,5 +1,6 @@
 import os
 import json
+import contextlib
 
 import pytest
 import logging
@@ -53,3 +54,61 @@ def s3_event():
 def test_lambda_handler(s3_event, mocker, monkeypatch, caplog):
     caplog.set_level(logging.DEBUG, app.LOGGER.name)
     ret = app.lambda_handler(s3_event, "")
+
+
+def test_lambda_handler_sqs_batch(s3_event, mocker):
+    """ Every record in an SQS batch is ingested, failures are reported """
+    def fake_ingest(record, s3_file):
+        if '20201010' in s3_file:
+            raise ValueError('bad file')
+        return 'ingested', 10
+
+    mocker.patch.object(app, '_ingest_record', side_effect=fake_ingest)
+
+    record = s3_event['Records'][0]
+    bad_record = json.loads(json.dumps(record))
+    bad_record['s3']['object']['key'] = record['s3']['object']['key'].replace(
+        '20201009', '20201010')
+    sqs_event = {
+        'Records': [
+            {
+                'messageId': 'msg-1',
+                'eventSource': 'aws:sqs',
+                'body': json.dumps({'Records': [record, record]})
+            },
+            {
+                'messageId': 'msg-2',
+                'eventSource': 'aws:sqs',
+                'body': json.dumps({'Records': [bad_record]})
+            }
+        ]
+    }
+
+    ret = app.lambda_handler(sqs_event, "")
+
+    assert [r['status'] for r in ret['results']] == [
+        'ingested', 'ingested', 'failed']
+    assert ret['batchItemFailures'] == [{'itemIdentifier': 'msg-2'}]
+
+
+def test_ingest_record_in_flight(s3_event, mocker):
+    """
+        A file locked by another invocation is skipped if it's the same object
+        being ingested, otherwise it's left to be retried
+    """
+    @contextlib.contextmanager
+    def locked(stf_type, fn):
+        yield False
+
+    mocker.patch.object(app, 'ingest_lock', locked)
+    status = mocker.patch.object(app, 'manifest_status',
+        return_value='in_progress')
+    record = s3_event['Records'][0]
+
+    assert app.ingest_record(record)['status'] == 'skipped'
+
+    status.return_value = None
+    result = app.ingest_record(record)
+    assert result['status'] == 'in_flight'
+    with pytest.raises(RuntimeError):
+        app.lambda_handler(s3_event, '')
@@ -0,0 +1,52 @@
+import io
+import json
+
+import pytest
+
+from lambda_ingest_s3_stf_data import stf_metrics
+
+
+@pytest.fixture()
+def output(monkeypatch):
+    buf = io.StringIO()
+    monkeypatch.setattr(stf_metrics, '_OUTPUT', buf)
+    monkeypatch.setattr(stf_metrics, '_EMF', True)
+    return buf
+
+
+def test_spans_are_collected_and_emitted(output):
+    with stf_metrics.context(file='a.nc') as spans:
+        with stf_metrics.span('copy', table='stf_fc_flow') as s:
+            s.n_rows = 10
+            s.n_bytes = 100
+        with pytest.raises(ValueError):
+            with stf_metrics.span('decode'):
+                raise ValueError()
+
+    assert [(r['stage'], r['file'], r['error']) for r in spans] == [
+        ('copy', 'a.nc', False), ('decode', 'a.nc', True)]
+
+    lines = [json.loads(line) for line in output.getvalue().splitlines()]
+    assert lines[0]['table'] == 'stf_fc_flow'
+    metrics = lines[0]['_aws']['CloudWatchMetrics'][0]
+    assert metrics['Dimensions'] == [['stage']]
+    assert [m['Name'] for m in metrics['Metrics']] == ['ms', 'rows', 'bytes']
+    # only time is known for the failed decode
+    assert [m['Name'] for m in lines[1]['_aws']['CloudWatchMetrics'][0][
+        'Metrics']] == ['ms']
+
+    totals = stf_metrics.summarize(spans)
+    assert totals['copy']['rows'] == 10
+    assert totals['copy']['bytes'] == 100
+    assert totals['decode']['errors'] == 1
+
+
+def test_timed_counts_result_rows(output):
+    @stf_metrics.timed('frame')
+    def frame():
+        return [1, 2, 3]
+
+    with stf_metrics.context() as spans:
+        assert frame() == [1, 2, 3]
+    assert spans[0]['stage'] == 'frame'
+    assert spans[0]['rows'] == 3
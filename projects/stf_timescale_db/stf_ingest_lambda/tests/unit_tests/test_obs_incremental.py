@@ -0,0 +1,70 @@
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+import pytest
+
+from lambda_ingest_s3_stf_data import app
+
+
+@pytest.fixture()
+def ds_obs():
+    """ 3 stations with 6 hours of observed flow """
+    time = pd.date_range('2020-10-09T18:00', periods=6, freq='h')
+    return xr.Dataset(
+        {
+            'q_der': (('time', 'station'), np.arange(18.0).reshape(6, 3)),
+            'station_id': (('station',), np.array([1, 2, 3]))
+        },
+        coords={'time': time, 'station': np.arange(3)}
+    )
+
+
+def test_obs_frame_only_sends_new_timestamps(ds_obs, monkeypatch):
+    monkeypatch.setattr(app, 'OBS_INCREMENTAL', True)
+    # node 3 has no metadata
+    monkeypatch.setattr(app, 'station_meta_ids',
+        lambda node_ids, catchment: np.array([10, 20, -1]))
+    stored = (np.datetime64('2020-10-09T18:00', 'ns'),
+        np.datetime64('2020-10-09T21:00', 'ns'))
+    # meta_id 20 has nothing stored yet
+    monkeypatch.setattr(app, 'get_obs_ranges',
+        lambda meta_ids: {10: stored, 20: None})
+
+    df = app.obs_frame(ds_obs, 'kiewa')
+
+    assert (df['meta_id'] == 10).sum() == 2
+    assert df.loc[df['meta_id'] == 10, 'obs_datetime'].min() == pd.Timestamp(
+        '2020-10-09T22:00')
+    assert (df['meta_id'] == 20).sum() == 6
+    assert not (df['meta_id'] == -1).any()
+    assert app.obs_ranges(df)[10] == (
+        np.datetime64('2020-10-09T22:00', 'ns'),
+        np.datetime64('2020-10-09T23:00', 'ns'), 2)
+
+
+def hour(h):
+    return np.datetime64('2020-10-09T00:00', 'ns') + np.timedelta64(h, 'h')
+
+
+def test_obs_range_cache_merges_adjacent_rows(monkeypatch):
+    monkeypatch.setattr(app, '_OBS_RANGE_CACHE',
+        {10: (0, (hour(5), hour(9), True))})
+
+    # incremental frame: every hour from 10 to 12
+    app.update_obs_range_cache({10: (hour(10), hour(12), 3)})
+    assert app._OBS_RANGE_CACHE[10] == (0, (hour(5), hour(12), True))
+
+    # an hour missing before the stored range
+    app.update_obs_range_cache({10: (hour(1), hour(4), 3)})
+    assert app._OBS_RANGE_CACHE[10] == (0, (hour(1), hour(12), False))
+
+
+def test_obs_range_cache_drops_disjoint_rows(monkeypatch):
+    # e.g. an older file going in after a newer one, the hours in between
+    # would never be sent if the ranges were merged
+    monkeypatch.setattr(app, '_OBS_RANGE_CACHE',
+        {10: (0, (hour(20), hour(29), True))})
+
+    app.update_obs_range_cache({10: (hour(5), hour(9), 5)})
+    assert 10 not in app._OBS_RANGE_CACHE
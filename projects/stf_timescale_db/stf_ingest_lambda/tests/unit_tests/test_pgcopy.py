@@ -0,0 +1,84 @@
+import struct
+import datetime
+
+import numpy as np
+import pandas as pd
+import pytz
+
+import stf_pgcopy
+
+
+def read_rows(buf):
+    """ Minimal binary COPY reader for the types used by the ingest """
+    data = buf.getvalue()
+    assert data[:len(stf_pgcopy.COPY_HEADER)] == stf_pgcopy.COPY_HEADER
+    pos = len(stf_pgcopy.COPY_HEADER)
+    rows = []
+    while True:
+        (n_fields,) = struct.unpack_from('!h', data, pos)
+        pos += 2
+        if n_fields == -1:
+            break
+        row = []
+        for _ in range(n_fields):
+            (length,) = struct.unpack_from('!i', data, pos)
+            pos += 4
+            if length == -1:
+                row.append(None)
+                continue
+            row.append(data[pos:pos + length])
+            pos += length
+        rows.append(row)
+    assert pos == len(data)
+    return rows
+
+
+def test_encode_frame_with_nulls():
+    fc_dt = pytz.utc.localize(datetime.datetime(2020, 10, 9, 23))
+    df = pd.DataFrame({
+        'fc_datetime': [fc_dt, fc_dt],
+        'lead_time_hours': [1, 2],
+        'meta_id': [7, 7],
+        'value': [1.5, np.nan]
+    })
+    columns = [
+        ('fc_datetime', 'timestamptz'),
+        ('lead_time_hours', 'int4'),
+        ('meta_id', 'int4'),
+        ('value', 'float8')
+    ]
+
+    rows = read_rows(stf_pgcopy.encode_frame(df, columns))
+
+    us_since_2000 = int((fc_dt - pytz.utc.localize(
+        datetime.datetime(2000, 1, 1))).total_seconds()) * 1000000
+    assert rows[0] == [
+        struct.pack('!q', us_since_2000),
+        struct.pack('!i', 1),
+        struct.pack('!i', 7),
+        struct.pack('!d', 1.5)
+    ]
+    assert rows[1][1] == struct.pack('!i', 2)
+    assert rows[1][3] is None
+
+
+def test_encode_naive_datetime_as_utc():
+    naive = np.array(['2000-01-01T01:00'], dtype='datetime64[ns]')
+    rows = read_rows(stf_pgcopy.encode_columns([(naive, 'timestamptz')]))
+    assert rows == [[struct.pack('!q', 3600 * 1000000)]]
+
+
+def test_encode_frames_stream_matches_encode_frame():
+    df = pd.DataFrame({
+        'meta_id': np.arange(10),
+        'value': np.where(np.arange(10) % 3 == 0, np.nan, np.arange(10.0))
+    })
+    columns = [('meta_id', 'int4'), ('value', 'float8')]
+    frames = (df.iloc[i:i + 4] for i in range(0, len(df), 4))
+
+    stream = stf_pgcopy.encode_frames(frames, columns)
+    # read in small pieces that straddle the frame boundaries
+    parts = iter(lambda: stream.read(7), b'')
+
+    assert b''.join(parts) == stf_pgcopy.encode_frame(df, columns).getvalue()
+    assert stream.read() == b''
@@ -0,0 +1,57 @@
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+import pytest
+
+from lambda_ingest_s3_stf_data import app
+
+
+@pytest.fixture()
+def da_fc():
+    """ Generates a small SWIFT-like ensemble forecast """
+    rng = np.random.default_rng(42)
+    n_time, n_ens, n_station, n_lead = 1, 50, 3, 12
+    return xr.DataArray(
+        rng.gamma(2.0, 10.0, size=(n_time, n_ens, n_station, n_lead)),
+        dims=('time', 'ens_member', 'station', 'lead_time'),
+        coords={
+            'time': [0],
+            'ens_member': np.arange(1, n_ens + 1),
+            'station': np.arange(1, n_station + 1),
+            'lead_time': np.arange(1, n_lead + 1)
+        },
+        name='q_fcast_ens'
+    )
+
+
+def test_quantiles_matches_per_station_groupby(da_fc):
+    df = app.quantiles(da_fc)
+
+    assert len(df) == da_fc.sizes['station'] * da_fc.sizes['lead_time']
+
+    for i in range(da_fc.sizes['station']):
+        # reference: the original per station groupby
+        df_ref = (da_fc.isel(station=i).to_dataframe()
+                .reset_index()
+                .groupby(['lead_time', 'time'])['q_fcast_ens']
+                .quantile(list(app.PCTL_MAP.values()))
+                .unstack())
+        df_ref.columns = list(app.PCTL_MAP)
+        df_ref = df_ref.reset_index()
+
+        df_station = (df[df['station'] == i]
+            .drop(columns='station')
+            .sort_values(['lead_time', 'time'])
+            .reset_index(drop=True))
+
+        pd.testing.assert_frame_equal(
+            df_station, df_ref, check_dtype=False, check_names=False)
+
+
+def test_quantiles_propagates_nan(da_fc):
+    da_fc[0, 0, 1, 3] = np.nan
+    df = app.quantiles(da_fc)
+
+    row = df[(df['station'] == 1) & (df['lead_time'] == 4)]
+    assert row[list(app.PCTL_MAP)].isna().all(axis=None)
@@ -0,0 +1,52 @@
+import os
+
+import boto3
+import pytest
+
+# optional test dependency, the s3 tests are skipped without it
+moto = pytest.importorskip('moto', minversion='5')
+mock_aws = moto.mock_aws
+
+from lambda_ingest_s3_stf_data import app
+
+BUCKET = 'stf-test-bucket'
+KEY = 'kiewa/SWIFT-Ensemble-Forecast-Flow_kiewa_20201009_2300.nc'
+
+
+@pytest.fixture()
+def s3_object(monkeypatch):
+    """ Puts an object spanning several parts into a moto s3 bucket """
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    # the client is cached across invocations, make sure it picks up the
+    # test credentials
+    monkeypatch.setattr(app, '_S3_CLIENT', None)
+    body = os.urandom(12 * 1024 * 1024)
+    with mock_aws():
+        s3 = boto3.client('s3', region_name=app.AWS_REGION)
+        s3.create_bucket(
+            Bucket=BUCKET,
+            CreateBucketConfiguration={'LocationConstraint': app.AWS_REGION})
+        s3.put_object(Bucket=BUCKET, Key=KEY, Body=body)
+        yield body
+
+
+def test_spool_s3_object(s3_object, tmp_path, monkeypatch):
+    monkeypatch.setattr(app, 'S3_FETCH_MODE', 'spool')
+    monkeypatch.setattr(app, 'SPOOL_DIR', str(tmp_path))
+    monkeypatch.setattr(app, 'S3_PART_SIZE', 5 * 1024 * 1024)
+
+    with app.open_s3_object(BUCKET, KEY) as path:
+        assert os.path.dirname(path) == str(tmp_path)
+        with open(path, 'rb') as f:
+            assert f.read() == s3_object
+
+    # spooled file is cleaned up afterwards
+    assert os.listdir(tmp_path) == []
+
+
+def test_memory_s3_object(s3_object, monkeypatch):
+    monkeypatch.setattr(app, 'S3_FETCH_MODE', 'memory')
+
+    with app.open_s3_object(BUCKET, KEY) as f:
+        assert f.read() == s3_object
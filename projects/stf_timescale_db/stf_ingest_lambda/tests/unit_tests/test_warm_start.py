@@ -0,0 +1,79 @@
+import psycopg2
+
+from lambda_ingest_s3_stf_data import app
+
+
+class FakeConnection():
+    def __init__(self, alive=True):
+        self.closed = 0
+        self.alive = alive
+        self.n_pings = 0
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def rollback(self):
+        pass
+
+
+class FakeCursor():
+    def __init__(self, con):
+        self.con = con
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, sql):
+        self.con.n_pings += 1
+        if not self.con.alive:
+            raise psycopg2.OperationalError('server closed the connection')
+
+
+class FakePool():
+    def __init__(self, connections):
+        self.idle = list(connections)
+        self.discarded = []
+
+    def getconn(self):
+        return self.idle.pop(0)
+
+    def putconn(self, con, close=False):
+        if close:
+            self.discarded.append(con)
+        else:
+            self.idle.append(con)
+
+
+def test_s3_client_is_reused(monkeypatch):
+    monkeypatch.setattr(app, '_S3_CLIENT', None)
+    assert app.get_s3_client() is app.get_s3_client()
+
+
+def test_dead_connection_is_replaced(monkeypatch):
+    monkeypatch.setattr(app, '_DB_LAST_USED', {})
+    dead, fresh = FakeConnection(alive=False), FakeConnection()
+    pool = FakePool([dead, fresh])
+
+    con = app.borrow_connection(pool)
+
+    assert con is fresh
+    assert pool.discarded == [dead]
+
+
+def test_recently_used_connection_is_not_pinged(monkeypatch):
+    monkeypatch.setattr(app, '_DB_LAST_USED', {})
+    con = FakeConnection()
+    pool = FakePool([con])
+
+    app.release_connection(pool, app.borrow_connection(pool))
+    assert con.n_pings == 1
+    app.release_connection(pool, app.borrow_connection(pool))
+    assert con.n_pings == 1
+
+    # idle for too long, checked again
+    monkeypatch.setattr(app, 'DB_LIVENESS_IDLE_SECS', 0)
+    app.release_connection(pool, app.borrow_connection(pool))
+    assert con.n_pings == 2